@@ -1,7 +1,10 @@
 from interfaces.login import LoginPage
 from models.admin import Admin
+from models.base.document import IndexedDocument
 
 if __name__ == '__main__':
+    # Write changes in the background while the menus wait for input, see IndexedDocument
+    IndexedDocument._write_behind_delay = 0.5
     Admin.configure_initial_user()
 
     LoginPage().run()
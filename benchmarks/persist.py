@@ -0,0 +1,40 @@
+import time
+
+from benchmarks.reference_set import BenchmarkCamp, BenchmarkRefugee
+from models.base.document import IndexedDocument
+from models.base.field import Field, ReferenceDocumentsField
+
+
+class BenchmarkPlan(IndexedDocument):
+    name = Field(primary_key=True)
+    camps = ReferenceDocumentsField(data_type=BenchmarkCamp)
+
+
+def benchmark_persist(size: int, camps: int = 10) -> float:
+    """
+    Time writing a plan whose camps hold the given number of refugees, in memory to leave out disk I/O.
+    :return: seconds taken
+    """
+    previous_mode = IndexedDocument.override_storage_mode('memory')
+    try:
+        BenchmarkPlan.delete_all()
+        with IndexedDocument.transaction():
+            plan = BenchmarkPlan(name='plan', camps=[BenchmarkCamp(name=f'camp{i}', refugees=[])
+                                                     for i in range(camps)])
+            for i, camp in enumerate(plan.camps):
+                camp.refugees.add(*[BenchmarkRefugee(user_id=user_id, num_of_family_member=1)
+                                    for user_id in range(i, size, camps)])
+        start = time.perf_counter()
+        BenchmarkPlan._persist(plan)
+        elapsed = time.perf_counter() - start
+        BenchmarkPlan.delete_all()
+        return elapsed
+    finally:
+        IndexedDocument.override_storage_mode(previous_mode)
+
+
+if __name__ == '__main__':
+    print(f'{"refugees":>10} {"persist (s)":>12} {"us/refugee":>12}')
+    for size in (12_500, 25_000, 50_000, 100_000):
+        persist_time = benchmark_persist(size)
+        print(f'{size:>10} {persist_time:>12.3f} {persist_time / size * 1e6:>12.2f}')
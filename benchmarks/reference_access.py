@@ -0,0 +1,22 @@
+import time
+
+from benchmarks.reference_set import BenchmarkCamp, BenchmarkRefugee
+
+
+def benchmark_access(size: int, repeat: int = 100_000) -> float:
+    """
+    Time reading the refugees of a camp, as done by Camp.count_refugees and the menus.
+    :return: seconds per access
+    """
+    refugees = [BenchmarkRefugee(user_id=i, num_of_family_member=1) for i in range(size)]
+    camp = BenchmarkCamp(name='camp', refugees=refugees)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        camp.refugees
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    print(f'{"refugees":>10} {"ns/access":>12}')
+    for size in (10, 1_000, 10_000, 100_000):
+        print(f'{size:>10} {benchmark_access(size) * 1e9:>12.1f}')
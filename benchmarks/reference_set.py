@@ -0,0 +1,53 @@
+import time
+
+from models.base.document import Document
+from models.base.field import Field, ReferenceDocumentsField
+
+
+class BenchmarkRefugee(Document):
+    """
+    Keyed document shaped like Refugee.
+    Refugee ids are truncated UUIDs, which collide at this scale, so sequential ids are used instead.
+    """
+    user_id = Field(primary_key=True)
+    num_of_family_member = Field()
+
+
+class BenchmarkCamp(Document):
+    name = Field(primary_key=True)
+    refugees = ReferenceDocumentsField(data_type=BenchmarkRefugee)
+
+
+def benchmark_bulk_insert(size: int) -> float:
+    """
+    Time adding refugees to a single camp in one call.
+    :return: seconds taken
+    """
+    camp = BenchmarkCamp(name='camp', refugees=[])
+    refugees = [BenchmarkRefugee(user_id=i, num_of_family_member=1) for i in range(size)]
+    start = time.perf_counter()
+    camp.refugees.add(*refugees)
+    return time.perf_counter() - start
+
+
+def benchmark_lookups(size: int) -> float:
+    """
+    Time a membership check and a get for every refugee in a camp.
+    :return: seconds taken
+    """
+    refugees = [BenchmarkRefugee(user_id=i, num_of_family_member=1) for i in range(size)]
+    camp_refugees = BenchmarkCamp(name='camp', refugees=refugees).refugees
+    start = time.perf_counter()
+    for refugee in refugees:
+        assert refugee in camp_refugees
+        assert camp_refugees.get(refugee.user_id) is refugee
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    print(f'{"refugees":>10} {"bulk add (s)":>14} {"us/refugee":>12} {"lookups (s)":>14} {"us/refugee":>12}')
+    for size in (12_500, 25_000, 50_000, 100_000):
+        insert_time = benchmark_bulk_insert(size)
+        lookup_time = benchmark_lookups(size)
+        print(f'{size:>10} {insert_time:>14.3f} {insert_time / size * 1e6:>12.2f} '
+              f'{lookup_time:>14.3f} {lookup_time / size * 1e6:>12.2f}')
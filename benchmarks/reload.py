@@ -0,0 +1,83 @@
+import time
+
+from benchmarks.persist import BenchmarkPlan
+from benchmarks.reference_set import BenchmarkCamp, BenchmarkRefugee
+from models.base.document import Document, IndexedDocument
+from models.base.field import Field, ReferenceDocumentsField
+
+
+class BenchmarkVolunteer(IndexedDocument):
+    username = Field(primary_key=True)
+
+
+class BenchmarkStaffedCamp(Document):
+    name = Field(primary_key=True)
+    volunteers = ReferenceDocumentsField(data_type=BenchmarkVolunteer)
+
+
+class BenchmarkStaffedPlan(IndexedDocument):
+    """
+    Plans whose camps reference volunteers in another index, as Plan, Camp and Volunteer do.
+    """
+    name = Field(primary_key=True)
+    camps = ReferenceDocumentsField(data_type=BenchmarkStaffedCamp)
+
+
+def benchmark_reload(size: int, plans: int = 100) -> float:
+    """
+    Time reloading plans and the volunteers they reference, in memory to leave out disk I/O.
+    :param size: the number of volunteers, spread over the plans
+    :return: seconds taken
+    """
+    previous_mode = IndexedDocument.override_storage_mode('memory')
+    try:
+        BenchmarkStaffedPlan.delete_all()
+        BenchmarkVolunteer.delete_all()
+        with IndexedDocument.transaction():
+            volunteers = [BenchmarkVolunteer(username=f'volunteer{i}') for i in range(size)]
+            for i in range(plans):
+                BenchmarkStaffedPlan(name=f'plan{i}', camps=[
+                    BenchmarkStaffedCamp(name='camp', volunteers=volunteers[i::plans])])
+        start = time.perf_counter()
+        BenchmarkVolunteer.reload()
+        BenchmarkStaffedPlan.reload()
+        BenchmarkStaffedPlan.all()
+        elapsed = time.perf_counter() - start
+        BenchmarkStaffedPlan.delete_all()
+        BenchmarkVolunteer.delete_all()
+        return elapsed
+    finally:
+        IndexedDocument.override_storage_mode(previous_mode)
+
+
+def benchmark_reload_embedded(size: int, camps: int = 10) -> float:
+    """
+    Time reloading a plan whose camps hold the given number of refugees, in memory to leave out disk I/O.
+    :return: seconds taken
+    """
+    previous_mode = IndexedDocument.override_storage_mode('memory')
+    try:
+        BenchmarkPlan.delete_all()
+        with IndexedDocument.transaction():
+            BenchmarkPlan(name='plan', camps=[
+                BenchmarkCamp(name=f'camp{i}', refugees=[BenchmarkRefugee(user_id=user_id, num_of_family_member=1)
+                                                         for user_id in range(i, size, camps)])
+                for i in range(camps)])
+        start = time.perf_counter()
+        BenchmarkPlan.reload()
+        BenchmarkPlan.all()
+        elapsed = time.perf_counter() - start
+        BenchmarkPlan.delete_all()
+        return elapsed
+    finally:
+        IndexedDocument.override_storage_mode(previous_mode)
+
+
+if __name__ == '__main__':
+    print(f'{"documents":>10} {"cross-index reload (s)":>24} {"us/volunteer":>14} '
+          f'{"embedded reload (s)":>21} {"us/refugee":>12}')
+    for size in (6_250, 12_500, 25_000, 50_000):
+        reload_time = benchmark_reload(size)
+        embedded_time = benchmark_reload_embedded(size)
+        print(f'{size:>10} {reload_time:>24.3f} {reload_time / size * 1e6:>14.2f} '
+              f'{embedded_time:>21.3f} {embedded_time / size * 1e6:>12.2f}')
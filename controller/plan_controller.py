@@ -1,8 +1,9 @@
 from enum import Enum
 from typing import Iterable, Type
 
-from models.base.document import Document
+from models.base.document import Document, IndexedDocument
 from models.plan import Plan
+from models.plan_statistics import PlanStatistics
 from models.camp import Camp
 from controller import controller_error
 
@@ -44,13 +45,20 @@ def create_plan(plan_name: str, emergency_type: Plan.EmergencyType, description:
 
 def list_plans() -> list:
     """
-    List out all the plans.
+    List out all the open plans, and the closed plans if the storage mode of plans does not archive them.
     This would not be shown on the menu.
     """
     list_plan = Plan.all()
     return list_plan
 
 
+def list_closed_plan_names() -> list:
+    """
+    List the names of the closed plans, which are archived and not included in list_plans.
+    """
+    return sorted(Plan.archived_keys())
+
+
 def view_plan_statistics(plan: Plan) -> str:
     """
     Display plan statistics.
@@ -80,6 +88,28 @@ def view_plan_statistics(plan: Plan) -> str:
     return plan_info + statistics
 
 
+def view_statistics_dashboard(plans: Iterable[Plan] = None, limit: int = 10) -> str:
+    """
+    Display statistics across plans: totals by emergency type and geographical area,
+    and the camps needing the most volunteers.
+    """
+    plan_statistics = PlanStatistics(plans)
+    dashboard = f"\nCamps: {len(plan_statistics)}\n"
+    for title, column in (('Emergency type', 'emergency'), ('Geographical area', 'geographical_area')):
+        dashboard += f"\nTotals by {title.lower()}:\n"
+        for group, totals in plan_statistics.totals_by(column).items():
+            group_name = group.value.capitalize() if isinstance(group, Enum) else group or '(none)'
+            dashboard += f"{title}: '{group_name}'\n" \
+                         f"Number of camps: {totals['num_of_camps']}\n" \
+                         f"Number of refugees: {totals['num_of_refugees']}\n" \
+                         f"Number of volunteers: {totals['num_of_volunteers']}\n" \
+                         f"Volunteers needed: {totals['num_of_volunteers_needed']}\n\n"
+    dashboard += "Camps needing the most volunteers:\n"
+    for plan_name, camp_name, num_volunteers_vs_standard in plan_statistics.neediest_camps(limit):
+        dashboard += f"Plan '{plan_name}', camp '{camp_name}': {num_volunteers_vs_standard:+d}\n"
+    return dashboard
+
+
 def find_plan(plan_name: str) -> Plan:
     """
     Finds the relevant plan with a given plan name.
@@ -94,12 +124,17 @@ def close_plan(plan: Plan):
     """
     Use find_plan in combination with this function when admin requests for a plan to be closed.
     Inputted plan will be changed to read-only by changing the __is_closed flag in Plan class.
+    The change is written to disk before returning.
     """
     if plan.is_closed:
         raise controller_error.ControllerError(f"Plan '{plan.name}' is already closed.")
     else:
         plan.close()
         plan.save()
+        try:
+            IndexedDocument.flush()
+        except Document.PersistenceError as e:
+            raise controller_error.ControllerError(str(e))
 
 
 def find_camp(plan: Plan, camp_name: str) -> Camp:
@@ -45,11 +45,10 @@ def find_refugee(refugee_id: int) -> Refugee:
     """
     Function to find if refugee exists and returns the refugee class profile. Raise error if no such refugee, camp and plan exist .
     """
-    for plan in Plan.all():
-        for camp in plan.camps:
-            refugee = camp.refugees.get(refugee_id)
-            if refugee:
-                return refugee
+    # Refugees are indexed once the plans embedding them are loaded, and closed plans are only loaded if found
+    refugee = Plan.find_embedded_archived(Refugee, refugee_id)
+    if refugee:
+        return refugee
     raise ControllerError(f"Invalid refugee_id: {refugee_id}. The refugee is not found.")
 
 
@@ -1,4 +1,6 @@
+import io
 import unittest
+from contextlib import redirect_stdout
 from datetime import date
 
 from models.volunteer import Volunteer
@@ -7,6 +9,7 @@ from controller.controller_error import ControllerError
 from models.camp import Camp
 from models.plan import Plan
 import controller.plan_controller as pc
+from interfaces.manage_plan import ManagePlanMenu
 
 
 class PlanControllerTest(unittest.TestCase):
@@ -167,6 +170,23 @@ class PlanControllerTest(unittest.TestCase):
         expected = [Plan.find('First Plan'), Plan.find('Second Plan'), Plan.find('Third Plan')]
         self.assertListEqual(expected, pc.list_plans())
 
+    def test_list_closed_plans_controller(self):
+        """
+        Test that closed plans are listed by name only.
+        """
+        plan = Plan(name='First Plan',
+                    emergency_type=Plan.EmergencyType.EARTHQUAKE,
+                    description='Test emergency plan',
+                    geographical_area='',
+                    camps=[Camp(name='TestCamp')])
+        pc.close_plan(plan)
+        if Plan.has_archive_tier():
+            self.assertListEqual([], pc.list_plans())
+            self.assertListEqual(['First Plan'], pc.list_closed_plan_names())
+        else:
+            self.assertListEqual([plan], pc.list_plans())
+        self.assertIn("Plan name: 'First Plan' (closed)", pc.view_plan_statistics(pc.find_plan('First Plan')))
+
     def test_view_open_plan_statistics_returns_str(self):
         """
         Test to confirm that view_plan_statistics function returns str
@@ -245,6 +265,38 @@ class PlanControllerTest(unittest.TestCase):
         with self.assertRaises(ControllerError):
             pc.find_camp(plan, 'NonExistentCamp')
 
+    def test_view_statistics_dashboard(self):
+        """
+        Test the statistics across plans.
+        """
+        camp = Camp(name='TestCamp')
+        Plan(name='My Plan',
+             emergency_type=Plan.EmergencyType.FLOOD,
+             description='Test emergency plan',
+             geographical_area='London',
+             camps=[camp])
+        camp.refugees.add(Refugee(firstname='Tom', lastname='Bond', num_of_family_member=30,
+                                  starting_date=date(2020, 1, 2)))
+        dashboard = pc.view_statistics_dashboard()
+        self.assertIn("Emergency type: 'Flood'\nNumber of camps: 1\nNumber of refugees: 30\n", dashboard)
+        self.assertIn("Geographical area: 'London'", dashboard)
+        self.assertIn("Plan 'My Plan', camp 'TestCamp': -2\n", dashboard)
+
+    def test_view_statistics_dashboard_from_menu(self):
+        """
+        Test that the statistics across plans are shown from the plan menu.
+        """
+        Plan(name='My Plan',
+             emergency_type=Plan.EmergencyType.FLOOD,
+             description='Test emergency plan',
+             geographical_area='London',
+             camps=[Camp(name='TestCamp')])
+        menu = ManagePlanMenu(user=None)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            menu.call_menu_item(str(menu.menu_items.index(ManagePlanMenu.do_view_dashboard)))
+        self.assertIn(pc.view_statistics_dashboard(), output.getvalue())
+
     def tearDown(self):
         """
         Function to delete stored data after a test has finished running
@@ -60,6 +60,33 @@ class RefugeeControllerTest(unittest.TestCase):
         retrieved_refugee = rc.find_refugee(refugee_id)
         self.assertEqual(refugee, retrieved_refugee)
 
+    def test_find_refugee_in_closed_plan(self):
+        """
+        Test case where the refugee is in a closed plan, which is not loaded with the open plans.
+        """
+        test_camp = Camp(name='camp1')
+        plan = Plan(name='test_plan',
+                    emergency_type=Plan.EmergencyType.EARTHQUAKE,
+                    description='Test emergency plan',
+                    geographical_area='London',
+                    camps=[test_camp])
+        refugee = Refugee(firstname="Tom",
+                          lastname="Bond",
+                          num_of_family_member=2,
+                          starting_date=date(2020, 1, 2),
+                          medical_condition_type=[Refugee.MedicalCondition.HIV])
+        test_camp.refugees.add(refugee)
+        plan.close()
+        Plan.reload()
+        with self.assertRaises(rc.ControllerError):
+            rc.find_refugee(refugee.user_id + 1)
+        if Plan.has_archive_tier():
+            # Closed plans not embedding the refugee are not loaded
+            self.assertIsNone(Refugee.find_embedded(refugee.user_id))
+        retrieved_refugee = rc.find_refugee(refugee.user_id)
+        self.assertEqual(retrieved_refugee.user_id, refugee.user_id)
+        self.assertTrue(retrieved_refugee.camp.plan.is_closed)
+
     def test_find_nonexistent_refugee(self):
         """
         Test case where refugee specified is not found in the file.
@@ -1,4 +1,4 @@
-from models.base.document import Document
+from models.base.document import Document, IndexedDocument
 from models.volunteer import Volunteer
 from models.camp import Camp
 from controller.controller_error import ControllerError
@@ -74,21 +74,12 @@ def edit_camp(volunteer: Volunteer, camp: Camp, is_admin: bool) -> Volunteer:
     old_camp = volunteer.camp
     if camp.plan.is_closed:
         raise ControllerError(f"Plan '{camp.plan.name}' of camp '{camp}' is closed.")
-    if is_admin:
+    if not is_admin and old_camp.plan != camp.plan:
+        raise ControllerError(f"Invalid camp: {camp}. You can only select a camp under the same plan.")
+    with IndexedDocument.transaction():  # write each affected index once
         old_camp.volunteers.remove(volunteer)
-        old_camp.save()
         camp.volunteers.add(volunteer)
-        camp.save()
-        return volunteer
-    else:
-        if old_camp.plan == camp.plan:
-            old_camp.volunteers.remove(volunteer)
-            old_camp.save()
-            camp.volunteers.add(volunteer)
-            camp.save()
-            return volunteer
-        else:
-            raise ControllerError(f"Invalid camp: {camp}. You can only select a camp under the same plan.")
+    return volunteer
 
 
 def edit_availability(volunteer: Volunteer, availability: bool) -> Volunteer:
@@ -103,6 +94,10 @@ def deactivate_volunteer(volunteer: Volunteer) -> Volunteer:
         raise ControllerError(f"Volunteer {volunteer.username} is already deactivated.")
     volunteer.account_activated = False
     volunteer.save()
+    try:
+        IndexedDocument.flush()  # A deactivated volunteer must not be able to log in again after a restart
+    except Document.PersistenceError as e:
+        raise ControllerError(str(e))
     return volunteer
 
 
@@ -116,3 +111,7 @@ def reactivate_volunteer(volunteer: Volunteer) -> Volunteer:
 
 def delete_volunteer(volunteer: Volunteer) -> None:
     volunteer.delete()
+    try:
+        IndexedDocument.flush()
+    except Document.PersistenceError as e:
+        raise ControllerError(str(e))
@@ -1,20 +1,19 @@
-import glob
-import os
 from datetime import date
 
 from models.admin import Admin
 from models.camp import Camp
 from models.plan import Plan
 from models.refugee import Refugee
+from models.user import User
 from models.volunteer import Volunteer
 
 if __name__ == '__main__':
 
     # delete existing data
 
-    files = glob.glob('data/*')
-    for f in files:
-        os.remove(f)
+    # Through the models, as plans are stored in directories of segments and archived plans
+    Plan.delete_all()
+    User.delete_all()
 
     Admin.configure_initial_user()
 
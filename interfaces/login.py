@@ -1,7 +1,7 @@
 import sys
 
 from models.admin import Admin
-from models.base.document import Document
+from models.base.document import Document, IndexedDocument
 from models.user import User
 from models.volunteer import Volunteer
 
@@ -46,6 +46,10 @@ class LoginPage:
                     continue
                 # logout after user exit from inner menus
                 self.user = None
+                try:
+                    IndexedDocument.flush()
+                except Document.PersistenceError as e:
+                    print("\033[31m {}\033[00m".format(f"** {e}. The changes will be written again later."))
                 continue
             except (KeyError, User.InvalidPassword):
                 print("\033[31m {}\033[00m".format("** Invalid username or password. Please try again."))
@@ -54,10 +54,14 @@ class ManagePlanMenu(BaseMenu):
     def do_list_plans(self):
         """List out all the existing plans"""
         print("\n\033[100m\033[4m\033[1m{}\033[0m ".format("Existing Plans"))
-        if not plan_controller.list_plans():
+        plans = plan_controller.list_plans()
+        closed_plan_names = plan_controller.list_closed_plan_names()
+        if not plans and not closed_plan_names:
             print("\033[31m * No existing plan. \033[00m")
-        for plan in plan_controller.list_plans():
+        for plan in plans:
             print(plan, '\n')
+        if closed_plan_names:
+            print("Closed plans: " + ", ".join(f"'{plan_name}'" for plan_name in closed_plan_names), '\n')
         return
 
     def do_view_plan(self):
@@ -75,6 +79,12 @@ class ManagePlanMenu(BaseMenu):
                 print(f"\033[31m * Plan '{plan_name}' not found. Please re-enter plan name. \033[00m")
                 continue
 
+    def do_view_dashboard(self):
+        """View statistics across all plans"""
+        print("\n\033[100m\033[4m\033[1m{}\033[0m".format("Statistics Dashboard"))
+        print(plan_controller.view_statistics_dashboard())
+        return
+
     def do_close_plan(self):
         """Close a plan"""
         while True:
@@ -112,10 +112,13 @@ class ManageVolunteerMenu(BaseMenu):
                 return
             try:
                 find_volunteer = volunteer_controller.find_volunteer(username)
-                volunteer_controller.delete_volunteer(find_volunteer)
-                print("\x1b[6;30;42m success! \x1b[0m")
-                print(f"Volunteer {username} deleted.")
-                return
             except ControllerError:
                 print(f"\033[31m* Volunteer {username} not found. Please check and re-enter.\033[00m")
                 continue
+            try:
+                volunteer_controller.delete_volunteer(find_volunteer)
+                print("\x1b[6;30;42m success! \x1b[0m")
+                print(f"Volunteer {username} deleted.")
+            except ControllerError as e:
+                print(f"\033[31m* Fail: {e}\033[00m")
+            return
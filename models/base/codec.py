@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import io
+import pickle
+from datetime import date
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Type
+
+from models.base.field import ReferenceSet
+from models.base.meta_document import MetaDocument
+
+if TYPE_CHECKING:
+    from models.base.document import IndexedDocument
+
+
+class DocumentCodec:
+    """
+    Compact encoding of a root-level document and the documents it embeds, driven by the fields declared
+    by their classes instead of pickling the attributes of each document by name.
+
+    Each document is converted to a record: a tuple of its class, as a position in the classes of the record,
+    its remaining state, as a position in the distinct states of the record, and the values of its fields
+    in the order of the class. Classes are stored once per record, with the names of their fields,
+    so that records stay readable when fields are added or removed.
+    Strings, numbers, bytes, booleans and None are stored as they are, and other values as tuples starting
+    with a tag:
+    - dates as their ordinal, and enum members as their name;
+    - lists, tuples, sets and dictionaries as their items;
+    - other root-level documents as references by key, as with IndexedDocument.Pickler;
+    - any other value pickled on its own.
+    The records are pickled without any custom pickling, which is fast and compact for plain tuples.
+    Enum members are stored by name, so that members can be added in any order. Records written by earlier
+    versions store them by position.
+    """
+    MAGIC = b'\x00EMS1'  # Never the start of a pickle
+    (DATE, ENUM, LIST, TUPLE, SET, FROZENSET, DICT, CLASS, DOCUMENT, DOCUMENT_REF, REFERENCE, REFERENCE_SET,
+     PICKLED) = range(13)
+    MISSING = (-1,)  # Value of a field that is not set
+    PRIMITIVE_TYPES = {str, int, float, bool, bytes, type(None)}
+    COLLECTION_TAGS = {list: LIST, tuple: TUPLE, set: SET, frozenset: FROZENSET}
+
+    class InvalidRecordError(Exception):
+        def __init__(self, reason):
+            super().__init__(f'Invalid encoded document: {reason}')
+
+    def __init__(self, document_type: Type[IndexedDocument], root: IndexedDocument = None):
+        """
+        :param document_type: the class of the index the record belongs to
+        :param root: the document encoded in full, as for IndexedDocument.Pickler
+        """
+        # Imported here as the document module uses codecs
+        from models.base.document import Document, IndexedDocument
+        self.__document_base = Document
+        self.__indexed_document_base = IndexedDocument
+        self.document_type = document_type
+        self.root = root
+
+    def encode(self, document: IndexedDocument) -> bytes:
+        self.__classes: dict[type, int] = {}
+        self.__class_records: list[tuple] = []
+        self.__states: dict[tuple, int] = {}
+        self.__documents: dict[int, int] = {}  # {id(document): position in the record}
+        self.__encoders = {
+            date: self.__encode_date,
+            list: self.__encode_collection,
+            tuple: self.__encode_collection,
+            set: self.__encode_collection,
+            frozenset: self.__encode_collection,
+            dict: self.__encode_dict,
+            ReferenceSet: self.__encode_reference_set,
+        }
+        value = self.__encode(document)
+        return self.MAGIC + pickle.dumps((self.__class_records, tuple(self.__states), value))
+
+    def decode(self, data: bytes) -> Any:
+        try:
+            class_records, states, value = pickle.loads(memoryview(data)[len(self.MAGIC):])
+        except (pickle.UnpicklingError, ValueError, EOFError) as e:
+            raise self.InvalidRecordError(str(e))
+        self.__classes: list[tuple[type, tuple]] = [(MetaDocument.find_class(module, qualname), field_names)
+                                                     for module, qualname, field_names in class_records]
+        self.__state_records = states
+        self.__states: list[tuple[dict, bool]] = [None] * len(states)
+        self.__documents: list[Any] = []
+        return self.__decode(value)
+
+    def __encode(self, value) -> Any:
+        value_type = type(value)
+        if value_type in self.PRIMITIVE_TYPES:
+            return value
+        encoder = self.__encoders.get(value_type)
+        if encoder is not None:
+            return encoder(value)
+        if isinstance(value, self.__document_base):
+            return self.__encode_document(value)
+        if isinstance(value, Enum):
+            return self.ENUM, self.__encode_class(value_type), value.name
+        if isinstance(value, type) and issubclass(value, self.__document_base):
+            return self.CLASS, self.__encode_class(value)
+        if value_type is self.__indexed_document_base.DeferredReference:
+            # Copied as unpickled, e.g. when migrating from another storage mode
+            return self.REFERENCE, value.module, value.classname, self.__encode(value.key)
+        pickled = io.BytesIO()
+        self.document_type.Pickler(pickled, self.document_type, root=self.root).dump(value)
+        return self.PICKLED, pickled.getvalue()
+
+    def __encode_date(self, value: date) -> tuple:
+        return self.DATE, value.toordinal()
+
+    def __encode_collection(self, value) -> tuple:
+        return (self.COLLECTION_TAGS[type(value)], *map(self.__encode, value))
+
+    def __encode_dict(self, value: dict) -> tuple:
+        encoded = [self.DICT]
+        for key, item in value.items():
+            encoded.append(self.__encode(key))
+            encoded.append(self.__encode(item))
+        return tuple(encoded)
+
+    def __encode_reference_set(self, value: ReferenceSet) -> tuple:
+        return self.REFERENCE_SET, self.__encode(value.__dict__)
+
+    def __encode_document(self, document) -> tuple:
+        document_type = type(document)
+        if isinstance(document, self.__indexed_document_base) and (
+                document._storage_class is not self.document_type
+                or self.root is not None and document is not self.root):
+            return self.REFERENCE, document.__module__, self.__qualname(document_type), self.__encode(document.key)
+        position = self.__documents.get(id(document))
+        if position is not None:
+            return self.DOCUMENT_REF, position
+        self.__documents[id(document)] = len(self.__documents)
+        state = document.__getstate__()
+        data = state.pop('_data')
+        encoded_state = self.__encode(state)
+        state_position = self.__states.get(encoded_state)
+        if state_position is None:
+            state_position = self.__states[encoded_state] = len(self.__states)
+        missing = self.MISSING
+        return (self.DOCUMENT, self.__encode_class(document_type), state_position,
+                *[self.__encode(data[field_name]) if field_name in data else missing
+                  for field_name in document_type._fields])
+
+    def __encode_class(self, value: type) -> int:
+        """
+        :return: the position of the class in the classes of the record
+        """
+        position = self.__classes.get(value)
+        if position is None:
+            position = self.__classes[value] = len(self.__class_records)
+            fields = getattr(value, '_fields', None)
+            self.__class_records.append((value.__module__, self.__qualname(value),
+                                         None if fields is None else tuple(fields)))
+        return position
+
+    @staticmethod
+    def __qualname(value: type) -> str:
+        return getattr(value, '__qualname__', value.__name__)
+
+    def __decode(self, value) -> Any:
+        if type(value) is not tuple:
+            return value
+        decoder = self.__decoders.get(value[0])
+        if decoder is None:
+            raise self.InvalidRecordError(f'Invalid tag {value[0]}')
+        return decoder(self, value)
+
+    def __decode_document(self, value: tuple):
+        document_type, field_names = self.__classes[value[1]]
+        document = document_type.__new__(document_type)
+        self.__documents.append(document)
+        data = {}
+        missing = self.MISSING
+        decode = self.__decode
+        for field_name, field_value in zip(field_names, value[3:]):
+            if type(field_value) is tuple:
+                if field_value == missing:
+                    continue
+                field_value = decode(field_value)
+            data[field_name] = field_value
+        state = self.__decode_state(value[2])
+        state['_data'] = data
+        document.__setstate__(state)
+        return document
+
+    def __decode_state(self, position: int) -> dict:
+        """
+        Documents share the records of equal states, e.g. the referrer roots of the documents in a camp.
+        States of immutable values and sets of them are decoded once and copied,
+        others are decoded for each document.
+        """
+        decoded = self.__states[position]
+        if decoded is None:
+            state = self.__decode(self.__state_records[position])
+            shared = all(type(value) in self.PRIMITIVE_TYPES or type(value) is set
+                         and all(type(item) in self.PRIMITIVE_TYPES or type(item) is tuple for item in value)
+                         for value in state.values())
+            decoded = self.__states[position] = (state, shared)
+            return state.copy()
+        state, shared = decoded
+        if not shared:
+            return self.__decode(self.__state_records[position])
+        return {name: value.copy() if type(value) is set else value for name, value in state.items()}
+
+    def __decode_date(self, value: tuple) -> date:
+        return date.fromordinal(value[1])
+
+    def __decode_enum(self, value: tuple) -> Enum:
+        enum_type = self.__classes[value[1]][0]
+        if type(value[2]) is int:
+            return list(enum_type)[value[2]]  # By position, written by earlier versions
+        return enum_type[value[2]]
+
+    def __decode_reference(self, value: tuple):
+        return self.__indexed_document_base.DeferredReference(value[1], value[2], self.__decode(value[3]))
+
+    def __decode_document_ref(self, value: tuple):
+        return self.__documents[value[1]]
+
+    def __decode_reference_set(self, value: tuple) -> ReferenceSet:
+        reference_set = ReferenceSet.__new__(ReferenceSet)
+        reference_set.__setstate__(self.__decode(value[1]))
+        return reference_set
+
+    def __decode_dict(self, value: tuple) -> dict:
+        items = [*map(self.__decode, value[1:])]
+        return dict(zip(items[0::2], items[1::2]))
+
+    def __decode_list(self, value: tuple) -> list:
+        return [*map(self.__decode, value[1:])]
+
+    def __decode_tuple(self, value: tuple) -> tuple:
+        return tuple(map(self.__decode, value[1:]))
+
+    def __decode_set(self, value: tuple) -> set:
+        return set(map(self.__decode, value[1:]))
+
+    def __decode_frozenset(self, value: tuple) -> frozenset:
+        return frozenset(map(self.__decode, value[1:]))
+
+    def __decode_class(self, value: tuple) -> type:
+        return self.__classes[value[1]][0]
+
+    def __decode_pickled(self, value: tuple):
+        return self.document_type.Unpickler(io.BytesIO(value[1])).load()
+
+    __decoders = {  # By tag, shared by all records
+        DOCUMENT: __decode_document,
+        DATE: __decode_date,
+        ENUM: __decode_enum,
+        REFERENCE: __decode_reference,
+        DOCUMENT_REF: __decode_document_ref,
+        REFERENCE_SET: __decode_reference_set,
+        DICT: __decode_dict,
+        LIST: __decode_list,
+        TUPLE: __decode_tuple,
+        SET: __decode_set,
+        FROZENSET: __decode_frozenset,
+        CLASS: __decode_class,
+        PICKLED: __decode_pickled,
+    }
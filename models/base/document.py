@@ -1,27 +1,154 @@
 from __future__ import annotations
 
+import atexit
+import logging
 import os
 import pickle
-import sys
-from typing import Union
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Union, Iterator, Iterable, TYPE_CHECKING
 
 from models.base.field import ReferenceDocumentsField, ReferenceSet
+from models.base.index import SortedIndex
+from models.base.storage import Storage, STORAGE_MODES
 from models.base.meta_document import MetaDocument, MetaIndexedDocument
 
+if TYPE_CHECKING:
+    from models.base.query import Query
+
+logger = logging.getLogger(__name__)
+
 
 def persist(func):
     """
     Decorator for saving the document after the function call.
+    Saves made during the function call are coalesced into the same transaction.
     """
 
     def wrapper_persist(*args, **kwargs):
         instance: Document = args[0]
-        func(*args, **kwargs)
-        instance.save()
+        with IndexedDocument.transaction():
+            func(*args, **kwargs)
+            instance.save()
 
     return wrapper_persist
 
 
+class ReferrerSet:
+    """
+    The documents referencing a document, with the names of the fields holding the reference.
+    Referrers are grouped by type and keyed by identity, so that adding, removing and finding referrers is O(1).
+    Referrers can be held with weak references, so that referrers which are no longer used elsewhere
+    can be garbage collected.
+    """
+
+    def __init__(self, weak: bool = False):
+        """
+        :param weak: whether to hold the referrers with weak references
+        """
+        self.__weak = weak
+        # {referrer type: {id(referrer): (referrer or weak reference to it, names of the referring fields)}}
+        self.__buckets: dict[type, dict[int, tuple[Union[Document, weakref.ref], set]]] = {}
+
+    def add(self, referrer: Document, field_name: str = None) -> bool:
+        """
+        Record a reference from the referrer.
+        :param field_name: the field of the referrer holding the reference, if known
+        :return: whether the reference was not recorded before
+        """
+        bucket = self.__buckets.setdefault(type(referrer), {})
+        entry = bucket.get(id(referrer))
+        if entry is None:
+            if self.__weak:
+                key = id(referrer)
+                entry = (weakref.ref(referrer, lambda _: bucket.pop(key, None)), set())
+            else:
+                entry = (referrer, set())
+            bucket[id(referrer)] = entry
+        if field_name in entry[1]:
+            return False
+        entry[1].add(field_name)
+        return True
+
+    def discard(self, referrer: Document, field_name: str = None) -> bool:
+        """
+        Remove a reference from the referrer, if recorded.
+        :param field_name: the field of the referrer no longer holding the reference.
+                           If not given, all references from the referrer are removed.
+        :return: whether a reference was removed
+        """
+        bucket = self.__buckets.get(type(referrer), {})
+        entry = bucket.get(id(referrer))
+        if entry is None:
+            return False
+        removed = field_name is None or field_name in entry[1]
+        entry[1].discard(field_name)
+        if field_name is None or not entry[1]:
+            del bucket[id(referrer)]
+            if not bucket:
+                del self.__buckets[type(referrer)]
+        return removed
+
+    def find(self, referrer_type: type = None, field_name: str = None) -> Iterator[Document]:
+        """
+        Iterate over the referrers matching the criteria.
+        :param referrer_type: optional type of the referrers, including subclasses
+        :param field_name: optional name of the field holding the reference
+        """
+        for bucket_type, bucket in list(self.__buckets.items()):
+            if referrer_type is not None and not issubclass(bucket_type, referrer_type):
+                continue
+            for entry in list(bucket.values()):
+                referrer = entry[0]() if self.__weak else entry[0]
+                if referrer is None:
+                    continue
+                if field_name is not None and field_name not in entry[1]:
+                    continue
+                yield referrer
+
+    def single(self) -> Union[None, tuple[Document, str]]:
+        """
+        Get the only referrer with the only field holding the reference, e.g. to find the path from a root-level
+        document to a document it embeds.
+        :return: (referrer, field name), or None if there is not exactly one referrer holding the reference
+                 in exactly one known field
+        """
+        if len(self.__buckets) != 1:
+            return None
+        bucket = next(iter(self.__buckets.values()))
+        if len(bucket) != 1:
+            return None
+        referrer, field_names = next(iter(bucket.values()))
+        referrer = referrer() if self.__weak else referrer
+        if referrer is None or len(field_names) != 1 or None in field_names:
+            return None
+        return referrer, next(iter(field_names))
+
+    def copy(self) -> ReferrerSet:
+        """
+        Copy the referrers and their fields, e.g. to restore them later.
+        """
+        copied = ReferrerSet(self.__weak)
+        for bucket in self.__buckets.values():
+            for referrer, field_names in list(bucket.values()):
+                referrer = referrer() if self.__weak else referrer
+                if referrer is not None:
+                    for field_name in field_names:
+                        copied.add(referrer, field_name)
+        return copied
+
+    def __iter__(self) -> Iterator[Document]:
+        return self.find()
+
+    def __contains__(self, referrer) -> bool:
+        return id(referrer) in self.__buckets.get(type(referrer), {})
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.__buckets.values())
+
+
 class Document(metaclass=MetaDocument):
     """
     Base class for all documents.
@@ -63,6 +190,19 @@ class Document(metaclass=MetaDocument):
     Deleting a document also automatically removes all references to it.
     """
     _initialised = False
+    _weak_referrers = False  # Hold referrers with weak references, so that detached referrers can be collected.
+    _global_index = False  # Index referenced documents of this class by primary key, see find_embedded.
+    __roots = threading.local()  # Root-level documents cached by _caching_roots, per thread
+    # Root-level documents whose referrers changed since they were last saved: {id(document): document}
+    __referrers_changed: dict[int, Document] = {}
+    # States of the documents changed in the current transaction before their first change, with the states of
+    # their reference sets: {id(document): (document, state, {id(reference set): (reference set, state)})}.
+    # None outside of a transaction, see IndexedDocument.transaction.
+    __snapshots: Union[None, dict[int, tuple[Document, dict, dict[int, tuple[ReferenceSet, tuple]]]]] = None
+    __referrers_changed_snapshot: Union[None, dict[int, Document]] = None
+    # Held while documents change, by each change and by transactions until they end, and while IndexedDocument
+    # loads or writes documents, so that the write-behind thread never encodes documents while they change
+    _changes_lock = threading.RLock()
 
     class PrimaryKeyNotDefinedError(Exception):
         def __init__(self, document):
@@ -85,6 +225,14 @@ class Document(metaclass=MetaDocument):
         def __init__(self, message):
             super().__init__(message)
 
+    class GlobalIndexNotDefinedError(Exception):
+        def __init__(self, document_type):
+            super().__init__(f"Global index not defined for {document_type.__name__}")
+
+    class FieldNotIndexedError(Exception):
+        def __init__(self, document_type, field_name):
+            super().__init__(f"Field {field_name} of {document_type.__name__} is not indexed")
+
     @persist
     def __init__(self, **kwargs):
         """
@@ -98,47 +246,55 @@ class Document(metaclass=MetaDocument):
                 raise self.PrimaryKeyNotSetError(field_name)
             self.__setattr__(field_name, kwargs.get(field_name))
         self._initialised = True
-        self._referenced_by: list[Document] = []
+        self._referenced_by = ReferrerSet(self._weak_referrers)
+        self._owners: dict[ReferenceDocumentsField, Document] = {}  # Parent pointers of single-owner fields
 
     def save(self) -> None:
         """
         Save all documents associated with this document.
+        The root-level documents among the associated documents are grouped by index,
+        so that each affected index is persisted once.
         """
-        self._persist()
-        self._save_referrers()  # Recursively look for root level documents and save them.
-        self._save_referees()  # Also save all documents that this document references.
-
-    def _persist(self) -> None:
-        """
-        By default, documents are not persisted. To be overridden by subclasses.
+        changed: dict[type, dict[int, IndexedDocument]] = {}
+        associated = self._find_associated_documents()
+        for document in associated:
+            Document.__referrers_changed.pop(id(document), None)
+        for document in associated:
+            if isinstance(document, IndexedDocument):
+                changed.setdefault(document._storage_class, {})[id(document)] = document
+        for index, documents in changed.items():
+            index._persist(*documents.values())
+
+    def _find_associated_documents(self) -> list[Document]:
         """
-        return
-
-    def _save_referrers(self) -> None:
+        Find the documents affected by a change of this document without recursion:
+        this document, its referrers up to the root-level documents, and the root-level documents whose referrers
+        changed since they were last saved, so that they record their new referrers.
+        Referees are not walked, so that saving a change does not depend on the size of the referenced documents.
+        Root-level documents referenced by a document without a root-level document yet are left for a later save.
         """
-        Recursively call save on the root-level document
-        """
-        for referrer in self._referenced_by:
-            referrer._persist()
-            referrer._save_referrers()
-
-    def _save_referees(self) -> None:
-        """
-        Recursively save all referees.
-        """
-        for field_name, field in self._fields.items():
-            if isinstance(field, ReferenceDocumentsField):
-                for referee in getattr(self, field_name):
-                    referee._persist()
-                    referee._save_referees()
+        associated = {id(self): self}
+        # Walk up the referrers to reach the root-level documents
+        visited, stack = {id(self)}, [self]
+        while stack:
+            for referrer in stack.pop()._referenced_by:
+                if id(referrer) not in visited:
+                    visited.add(id(referrer))
+                    associated[id(referrer)] = referrer
+                    stack.append(referrer)
+        for key, document in list(Document.__referrers_changed.items()):
+            if all(referrer._get_root_document() is not None for referrer in document._referenced_by):
+                associated[key] = document
+        return list(associated.values())
 
     def delete(self) -> None:
         """
         Remove all references to this document and persist the change.
         """
-        for referrer in list(self._referenced_by):  # copy with list() to avoid issues with removing items
-            referrer.__unlink_referee(self)
-            referrer.save()
+        with IndexedDocument.transaction():
+            for referrer in list(self._referenced_by):  # copy with list() to avoid issues with removing items
+                referrer.__unlink_referee(self)
+                referrer.save()
 
     @property
     def key(self):
@@ -155,26 +311,276 @@ class Document(metaclass=MetaDocument):
         :param field_name: optional field name of the referrer where the instance is referred as a criteria
         :return: the first referrer matching the criteria
         """
-        for referrer in self._referenced_by:
-            if referrer_type is not None and not isinstance(referrer, referrer_type):
-                continue
-            if field_name is not None and not self in getattr(referrer, field_name):
-                continue
-            return referrer
-        raise self.ReferrerNotFound(referrer_type, field_name)
+        referrer = next(self._referenced_by.find(referrer_type, field_name), None)
+        if referrer is None:
+            raise self.ReferrerNotFound(referrer_type, field_name)
+        return referrer
+
+    @classmethod
+    def find_embedded(cls, key) -> Union[None, Document]:
+        """
+        Find a document of this class referenced by any other document, by its primary key, in O(1).
+        Only supported by classes setting _global_index = True and defining a primary key.
+        Documents are indexed while they are referenced, so the root-level documents embedding them must be loaded.
+        GlobalIndexNotDefinedError is raised if the class is not globally indexed.
+        :param key: the primary key value
+        :return: the document, or None if not found
+        """
+        if not cls._global_index or not cls._primary_key:
+            raise cls.GlobalIndexNotDefinedError(cls)
+        return cls._embedded_index.get(key)
+
+    @classmethod
+    def find_by(cls, **criteria) -> list[Document]:
+        """
+        Find documents of this class by the values of indexed fields. For example:
+
+            Volunteer.find_by(phone='+447519953189')
+
+        Root-level documents are indexed while they are in the index of their class,
+        and embedded documents while they are referenced by another document. The indexes of the root-level
+        documents that may embed documents of this class are loaded first, see _load_embedding_indexes.
+        FieldNotIndexedError is raised if a field is not declared with index=True.
+        :param criteria: field names and values, all of which must match
+        :return: the matching documents
+        """
+        cls._load_embedding_indexes()
+        for field_name in criteria:
+            if field_name not in cls._field_indexes:
+                raise cls.FieldNotIndexedError(cls, field_name)
+        if not criteria:
+            return []
+        # Start from the most selective index and check the remaining criteria on its documents
+        field_name = min(criteria, key=lambda name: cls._field_indexes[name].count(criteria[name]))
+        return [document for document in cls._field_indexes[field_name].find(criteria[field_name])
+                if all(getattr(document, name) == value for name, value in criteria.items())]
+
+    @classmethod
+    def query(cls) -> Query:
+        """
+        Start a query over the documents of this class. For example:
+
+            Refugee.query().where(lastname='Bond', starting_date__gte=date(2022, 1, 1)).within(plan)
+
+        See the Query class for the supported criteria.
+        """
+        from models.base.query import Query
+        cls._load_embedding_indexes()
+        return Query(cls)
+
+    @classmethod
+    def find_range(cls, field_name: str, low=None, high=None,
+                   include_low: bool = True, include_high: bool = False) -> Iterator[Document]:
+        """
+        Iterate over the documents of this class with values of a field between low and high, in the order of values.
+        For example, refugees registered in the last 7 days:
+
+            Refugee.find_range('starting_date', low=date.today() - timedelta(days=7))
+
+        Documents are indexed as for find_by, and documents with a None value are not included.
+        FieldNotIndexedError is raised if the field is not declared with index='sorted'.
+        :param field_name: name of the field
+        :param low: lower bound, or None for no lower bound
+        :param high: upper bound, or None for no upper bound
+        :param include_low: whether documents with a value equal to low are included
+        :param include_high: whether documents with a value equal to high are included
+        """
+        index = cls._field_indexes.get(field_name)
+        if not isinstance(index, SortedIndex):
+            raise cls.FieldNotIndexedError(cls, field_name)
+        cls._load_embedding_indexes()
+        return index.range(low, high, include_low, include_high)
+
+    @classmethod
+    def _load_embedding_indexes(cls) -> None:
+        """
+        Load the documents of the indexes that may embed documents of this class, so that all embedded documents
+        are indexed, e.g. all plans before searching refugees. These are the IndexedDocument classes with
+        a reference field declared with this class, with a class embedding it, or without a data type.
+        Root-level documents in the archive tier are left out, as by IndexedDocument.all.
+        """
+        loaded = set()
+        indexes = IndexedDocument.__subclasses__()
+        while indexes:
+            index = indexes.pop()
+            indexes.extend(index.__subclasses__())
+            if index._storage_class not in loaded and index.__embeds(cls):
+                loaded.add(index._storage_class)
+                index.load_all()
+
+    @classmethod
+    def __embeds(cls, document_type: type) -> bool:
+        """
+        Check whether documents of this class may embed documents of another class, through reference fields.
+        """
+        visited, stack = {cls}, [cls]
+        while stack:
+            for field in stack.pop()._fields.values():
+                if not isinstance(field, ReferenceDocumentsField):
+                    continue
+                data_type = field._data_type
+                if data_type is None or issubclass(data_type, document_type):
+                    return True
+                if not issubclass(data_type, IndexedDocument) and data_type not in visited:
+                    visited.add(data_type)
+                    stack.append(data_type)
+        return False
+
+    @classmethod
+    def _check_unique_fields(cls, values: dict, document: Document = None) -> None:
+        """
+        Check that a document with the field values can be indexed in this class without breaking unique constraints.
+        DuplicateKeyError is raised otherwise.
+        :param values: field values by field name
+        :param document: the document to be checked, if it may already be indexed
+        """
+        for field_name, index in cls._field_indexes.items():
+            index.check(values.get(field_name), document)
+
+    @classmethod
+    def _index_fields(cls, document: Document) -> None:
+        """
+        Add a document to the field indexes of this class.
+        """
+        cls._check_unique_fields(document._data, document)
+        for field_name, index in cls._field_indexes.items():
+            index.add(document, document._data.get(field_name))
+
+    @classmethod
+    def _unindex_fields(cls, document: Document) -> None:
+        """
+        Remove a document from the field indexes of this class.
+        """
+        for index in cls._field_indexes.values():
+            index.remove(document)
+
+    def _update_field_indexes(self, field_name: str, value) -> None:
+        """
+        Update the indexes holding this document for a new value of the field.
+        DuplicateKeyError is raised, and no index is updated, if the value breaks a unique constraint.
+        """
+        indexes = [index_class._field_indexes[field_name] for index_class in type(self).__mro__
+                   if field_name in vars(index_class).get('_field_indexes', {})
+                   and self in index_class._field_indexes[field_name]]
+        for index in indexes:
+            index.check(value, self)
+        for index in indexes:
+            index.add(self, value)
+
+    def _check_attach(self) -> None:
+        """
+        Check that this document can be referenced by another document without breaking unique constraints.
+        """
+        if len(self._referenced_by) == 0:
+            type(self)._check_unique_fields(self._data, self)
+
+    def _attach(self) -> None:
+        """
+        Index this document once it is referenced by another document.
+        """
+        type(self)._index_fields(self)
+        type(self)._attached_documents[id(self)] = self
+        if self._global_index:
+            self._embedded_index[self.key] = self
+
+    def _detach(self) -> None:
+        """
+        Remove this document from indexes once it is no longer referenced.
+        """
+        self._snapshot()  # Indexed again if the transaction is rolled back
+        type(self)._unindex_fields(self)
+        type(self)._attached_documents.pop(id(self), None)
+        if self._global_index and self._embedded_index.get(self.key) is self:
+            del self._embedded_index[self.key]
+
+    def find_owner(self, field: ReferenceDocumentsField) -> Document:
+        """
+        Find the document referencing this document through a single-owner reference field in O(1).
+        ReferrerNotFound exception is raised if this document is not referenced through the field.
+        :param field: a ReferenceDocumentsField declared with single_owner=True, e.g. Camp.refugees
+        :return: the owner
+        """
+        owner = self._owners.get(field)
+        if isinstance(owner, weakref.ref):
+            owner = owner()
+        if owner is None:
+            raise self.ReferrerNotFound(attribute_name=field.name)
+        return owner
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
         return self._data == other._data
 
-    def _add_referrer(self, referrer):
-        if referrer not in self._referenced_by:
-            self._referenced_by.append(referrer)
+    def _add_referrer(self, referrer, field_name: str = None, loaded: bool = False):
+        """
+        :param loaded: whether the reference was loaded with the referrer, as already recorded by this document
+        """
+        if loaded:
+            self.__snapshot_loaded_referrer(referrer, field_name)
+        else:
+            self._snapshot()
+        attached = len(self._referenced_by) > 0
+        added = self._referenced_by.add(referrer, field_name)
+        if not attached:
+            self._attach()
+        field = referrer._fields.get(field_name)
+        if getattr(field, 'single_owner', False):
+            self._owners[field] = weakref.ref(referrer) if self._weak_referrers else referrer
+        if added:
+            if not loaded:
+                referrer._snapshot()
+            referrer._referee_added(field_name, self)
+            if not loaded and isinstance(self, IndexedDocument):
+                Document.__referrers_changed[id(self)] = self
+                self._record_change()
+            elif not loaded and len(self._referenced_by) > 1:
+                self.__record_referrers_changed()
+
+    def _remove_referrer(self, referrer, field_name: str = None):
+        self._snapshot()
+        if self._referenced_by.discard(referrer, field_name):
+            referrer._snapshot()
+            referrer._referee_removed(field_name, self)
+            if isinstance(self, IndexedDocument):
+                Document.__referrers_changed[id(self)] = self
+                self._record_change()
+            elif len(self._referenced_by) > 0:
+                self.__record_referrers_changed()
+        field = referrer._fields.get(field_name)
+        if field in self._owners and self.find_owner(field) is referrer:
+            # Fall back to another referrer of the same type still holding this document in the field
+            other = next(self._referenced_by.find(type(referrer), field_name), None)
+            if other is None:
+                del self._owners[field]
+            else:
+                self._owners[field] = weakref.ref(other) if self._weak_referrers else other
+        if len(self._referenced_by) == 0:
+            self._detach()
 
-    def _remove_referrer(self, referrer):
-        if referrer in self._referenced_by:
-            self._referenced_by.remove(referrer)
+    def _referee_added(self, field_name: str, document: Document) -> None:
+        """
+        Called when a document is added to a reference field of this document.
+        Override to maintain aggregates over the referenced documents.
+        """
+
+    def _referee_removed(self, field_name: str, document: Document) -> None:
+        """
+        Called when a document is removed from a reference field of this document.
+        """
+
+    def _referee_changed(self, document: Document, field_name: str, old_value, new_value) -> None:
+        """
+        Called when a field of a document referenced by this document is set to a new value.
+        """
+
+    def _field_changed(self, field_name: str, old_value, new_value) -> None:
+        """
+        Notify the referrers that a field of this document was set.
+        """
+        for referrer in self._referenced_by:
+            referrer._snapshot()
+            referrer._referee_changed(self, field_name, old_value, new_value)
 
     def __unlink_referee(self, referee):
         for field_name, field in self._fields.items():
@@ -188,10 +594,175 @@ class Document(metaclass=MetaDocument):
         """
         Get the root-level document.
         """
+        cache = getattr(Document.__roots, 'cache', None)
+        if cache is not None and id(self) in cache:
+            return cache[id(self)]
+        root = None
         for referrer in self._referenced_by:
             root = referrer._get_root_document()
             if root is not None:
-                return root
+                break
+        if cache is not None:
+            cache[id(self)] = root
+        return root
+
+    @staticmethod
+    @contextmanager
+    def _caching_roots() -> Iterator[None]:
+        """
+        Cache the root-level documents found by _get_root_document in this thread, e.g. while an index is pickled,
+        so that the referrers of each document are walked once instead of once per referenced document.
+        The references to the roots pickled by __getstate__ are cached too.
+        Referrers must not be changed in this thread meanwhile. Nested calls use the cache of the outermost one.
+        """
+        if getattr(Document.__roots, 'cache', None) is not None:
+            yield
+            return
+        Document.__roots.cache = {}
+        Document.__roots.references = {}
+        try:
+            yield
+        finally:
+            Document.__roots.cache = None
+            Document.__roots.references = None
+
+    def _snapshot(self) -> None:
+        """
+        Record the state of this document before its first change in the current transaction, so that it can be
+        restored in place if the transaction is rolled back, see _restore_snapshots.
+        Called before changing the fields, references or referrers of the document.
+        """
+        snapshots = Document.__snapshots
+        if snapshots is None or id(self) in snapshots or not self._initialised:
+            return
+        state = self.__dict__.copy()
+        state['_data'] = dict(self._data)
+        state['_referenced_by'] = self._referenced_by.copy()
+        state['_owners'] = dict(self._owners)
+        references = {id(value): (value, value._snapshot()) for value in self._data.values()
+                      if isinstance(value, ReferenceSet)}
+        snapshots[id(self)] = (self, state, references)
+
+    def _record_reference_change(self, references: ReferenceSet, slot, previous: Union[None, Document]) -> None:
+        """
+        Record the document in a slot of a reference set of this document before the slot changes in the current
+        transaction, so that the change is undone if the transaction is rolled back, see ReferenceSet._rollback.
+        Called after _snapshot. Reference sets assigned since the snapshot are restored with the fields instead.
+        :param references: the reference set, held by a field of this document
+        :param slot: the key of the slot in the reference set
+        :param previous: the document in the slot, or None if the slot is empty
+        """
+        snapshot = (Document.__snapshots or {}).get(id(self))
+        recorded = snapshot and snapshot[2].get(id(references))
+        if recorded:
+            recorded[1][1].append((slot, previous))
+
+    def _record_change(self, operation: str = None, field_name: str = None, value=None) -> None:
+        """
+        Record a change to this document with its root-level document, once the change is made, so that storages
+        writing changes instead of whole documents can write it, see IndexedDocument._unwritten_changes.
+        The change is recorded with the path from the root-level document, by the field and primary key of each
+        embedded document. Changes that cannot be replayed by path, e.g. to a document embedded in more than one
+        place or without a primary key, require the root-level document to be written in full.
+        :param operation: 'set' when the field was set to the value, 'add' when the documents of the value,
+                          {slot: document}, were added to the reference set of the field, 'remove' when the slot
+                          given as the value was removed from it, or None when the root-level document has to be
+                          written in full
+        """
+        if not self._initialised:
+            return
+        path = []
+        document = self
+        while operation is not None and not isinstance(document, IndexedDocument):
+            parent = document._referenced_by.single()
+            if parent is None or document._primary_key is None:
+                operation = None
+            else:
+                path.append((parent[1], document.key))
+                document = parent[0]
+        if operation == 'set' and isinstance(value, (Document, ReferenceSet)) \
+                or operation == 'add' and not Document.__embedded_once(value.values()):
+            operation = None
+        if operation is None:
+            document = self._get_root_document()
+            if document is not None:
+                document._record_mutation(None)
+        else:
+            document._record_mutation((tuple(reversed(path)), operation, field_name, value))
+
+    @staticmethod
+    def __embedded_once(documents: Iterable[Document]) -> bool:
+        """
+        Check whether documents added to a reference set, and the documents they embed, are only embedded there,
+        so that adding them can be recorded as a change, see _record_change.
+        Root-level documents are written as references to them.
+        """
+        stack = list(documents)
+        while stack:
+            document = stack.pop()
+            if isinstance(document, IndexedDocument):
+                continue
+            if len(document._referenced_by) != 1:
+                return False
+            for field_name in document._reference_fields:
+                stack.extend(document._data.get(field_name) or ())
+        return True
+
+    def __record_referrers_changed(self) -> None:
+        """
+        Require the root-level documents of the referrers of this document to be written in full when the referrers
+        of a document embedded in more than one place change, as each copy records the roots of its referrers.
+        """
+        for referrer in self._referenced_by:
+            referrer._record_change()
+
+    def __snapshot_loaded_referrer(self, referrer: Document, field_name: str) -> None:
+        """
+        Add a referrer loaded in the current transaction to the recorded state of this document, if any,
+        so that the reference is kept if the transaction is rolled back.
+        """
+        snapshot = (Document.__snapshots or {}).get(id(self))
+        if snapshot is None:
+            return
+        state = snapshot[1]
+        state['_referenced_by'].add(referrer, field_name)
+        field = referrer._fields.get(field_name)
+        if getattr(field, 'single_owner', False):
+            state['_owners'][field] = weakref.ref(referrer) if self._weak_referrers else referrer
+
+    @staticmethod
+    def _start_snapshots() -> None:
+        """
+        Start recording the state of each document before its first change, see _snapshot.
+        """
+        Document.__snapshots = {}
+        Document.__referrers_changed_snapshot = dict(Document.__referrers_changed)
+
+    @staticmethod
+    def _discard_snapshots() -> None:
+        """
+        Stop recording the state of changed documents, once the changes are kept.
+        """
+        Document.__snapshots = None
+        Document.__referrers_changed_snapshot = None
+
+    @staticmethod
+    def _restore_snapshots() -> list[Document]:
+        """
+        Restore the documents changed since _start_snapshots in place, as they were before their first change,
+        and stop recording. Field indexes are not updated.
+        :return: the restored documents
+        """
+        snapshots, Document.__snapshots = Document.__snapshots, None
+        Document.__referrers_changed.clear()
+        Document.__referrers_changed.update(Document.__referrers_changed_snapshot)
+        Document.__referrers_changed_snapshot = None
+        for document, state, references in snapshots.values():
+            document.__dict__.clear()
+            document.__dict__.update(state)
+            for reference_set, reference_state in references.values():
+                reference_set._rollback(reference_state)
+        return [document for document, _, _ in snapshots.values()]
 
     def __str__(self):
         return f'{self.__class__.__name__}({self._data})'
@@ -204,16 +775,30 @@ class Document(metaclass=MetaDocument):
         """
         state = self.__dict__.copy()
         referrer_roots = set()
+        references = getattr(Document.__roots, 'references', None)
         for referrer in self._referenced_by:
             root = referrer._get_root_document()
             if not root:
                 raise self.PersistenceError(f'Cannot save {repr(self)} because it is referenced by '
                                             f'{repr(referrer)} which does not have a persistent parent.')
-            referrer_roots.add((root.__module__, getattr(root.__class__, '__qualname__', root.__class__.__name__)))
+            reference = None if references is None else references.get(id(root))
+            if reference is None:
+                reference = (root.__module__, getattr(root.__class__, '__qualname__', root.__class__.__name__),
+                             root.key)
+                if references is not None:
+                    references[id(root)] = reference
+            referrer_roots.add(reference)
         state['_referrer_roots'] = referrer_roots
-        state['_referenced_by'] = []
+        del state['_referenced_by']
+        state.pop('_owners', None)
         return state
 
+    def __setstate__(self, state):
+        state.pop('_referenced_by', None)  # Saved by earlier versions
+        self.__dict__.update(state)
+        self._referenced_by = ReferrerSet(self._weak_referrers)
+        self._owners = {}
+
 
 class IndexedDocument(Document, metaclass=MetaIndexedDocument):
     """
@@ -224,25 +809,114 @@ class IndexedDocument(Document, metaclass=MetaIndexedDocument):
     Documents are persisted as the index to all documents in this class.
     The default persistence path is data/{classname}
     to change the path, override the _persistence_path property.
+    Subclasses of an IndexedDocument class are stored in the index of their top-most persisted parent class,
+    its _storage_class, e.g. volunteers and admins are stored with the users in data/User. The index of each class
+    is a view of the shared index: User.find finds volunteers and admins, while Volunteer.all only gets volunteers.
+    Documents of subclasses stored in their own files by earlier versions are moved to the shared storage
+    when they are first loaded.
+
+    Storage modes are selected with the _storage_mode attribute, see models.base.storage:
+    - 'snapshot' (default): the whole index is rewritten to data/{classname} on every change.
+    - 'log': the changes to each changed document are appended as a record to data/{classname}.log.
+      The log is replayed on top of the last snapshot when the index is loaded, and folded into a new snapshot
+      once its size reaches _log_compaction_ratio times the size of the snapshot and _log_compaction_min_size bytes,
+      or by compact().
+    - 'paged': documents are loaded lazily. Loading the index only reads a table of the stored keys,
+      and each document is loaded when it is first found, together with the documents it references.
+      Finding documents by anything but their key loads the whole index.
+    - 'partitioned': documents are loaded lazily as in 'paged' mode, and each document has its own file,
+      with a log of the changes to it since the file was written, folded in as in 'log' mode.
+      Documents can also be moved to a compressed archive tier with archive(). Archived documents are only
+      loaded when found by key or requested with include_archived, and all() leaves them out by default.
+    - 'sqlite': documents are loaded lazily as in 'partitioned' mode, from a row per document in an SQLite database.
+      Indexed fields are also stored in indexed columns, so that find_by and unique checks only load
+      the matching documents.
+    - 'memory': documents are pickled in memory instead of files, for example to run tests without file I/O.
+    Only the 'partitioned', 'sqlite' and 'memory' modes have an archive tier: in the others, archive() leaves
+    documents in place.
+    The storage mode of all indexes can be replaced, for the whole process with the EMS_STORAGE_MODE environment
+    variable, or for example for a test case with override_storage_mode.
+    Documents are encoded by the fields of their classes with models.base.codec.DocumentCodec when _document_codec
+    is 'binary' (default), or pickled when it is 'pickle'. Documents written with either codec can be read.
+    With the binary codec, the 'log' and 'partitioned' modes only write the changes to a loaded document:
+    fields set, and documents added to or removed from reference sets, see Document._record_change.
+    Values changed in place without setting their field are only written with the whole document, e.g. when it is
+    next written in full.
+    Files are replaced atomically, so an interrupted write leaves either the previous or the new state.
+    The _durability attribute selects when writes are flushed to the disk with fsync:
+    'none' (default), 'commit' once per save or transaction, or 'write' after every appended record.
+
+    Changes are written when saved, unless write-behind is enabled by setting _write_behind_delay to a number of
+    seconds. Saving then only marks the index as changed, and a background thread writes it once no changes were
+    made for _write_behind_delay seconds, and at the latest _write_behind_max_delay seconds after the first
+    unwritten change. flush() writes the changes immediately, and is also called when the interpreter exits.
+    Changes that fail to be written in the background are logged and retried after the delay, or by flush(),
+    which raises PersistenceError if they fail again.
+    The background thread holds the lock of document changes while it writes, so documents only change between
+    writes, and transactions hold it until they end. A change is always saved again after it is made,
+    so the last write has the latest state.
     """
 
+    _storage_mode = 'snapshot'
+    _storage_mode_override: Union[None, str] = os.environ.get('EMS_STORAGE_MODE') or None
+    _log_compaction_threshold = 1000
+    _log_compaction_ratio = 1.0
+    _log_compaction_min_size = 65536
+    _document_codec = 'binary'
+    _durability = 'none'
+    _write_behind_delay: Union[None, float] = None
+    _write_behind_max_delay = 5.0
+
     __objects = None
     __data_loaded = None
+    __storage: Storage = None
+    __unloaded: set = None  # Keys of stored documents not loaded yet, with lazy storage
+    # Classes of the stored documents by key, as listed by the storage when the index was loaded
+    __stored_classes: dict = None
+    __archived: set = None  # Keys of documents in the archive tier
+    __deleted: set = None  # Keys of documents deleted from the index and not written yet
+    # Changes waiting for the outermost transaction to end: {index: {id(document): document}}.
+    # None as the documents of an index requests a full snapshot. None outside of a transaction.
+    __pending: Union[None, dict[type, Union[None, dict[int, IndexedDocument]]]] = None
+    # Entries of the indexes before their first change in the current transaction, to restore them on rollback:
+    # {(index, key): (loaded document or None, whether archived, whether deleted)}. None outside of a transaction.
+    __index_changes: Union[None, dict[tuple[type, object], tuple[Union[None, IndexedDocument], bool, bool]]] = None
+    # Changes to loaded documents not written yet, for storages writing changes, see _unwritten_changes:
+    # {id(document): (document, changes, or None if the document has to be written in full)}
+    __mutations: dict[int, tuple[IndexedDocument, Union[None, list[tuple]]]] = {}
+    # Documents to move to the archive tier once the outermost transaction is written: {id(document): document}
+    __pending_archives: dict[int, IndexedDocument] = {}
+    # Changes waiting to be written behind: {index: (documents as in __pending, time of the first change,
+    # time of the last change)}. Guarded by __write_behind_condition.
+    __write_behind: dict[type, tuple[Union[None, dict[int, IndexedDocument]], float, float]] = {}
+    __write_behind_condition = threading.Condition()
+    __write_behind_thread: threading.Thread = None
+    # Held while accessing storage, which is not safe to use from both threads at once.
+    # The lock of document changes, so that the documents written do not change meanwhile
+    __storage_lock = Document._changes_lock
 
     class Pickler(pickle.Pickler):
         """
         Custom pickler to persist references to other IndexedDocuments.
         """
 
-        def __init__(self, file, base_class):
+        def __init__(self, file, base_class, root=None):
+            """
+            :param file: file to write to
+            :param base_class: class of the index being pickled
+            :param root: the only document to be pickled in full when writing a single log record.
+                         If not given, all documents stored in the index of base_class are pickled in full.
+            """
             super().__init__(file)
             self.base_class = base_class
+            self.root = root
 
         def persistent_id(self, obj):
-            if not type(obj) == self.base_class and isinstance(obj, IndexedDocument):
-                return obj.__module__, getattr(obj.__class__, '__qualname__', obj.__class__.__name__), obj.key
-            else:
+            if not isinstance(obj, IndexedDocument):
+                return None
+            if obj._storage_class is self.base_class and (self.root is None or obj is self.root):
                 return None
+            return obj.__module__, getattr(obj.__class__, '__qualname__', obj.__class__.__name__), obj.key
 
     class Unpickler(pickle.Unpickler):
         """
@@ -268,9 +942,24 @@ class IndexedDocument(Document, metaclass=MetaIndexedDocument):
             """
             Restore the referenced document.
             """
-            __import__(self.module)
-            index = pickle._getattribute(sys.modules[self.module], self.classname)[0]
-            return index.find(self.key)
+            return MetaDocument.find_class(self.module, self.classname).find(self.key)
+
+        @staticmethod
+        def restore_all(references: list[IndexedDocument.DeferredReference]) -> list[IndexedDocument]:
+            """
+            Restore the documents referenced by deferred references, grouped by the class of the referenced documents
+            so that each class is found and its index loaded once.
+            :return: the referenced documents, in the order of the references
+            """
+            keys_by_index: dict[tuple[str, str], list] = {}
+            for reference in references:
+                keys_by_index.setdefault((reference.module, reference.classname), []).append(reference.key)
+            documents = {}
+            for (module, classname), keys in keys_by_index.items():
+                index = MetaDocument.find_class(module, classname)
+                index.check_and_load_data()
+                documents[module, classname] = {key: index.find(key) for key in keys}
+            return [documents[reference.module, reference.classname][reference.key] for reference in references]
 
     @persist
     def __init__(self, **kwargs):
@@ -278,111 +967,700 @@ class IndexedDocument(Document, metaclass=MetaIndexedDocument):
         if not self._primary_key:
             raise Document.PrimaryKeyNotDefinedError(self)
         key_value = kwargs.get(self._primary_key)
-        if self.__class__.find(key_value) is not None:
+        if self._storage_class.find(key_value) is not None:
             raise Document.DuplicateKeyError(self._primary_key, key_value)
+        index_classes = self.__class__.__index_classes()
+        for index_class in index_classes:
+            index_class.__load_for_unique_check(kwargs)
+            index_class._check_unique_fields(kwargs)
         super().__init__(**kwargs)
+        self.__class__.__record_index_change(self.key)
         self.__class__.__objects[self.key] = self
-
-        # Also save to parent indices
-        for persistence_base in self._persistence_bases:
-            persistence_base.__index_subclass_add(self)
-            persistence_base._persist()
+        for index_class in index_classes:
+            index_class._index_fields(self)
+        self._record_mutation(None)
 
     @classmethod
     def reload(cls) -> None:
         """
         Reload the index from disk.
+        In log mode, the log is replayed on top of the last snapshot.
+        With lazy storage, only the keys of the stored documents are read.
+        Changes waiting to be written behind are written first.
+        A subclass reloads the index of its storage class, see IndexedDocument.
         """
-        try:
-            with open(cls._persistence_path, 'rb') as f:
-                cls.__objects = cls.Unpickler(f).load()
-                cls.__data_loaded = cls.__name__
-                for key in cls.__objects:
-                    # Restore deferred references to referees
-                    cls.__objects[key] = cls.__restore_reference(cls.__objects[key])
-                    # Load all indices referring to this document to relink referrers
-                    cls.__restore_referrer(cls.__objects[key])
-            # Mark as loaded with this class, so that subclasses will load their own data
-        except FileNotFoundError:
-            cls.__objects = {}
+        if cls._storage_class is not cls:
+            cls._storage_class.reload()
+            cls.__share_storage()
+            return
+        cls.__flush_indexes([cls])
+        with IndexedDocument.__storage_lock:
+            previous = cls.__dict__.get('_IndexedDocument__objects')
+            if previous:
+                cls.__detach_embedded(previous.values())
+            cls.__discard_mutations()
+            for index in cls._field_indexes.values():
+                index.clear()
+            cls.__storage = STORAGE_MODES[IndexedDocument._storage_mode_override or cls._storage_mode](cls)
+            cls.__objects = cls.__storage.load()
+            separate = {(document.module, document.classname) for document in cls.__objects.values()
+                        if isinstance(document, cls.DeferredReference)}
+            if separate:
+                # Subclass instances stored in their own files by earlier versions
+                for module, classname in separate:
+                    cls.__storage.merge(MetaDocument.find_class(module, classname)._separate_persistence_path,
+                                        cls.__objects)
+                cls.__objects = {key: document for key, document in cls.__objects.items()
+                                 if not isinstance(document, cls.DeferredReference)}
+            cls.__unloaded = set(cls.__storage.keys())
+            cls.__stored_classes = cls.__storage.stored_classes()
+            cls.__archived = set(cls.__storage.archived_keys())
+            cls.__deleted = set()
+            # Mark as loaded with this class, so that subclasses share the loaded data when they are next used
             cls.__data_loaded = cls.__name__
+            cls.__unshare_storage()
+            for document in list(cls.__objects.values()):
+                # Restore deferred references to referees
+                cls.__restore_reference(document)
+                # Load all indices referring to this document to relink referrers
+                cls.__restore_referrer(document)
+            for field_name, index in cls._field_indexes.items():
+                for document in cls.__objects.values():
+                    index.add(document, document._data.get(field_name))
 
     @classmethod
-    def __restore_reference(cls, value):
+    def __share_storage(cls) -> None:
         """
-        Restore deferred references to other IndexedDocuments recursively.
-        :param value: a DeferredReference, Document, ReferenceSet, or field value
-        :return: the restored value, or None if it was a field value
+        Use the loaded index of the storage class of this subclass, and index the documents of this class
+        in the field indexes of this class.
         """
-        if isinstance(value, cls.DeferredReference):
-            return value.restore()
-        elif isinstance(value, Document):
-            for field_name, field in value._fields.items():
-                restored_field = cls.__restore_reference(getattr(value, field_name))
-                if restored_field is not None:
-                    setattr(value, field_name, restored_field)
-            return value
-        elif isinstance(value, ReferenceSet):
-            return [cls.__restore_reference(doc) for doc in value]
-        else:
-            return None
+        storage_class = cls._storage_class
+        cls.__storage, cls.__objects = storage_class.__storage, storage_class.__objects
+        cls.__unloaded, cls.__archived = storage_class.__unloaded, storage_class.__archived
+        cls.__stored_classes = storage_class.__stored_classes
+        cls.__deleted = storage_class.__deleted
+        cls.__data_loaded = cls.__name__
+        for field_name, index in cls._field_indexes.items():
+            index.clear()
+            for document in cls.__objects.values():
+                if isinstance(document, cls):
+                    index.add(document, document._data.get(field_name))
+
+    @classmethod
+    def __unshare_storage(cls) -> None:
+        """
+        Mark the subclasses sharing the index of this class as not loaded once the index is replaced,
+        so that they share the new index when they are next used.
+        """
+        subclasses = cls.__subclasses__()
+        while subclasses:
+            subclass = subclasses.pop()
+            subclasses.extend(subclass.__subclasses__())
+            if subclass.__dict__.get('_IndexedDocument__data_loaded') is not None:
+                subclass.__data_loaded = None
+
+    @classmethod
+    def __index_classes(cls) -> list[type]:
+        """
+        Get the classes whose field indexes hold the documents of this class: this class and its parent classes
+        sharing its storage.
+        """
+        return [index_class for index_class in cls.__mro__
+                if getattr(index_class, '_storage_class', None) is cls._storage_class]
+
+    @classmethod
+    def __detach_embedded(cls, roots: Iterable[IndexedDocument]) -> None:
+        """
+        Remove the embedded documents of root-level documents leaving the index from global and field indexes.
+        """
+        visited, stack = set(), list(roots)
+        while stack:
+            document = stack.pop()
+            for field_name in document._reference_fields:
+                for referee in document._data.get(field_name) or ():
+                    if not isinstance(referee, IndexedDocument) and id(referee) not in visited:
+                        visited.add(id(referee))
+                        referee._detach()
+                        stack.append(referee)
+
+    @classmethod
+    def __restore_reference(cls, document: IndexedDocument) -> None:
+        """
+        Restore the references of a loaded root-level document and the documents it embeds in place:
+        deferred references to other IndexedDocuments are restored, and referenced documents are linked to their
+        referrers. Only reference fields are visited, without recursion.
+        :param document: a loaded IndexedDocument instance
+        """
+        visited, stack = {id(document)}, [document]
+        while stack:
+            referrer = stack.pop()
+            for field_name in referrer._reference_fields:
+                references = referrer._data.get(field_name)
+                if not isinstance(references, ReferenceSet):
+                    continue
+                replaced = False
+                for referee in references:
+                    if isinstance(referee, cls.DeferredReference):
+                        replaced = True
+                    elif isinstance(referee, IndexedDocument):
+                        # An embedded copy of a document replaced by a later log record
+                        replaced = replaced or cls.__objects.get(referee.key, referee) is not referee
+                    elif id(referee) not in visited:
+                        visited.add(id(referee))
+                        stack.append(referee)
+                references._restore(referrer, field_name, cls.__restored_referees(references) if replaced else None)
+
+    @classmethod
+    def __restored_referees(cls, references: ReferenceSet) -> list[Document]:
+        """
+        Get the documents referenced by a loaded reference set, with deferred references restored in one batch
+        and embedded copies of documents of this index replaced by the loaded documents.
+        """
+        referees = list(references)
+        deferred = iter(cls.DeferredReference.restore_all(
+            [referee for referee in referees if isinstance(referee, cls.DeferredReference)]))
+        return [next(deferred) if isinstance(referee, cls.DeferredReference)
+                else cls.__objects.get(referee.key, referee) if isinstance(referee, IndexedDocument)
+                else referee for referee in referees]
+
+    @classmethod
+    def __load_document(cls, key) -> Union[None, IndexedDocument]:
+        """
+        Load a document from lazy storage, with the documents it references and the root-level documents
+        referring to it.
+        """
+        with IndexedDocument.__storage_lock:
+            cls.__unloaded.discard(key)
+            document = cls.__storage.load_document(key)
+            if isinstance(document, cls.DeferredReference):
+                # A subclass instance stored in its own files by earlier versions
+                subclass = MetaDocument.find_class(document.module, document.classname)
+                return cls.__merge_separate_storage(subclass).get(key)
+            if document is not None:
+                # Indexed before restoring references, so that references back to it find it
+                cls.__objects[key] = document
+                cls.__restore_reference(document)
+                cls.__restore_referrer(document)
+                cls.__index_loaded(document)
+            return document
+
+    @classmethod
+    def __merge_separate_storage(cls, subclass: type) -> dict:
+        """
+        Move the documents of a subclass stored in their own files by earlier versions to the shared storage,
+        as loaded documents.
+        :return: the moved documents by key
+        """
+        with IndexedDocument.__storage_lock:
+            documents = cls.__storage.merge(subclass._separate_persistence_path, cls.__objects)
+            cls.__unloaded.difference_update(documents)
+            for document in documents.values():
+                cls.__restore_reference(document)
+                cls.__restore_referrer(document)
+                cls.__index_loaded(document)
+            return documents
+
+    @staticmethod
+    def __index_loaded(document: IndexedDocument) -> None:
+        """
+        Add a loaded document to the field indexes of the classes sharing the storage of its class.
+        """
+        for index_class in type(document).__index_classes():
+            for field_name, index in index_class._field_indexes.items():
+                index.add(document, document._data.get(field_name))
+
+    @classmethod
+    def load_all(cls, include_archived: bool = False) -> None:
+        """
+        Load all documents of the index, if it has lazy storage.
+        For example, to index all embedded documents for Document.find_embedded.
+        A subclass sharing the storage of its parent class only loads the documents stored with its own classes,
+        and those stored without their class.
+        :param include_archived: whether to also load the documents in the archive tier
+        """
+        cls.check_and_load_data()
+        for key in list(cls.__unloaded):
+            if key in cls.__unloaded and (include_archived or key not in cls.__archived) and cls.__may_store(key):
+                cls.__load_document(key)
+
+    @classmethod
+    def __may_store(cls, key) -> bool:
+        """
+        Check whether a stored document not loaded yet may be an instance of this class, by its stored class.
+        """
+        stored_class = cls.__stored_classes.get(key)
+        return (cls._storage_class is cls or stored_class is None
+                or issubclass(MetaDocument.find_class(*stored_class), cls))
+
+    def archive(self) -> None:
+        """
+        Move the document to the archive tier of the index, see IndexedDocument.
+        The document stays loaded, and later changes to it are written to the archive.
+        With storage modes without an archive tier, the document stays in the index as it is.
+        Inside a transaction, the document is moved once the changes of the transaction are written,
+        and stays where it was if the transaction is rolled back.
+        """
+        if not self.has_archive_tier():
+            return
+        if IndexedDocument.__pending is not None:
+            self.__record_index_change(self.key)
+            self.__class__.__archived.add(self.key)
+            IndexedDocument.__pending_archives[id(self)] = self
+            return
+        self.__archive_stored()
+
+    def __archive_stored(self) -> None:
+        """
+        Move the document to the archive tier of the storage, see archive.
+        """
+        with IndexedDocument.__storage_lock, Document._caching_roots():
+            self.__class__.__storage.archive(self)
+        self.__class__.__archived.add(self.key)
+
+    @classmethod
+    def has_archive_tier(cls) -> bool:
+        """
+        Check whether the storage mode of the index has an archive tier, see archive.
+        """
+        cls.check_and_load_data()
+        return cls.__storage.archiving
+
+    @classmethod
+    def archived_keys(cls) -> list:
+        """
+        Get the keys of the documents in the archive tier, without loading them.
+        For a subclass sharing the storage of its parent class, the archived documents that may be its own are loaded
+        to find them, see load_all.
+        """
+        cls.check_and_load_data()
+        if cls._storage_class is not cls:
+            return [key for key in list(cls.__archived) if cls.__may_store(key) and cls.find(key) is not None]
+        return list(cls.__archived)
+
+    @classmethod
+    def find_embedded_archived(cls, embedded_type: type, key) -> Union[None, Document]:
+        """
+        Find a globally indexed document embedded in a document of this index by its primary key,
+        including in the documents of the archive tier, see Document.find_embedded.
+        Archived documents not loaded yet are read one at a time to search them, and only the one embedding
+        the document is loaded, so that searching for a missing key does not load the archive.
+        :param embedded_type: the class of the embedded document, e.g. Refugee in Plan
+        :param key: the primary key value
+        :return: the document, or None if not found
+        """
+        cls.load_all()
+        found = embedded_type.find_embedded(key)
+        if found is not None:
+            return found
+        for archived_key in list(cls.__archived):
+            if archived_key not in cls.__unloaded or not cls.__may_store(archived_key):
+                continue
+            with IndexedDocument.__storage_lock:
+                stored = cls.__storage.read_document(archived_key)
+            if cls.__embeds(stored, embedded_type, key):
+                cls.find(archived_key)
+                return embedded_type.find_embedded(key)
+        return None
+
+    @staticmethod
+    def __embeds(document: Document, embedded_type: type, key) -> bool:
+        """
+        Check whether a document read from storage embeds a document of a class by its primary key.
+        """
+        stack, visited = [document], set()
+        while stack:
+            current = stack.pop()
+            if not isinstance(current, Document) or id(current) in visited:
+                continue  # Including deferred references to the documents of other indexes
+            visited.add(id(current))
+            if isinstance(current, embedded_type) and current.key == key:
+                return True
+            for value in current._data.values():
+                if isinstance(value, ReferenceSet):
+                    stack.extend(value)
+        return False
+
+    @classmethod
+    def __load_for_unique_check(cls, values: dict) -> None:
+        """
+        Load the documents of the index that unique fields have to be checked against.
+        :param values: field values by field name
+        """
+        for field_name, index in cls._field_indexes.items():
+            if index.unique:
+                cls.__load_matching({field_name: values.get(field_name)})
+
+    @classmethod
+    def __load_matching(cls, criteria: dict) -> None:
+        """
+        Load the stored documents that may match criteria on indexed fields,
+        or all documents if the storage cannot search by the criteria.
+        """
+        cls.check_and_load_data()
+        with IndexedDocument.__storage_lock:
+            keys = cls.__storage.find_keys(criteria)
+        if keys is None:
+            cls.load_all()
+            return
+        for key in keys:
+            if key in cls.__unloaded:
+                cls.__load_document(key)
 
     @classmethod
     def __restore_referrer(cls, obj) -> None:
         """
-        Load all indices referring to this document to relink referrers.
+        Load the root-level documents referring to this document to relink referrers.
+        Referrer roots saved by earlier versions only name the class, and the whole index of the class is loaded.
         :param obj: an unpickled IndexedDocument instance
         """
         if getattr(obj, '_referrer_roots', None):
-            for mod, classname in obj._referrer_roots:
-                __import__(mod)
-                index = pickle._getattribute(sys.modules[mod], classname)[0]
-                index.check_and_load_data()
+            keyed_roots = []
+            for root in obj._referrer_roots:
+                if len(root) > 2:
+                    keyed_roots.append(cls.DeferredReference(*root))
+                else:
+                    MetaDocument.find_class(*root).load_all()
+            cls.DeferredReference.restore_all(keyed_roots)
             delattr(obj, '_referrer_roots')
 
+    @staticmethod
+    def override_storage_mode(mode: Union[None, str]) -> Union[None, str]:
+        """
+        Replace the storage mode of all indexes, see IndexedDocument. For example, in a test case:
+
+            def setUp(self):
+                self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode('memory'))
+
+        Changes waiting to be written behind are written first. Loaded indexes are then discarded,
+        and loaded from the new storage when next used.
+        :param mode: the storage mode, or None for the storage mode of each index
+        :return: the replaced storage mode, to restore it
+        """
+        previous = IndexedDocument._storage_mode_override
+        if mode == previous:
+            return previous
+        IndexedDocument.flush()
+        IndexedDocument._storage_mode_override = mode
+        indexes = IndexedDocument.__subclasses__()
+        while indexes:
+            index = indexes.pop()
+            indexes.extend(index.__subclasses__())
+            if index.__dict__.get('_IndexedDocument__data_loaded') is not None:
+                index.__data_loaded = None
+        return previous
+
     @classmethod
     def check_and_load_data(cls):
         """
         Check if the index of the current class is loaded, if not, load it.
+        A subclass shares the index of its storage class once it is loaded, see IndexedDocument.
         """
         if cls.__data_loaded != cls.__name__:
-            cls.reload()
+            if cls._storage_class is cls:
+                cls.reload()
+            else:
+                cls._storage_class.check_and_load_data()
+                cls.__share_storage()
 
     @classmethod
-    def _persist(cls) -> None:
+    @contextmanager
+    def transaction(cls) -> Iterator[None]:
         """
-        Save all documents of the same type (i.e. the index) to disk.
-        If the class is a subclass of IndexedDocument, also persist to parent indices.
+        Group changes so that each affected index is written to disk once, when the outermost transaction ends.
+        Nested transactions join the outermost one.
+        If an exception is raised, nothing is written: the changed documents are restored in place as they were
+        before the transaction, so that documents held by the caller stay in their indexes, and the exception
+        is re-raised. For example:
+
+            with IndexedDocument.transaction():
+                old_camp.volunteers.remove(volunteer)
+                new_camp.volunteers.add(volunteer)
+
+        The lock of document changes is held until the transaction ends, so that changes are never written behind
+        half applied.
         """
-        cls.check_and_load_data()
-        os.makedirs(os.path.dirname(cls._persistence_path), exist_ok=True)
-        with open(cls._persistence_path, 'wb') as f:
-            cls.Pickler(f, cls).dump(cls.__objects)
+        if IndexedDocument.__pending is not None:
+            yield
+            return
+        with Document._changes_lock:
+            IndexedDocument.__pending = {}
+            IndexedDocument.__index_changes = {}
+            Document._start_snapshots()
+            try:
+                yield
+            except BaseException:
+                IndexedDocument.__pending = None
+                IndexedDocument.__pending_archives = {}
+                IndexedDocument.__rollback()
+                raise
+            pending, IndexedDocument.__pending = IndexedDocument.__pending, None
+            archives, IndexedDocument.__pending_archives = IndexedDocument.__pending_archives, {}
+            IndexedDocument.__index_changes = None
+            Document._discard_snapshots()
+            for index, documents in pending.items():
+                if documents is None:
+                    index._persist()
+                else:
+                    index._persist(*documents.values())
+            for document in archives.values():
+                if document._storage_class.__objects.get(document.key) is document:  # Unless deleted since
+                    document.__archive_stored()
 
-    def _get_root_document(self):
-        return self
+    @classmethod
+    def __record_index_change(cls, key) -> None:
+        """
+        Record the entry of a key in the index before its first change in the current transaction, see __rollback.
+        """
+        changes = IndexedDocument.__index_changes
+        index = cls._storage_class
+        if changes is not None and (index, key) not in changes:
+            changes[index, key] = (index.__objects.get(key), key in index.__archived, key in index.__deleted)
+
+    @staticmethod
+    def __rollback() -> None:
+        """
+        Restore the documents and index entries changed in the current transaction in place,
+        and index the restored documents again.
+        """
+        changes, IndexedDocument.__index_changes = IndexedDocument.__index_changes, None
+        documents = {id(document): document for document in Document._restore_snapshots()}
+        # The recorded changes cannot be told apart from the rolled back ones, so the documents are written in full
+        for key, (document, _) in list(IndexedDocument.__mutations.items()):
+            if (document._storage_class.__objects or {}).get(document.key) is document:
+                IndexedDocument.__mutations[key] = (document, None)
+            else:
+                del IndexedDocument.__mutations[key]
+        for (index, key), (previous, archived, deleted) in changes.items():
+            for document in (index.__objects.get(key), previous):
+                if document is not None:
+                    documents[id(document)] = document
+            if previous is None:
+                index.__objects.pop(key, None)
+            else:
+                index.__objects[key] = previous
+            (index.__archived.add if archived else index.__archived.discard)(key)
+            (index.__deleted.add if deleted else index.__deleted.discard)(key)
+        # Removed from all indexes first, so that unique fields are checked against the restored values
+        for document in documents.values():
+            if isinstance(document, IndexedDocument):
+                for index_class in type(document).__index_classes():
+                    index_class._unindex_fields(document)
+            else:
+                document._detach()
+        for document in documents.values():
+            root = document._get_root_document()
+            if root is None or (root._storage_class.__objects or {}).get(root.key) is not root:
+                continue  # No longer referenced, or by a document no longer loaded
+            if isinstance(document, IndexedDocument):
+                IndexedDocument.__index_loaded(document)
+            else:
+                document._attach()
 
     @classmethod
-    def __index_subclass_add(cls, child: Document) -> None:
+    def _persist(cls, *documents: IndexedDocument) -> None:
         """
-        Save a subclass instance to the index of the parent (this) class.
-        To be called from the __init__ method of a subclass of another IndexedDocument,
-        such as to replace instances in the index of the parent class with instances of the subclass.
-        :param child: child instance to be added
+        Save changes to the index of this class to disk.
+        In snapshot mode, all documents of the same type (i.e. the index) are written.
+        In log mode, only the changed documents are appended to the log.
+        Inside a transaction, the changes are only recorded and written when the transaction ends.
+        With write-behind, the changes are recorded and written by the background thread.
+        :param documents: the changed documents. If not given, a new snapshot is written in both modes.
         """
+        if cls._storage_class is not cls:
+            cls._storage_class._persist(*documents)
+            return
         cls.check_and_load_data()
-        cls.__objects[child.key] = child
+        pending = IndexedDocument.__pending
+        if pending is not None:
+            if not documents:
+                pending[cls] = None
+            elif pending.setdefault(cls, {}) is not None:
+                pending[cls].update((id(document), document) for document in documents)
+            return
+        if cls._write_behind_delay is not None:
+            cls.__write_later(documents)
+            return
+        with IndexedDocument.__storage_lock, Document._caching_roots():
+            cls.__write(documents)
 
+    @classmethod
+    def __write_later(cls, documents: tuple[IndexedDocument, ...], first_change: float = None) -> None:
+        """
+        Record changes to be written by the background thread, starting it if needed.
+        :param first_change: the time of the first change, if earlier than now
+        """
+        now = time.monotonic()
+        with IndexedDocument.__write_behind_condition:
+            changed, since, _ = IndexedDocument.__write_behind.get(cls, ({}, now, now))
+            if first_change is not None:
+                since = min(since, first_change)
+            if not documents:
+                changed = None
+            elif changed is not None:
+                changed.update((id(document), document) for document in documents)
+            IndexedDocument.__write_behind[cls] = (changed, since, now)
+            if IndexedDocument.__write_behind_thread is None:
+                IndexedDocument.__write_behind_thread = threading.Thread(
+                    target=IndexedDocument.__write_behind_loop, name='write-behind', daemon=True)
+                IndexedDocument.__write_behind_thread.start()
+                atexit.register(IndexedDocument.flush)
+            IndexedDocument.__write_behind_condition.notify()
+
+    @staticmethod
+    def __write_behind_loop() -> None:
+        """
+        Write the changes of each index once it is due, see IndexedDocument.
+        Changes that fail to be written are logged, and retried after the delay.
+        """
+        condition = IndexedDocument.__write_behind_condition
+        while True:
+            with condition:
+                while True:
+                    now = time.monotonic()
+                    due_times = {index: min(last_change + index._write_behind_delay,
+                                            first_change + index._write_behind_max_delay)
+                                 for index, (_, first_change, last_change) in IndexedDocument.__write_behind.items()}
+                    due = [index for index, due_time in due_times.items() if due_time <= now]
+                    if due:
+                        break
+                    condition.wait(min(due_times.values()) - now if due_times else None)
+            try:
+                IndexedDocument.__flush_indexes(due)
+            except Exception:  # Recorded again by __flush_indexes
+                logger.exception('Writing changes behind failed, retrying after the delay')
 
     @classmethod
-    def __index_subclass_remove(cls, child: Document) -> None:
+    def flush(cls) -> None:
         """
-        Remove a subclass instance from the index of the parent (this) class.
-        To be called from the delete method of a subclass of another IndexedDocument,
-        :param child: child instance to be deleted
+        Write all changes waiting to be written behind to disk, see IndexedDocument.
+        For example, before returning from an action that must not be lost if the application stops.
+        Changes that failed to be written in the background are written again.
+        PersistenceError is raised if writing fails, and the changes are then retried in the background.
         """
+        try:
+            cls.__flush_indexes()
+        except Exception as e:
+            raise cls.PersistenceError(f'Writing changes behind failed: {e}') from e
+
+    @staticmethod
+    def __flush_indexes(indexes: Iterable[type] = None) -> None:
+        """
+        Write the changes waiting to be written behind.
+        If writing an index fails, its changes are recorded again, the other indexes are still written,
+        and the first exception is then raised.
+        :param indexes: the indexes to write, all of them by default
+        """
+        error = None
+        with IndexedDocument.__storage_lock, Document._caching_roots():
+            with IndexedDocument.__write_behind_condition:
+                waiting = IndexedDocument.__write_behind
+                if indexes is None:
+                    indexes = list(waiting)
+                changes = {index: waiting.pop(index) for index in indexes if index in waiting}
+            for index, (documents, first_change, _) in changes.items():
+                try:
+                    index.__write(() if documents is None else tuple(documents.values()))
+                except BaseException as e:
+                    index.__write_later(() if documents is None else tuple(documents.values()), first_change)
+                    error = error or e
+        if error is not None:
+            raise error
+
+    @classmethod
+    def compact(cls) -> None:
+        """
+        Write all documents of the same type (i.e. the index) to disk as a new snapshot and clear the log.
+        With lazy storage, documents that have not been loaded are copied as they are.
+        """
+        if cls._storage_class is not cls:
+            cls._storage_class.compact()
+            return
         cls.check_and_load_data()
-        del cls.__objects[child.key]
+        with IndexedDocument.__storage_lock, Document._caching_roots():
+            with IndexedDocument.__write_behind_condition:
+                IndexedDocument.__write_behind.pop(cls, None)  # Written with the snapshot
+            cls.__write(())
+
+    @classmethod
+    def __write(cls, documents: tuple[IndexedDocument, ...]) -> None:
+        """
+        Write changed documents to the storage, or all of them if none are given, with the storage lock held.
+        """
+        if documents:
+            cls.__storage.save(cls.__objects, documents, cls.__deleted)
+            cls.__deleted.difference_update(document.key for document in documents)
+            for document in documents:
+                IndexedDocument.__mutations.pop(id(document), None)
+        else:
+            cls.__storage.compact(cls.__objects)
+            cls.__deleted.clear()
+            cls.__discard_mutations()
+
+    def _record_mutation(self, mutation: Union[None, tuple]) -> None:
+        """
+        Record a change to this document or to a document it embeds, if the storage of the index writes changes,
+        see Document._record_change.
+        :param mutation: (path, operation, field name, value), or None if the document has to be written in full
+        """
+        storage = self._storage_class.__storage
+        if storage is None or not storage.patches:
+            return
+        recorded = IndexedDocument.__mutations.get(id(self))
+        if recorded is not None and recorded[0] is not self:
+            recorded = None  # Recorded for a collected document with the same id
+        if mutation is None:
+            IndexedDocument.__mutations[id(self)] = (self, None)
+        elif recorded is None:
+            IndexedDocument.__mutations[id(self)] = (self, [mutation])
+        elif recorded[1] is not None:
+            recorded[1].append(mutation)
+
+    @staticmethod
+    def _unwritten_changes(document: IndexedDocument) -> Union[None, list[tuple]]:
+        """
+        Get the changes to a loaded document since it was last written, for storages writing changes instead of
+        whole documents, see Storage.patches.
+        Each change is (path, operation, field name, value), see Document._record_change. Applied in order to the
+        document as last written, they give the document as it is.
+        :return: the changes, or None if the document has to be written in full, e.g. as it was never written
+        """
+        recorded = IndexedDocument.__mutations.get(id(document))
+        return recorded[1] if recorded is not None and recorded[0] is document else None
+
+    @classmethod
+    def __discard_mutations(cls) -> None:
+        """
+        Discard the changes recorded for the documents of this index, once they are no longer loaded.
+        """
+        for key, (document, _) in list(IndexedDocument.__mutations.items()):
+            if document._storage_class is cls:
+                del IndexedDocument.__mutations[key]
+
+    def __getstate__(self):
+        """
+        Keep the referrer roots of a document whose referrers have not been relinked yet, such as a document
+        copied as unpickled when migrating its index, which would otherwise be written without them.
+        """
+        state = super().__getstate__()
+        if '_referrer_roots' in self.__dict__:
+            state['_referrer_roots'] = state['_referrer_roots'] | set(self.__dict__['_referrer_roots'])
+        return state
+
+    def _get_root_document(self):
+        return self
+
+    def _check_attach(self) -> None:
+        return  # Root-level documents are indexed with the index of their class
+
+    def _attach(self) -> None:
+        return
+
+    def _detach(self) -> None:
+        return
+
+    @classmethod
+    def _load_embedding_indexes(cls) -> None:
+        return  # Root-level documents are indexed with the index of their class, loaded when searched
 
     @classmethod
     def find(cls, key) -> Union[None, IndexedDocument]:
@@ -392,43 +1670,87 @@ class IndexedDocument(Document, metaclass=MetaIndexedDocument):
         :return: the document, or None if not found
         """
         cls.check_and_load_data()
-        return cls.__objects.get(key)
+        document = cls.__objects.get(key)
+        if document is None and key in cls.__unloaded:
+            document = cls.__load_document(key)
+        return document if isinstance(document, cls) else None
+
+    @classmethod
+    def query(cls) -> Query:
+        cls.load_all()
+        return super().query()
 
     @classmethod
-    def all(cls) -> list[IndexedDocument]:
+    def find_by(cls, **criteria) -> list[IndexedDocument]:
+        cls.__load_matching(criteria)
+        return super().find_by(**criteria)
+
+    @classmethod
+    def find_range(cls, field_name: str, low=None, high=None,
+                   include_low: bool = True, include_high: bool = False) -> Iterator[IndexedDocument]:
+        cls.load_all()
+        return super().find_range(field_name, low, high, include_low, include_high)
+
+    @classmethod
+    def all(cls, include_archived: bool = False) -> list[IndexedDocument]:
         """
         Get all documents of this type.
+        :param include_archived: whether to include the documents in the archive tier, loading them if needed
         :return: a list of all documents
         """
-        cls.check_and_load_data()
-        return list(cls.__objects.values())
+        cls.load_all(include_archived)
+        if include_archived or not cls.__archived:
+            documents = list(cls.__objects.values())
+        else:
+            documents = [document for key, document in cls.__objects.items() if key not in cls.__archived]
+        if cls._storage_class is not cls:
+            return [document for document in documents if isinstance(document, cls)]
+        return documents
 
     def delete(self) -> None:
         """
         Remove the document from the index, all references to it, and persist the change.
         """
         self.__class__.check_and_load_data()
-        del self.__class__.__objects[self.key]
-        self._persist()
-        # Also save to parent indices
-        for persistence_base in self._persistence_bases:
-            persistence_base.__index_subclass_remove(self)
-            persistence_base._persist()
-        super().delete()
+        with self.transaction():
+            self.__class__.__record_index_change(self.key)
+            del self.__class__.__objects[self.key]
+            self.__class__.__archived.discard(self.key)
+            self.__class__.__deleted.add(self.key)
+            for index_class in self.__class__.__index_classes():
+                index_class._unindex_fields(self)
+            self.__detach_embedded([self])
+            self._persist(self)
+            super().delete()
 
     @classmethod
     def delete_all(cls) -> None:
         """
         Remove all documents of this type and persist the change.
+        For a subclass, only its own documents are removed from the storage shared with its parent classes.
         """
-        cls.check_and_load_data()
-        for document in cls.all():
-            super().delete(document)
-        try:
-            os.remove(cls._persistence_path)
-        except FileNotFoundError:
-            pass
-        cls.__objects = {}
+        if cls._storage_class is not cls:
+            with cls.transaction():
+                for document in cls.all(include_archived=True):
+                    document.delete()
+            return
+        with IndexedDocument.__storage_lock:
+            documents = cls.all(include_archived=True)
+            cls.__detach_embedded(documents)
+            for index in cls._field_indexes.values():
+                index.clear()
+            for document in documents:
+                super().delete(document)
+            with IndexedDocument.__write_behind_condition:
+                IndexedDocument.__write_behind.pop(cls, None)
+            cls.__storage.clear()
+            cls.__discard_mutations()
+            cls.__objects = {}
+            cls.__unloaded = set()
+            cls.__stored_classes = {}
+            cls.__archived = set()
+            cls.__deleted = set()
+            cls.__unshare_storage()
 
     def __str__(self):
         return f'{self.__class__.__name__}({self._primary_key}={self.key})'
@@ -13,6 +13,8 @@ class Field:
     """
     name = None  # Set by Document.__new__()
     primary_key = False
+    index = False
+    unique = False
 
     class PrimaryKeyMutationError(Exception):
         def __init__(self):
@@ -22,12 +24,19 @@ class Field:
         def __init__(self, value):
             super().__init__(f"Invalid value {value}")
 
-    def __init__(self, primary_key=False):
+    def __init__(self, primary_key=False, index: Union[bool, str] = False, unique=False):
         """
         Declare a data attribute.
         :param primary_key: whether this attribute is a primary key. Only one primary key per class is allowed.
+        :param index: whether to maintain an index of this attribute, to find documents with Document.find_by.
+                      True for a hash index, requiring hashable values.
+                      'sorted' for a sorted index, requiring comparable values, which also supports
+                      range queries with Document.find_range.
+        :param unique: whether values of this attribute must be unique among the indexed documents. Implies index.
         """
         self.primary_key = primary_key
+        self.index = index or unique
+        self.unique = unique
 
     def __get__(self, instance, owner):
         if instance is None:
@@ -40,14 +49,26 @@ class Field:
         if self.primary_key and instance._initialised:
             raise self.PrimaryKeyMutationError()
         else:
-            instance._data[self.name] = value
+            if not instance._initialised:
+                instance._data[self.name] = value
+                return
+            with instance._changes_lock:
+                instance._snapshot()
+                if self.index:
+                    instance._update_field_indexes(self.name, value)
+                old_value = instance._data.get(self.name)
+                instance._data[self.name] = value
+                if old_value != value:
+                    instance._field_changed(self.name, old_value, value)
+                instance._record_change('set', self.name, value)
 
 
 class ReferenceSet:
     """
     A container for references to other documents.
     The class maintains a two-way binding between the referenced documents and the referencing documents.
-    Additionally, the references are automatically indexed if they have a primary key.
+    The references are stored in an insertion-ordered dict, keyed by the primary key of the referenced documents,
+    or by identity if they do not have a primary key, so that add, remove, get and membership checks are O(1).
     """
 
     class MultipleTypeError(Exception):
@@ -58,28 +79,59 @@ class ReferenceSet:
         def __init__(self):
             super().__init__('Operation not supported for references to documents without primary keys')
 
-    def __init__(self, references: Sequence[Document], data_type: Type[Document] = None, owner: Document = None):
-        self.__ref_documents: list[Document] = []  # Actual references
+    def __init__(self, references: Sequence[Document], data_type: Type[Document] = None, owner: Document = None,
+                 field_name: str = None):
+        # Actual references, keyed by primary key value, or by id() for documents without a primary key.
+        self.__ref_documents: dict[Any, Document] = {}
         self.data_type = data_type  # Type of the references, updated in the first add if not provided.
         # Primary key name of the referenced documents, updated in the first add if data_type not provided.
         self.__primary_key = self.data_type._primary_key if self.data_type else None
-        self.__index: dict[Any, Document] = {}  # Index of the references, if they have a primary key.
         self.__owner = owner  # The document that owns this reference set. Must be set before editing references.
+        self.__field_name = field_name  # The field of the owner holding this reference set.
         self.__add_references(*references)
 
-    def _with_owner(self, owner: Document) -> ReferenceSet:
+    def _with_owner(self, owner: Document, field_name: str = None, loaded: bool = False) -> ReferenceSet:
         """
         Update the owner of this reference set, so that references can be updated.
+        The owner is bound when the reference set is assigned to a field, including when an index is loaded.
+        :param owner: the document owning this reference set
+        :param field_name: the field of the owner holding this reference set
+        :param loaded: whether the references were loaded with the owner, so that the referenced documents
+                       already recorded it
         """
         self.__owner = owner
-        for document in self.__ref_documents:
+        self.__field_name = field_name
+        for document in self.__ref_documents.values():
             if getattr(document, '_add_referrer', None) is not None:
-                document._add_referrer(owner)
+                document._add_referrer(owner, field_name, loaded)
         return self
 
+    def __slot(self, document: Document) -> Any:
+        """
+        Get the dict key of a document in this reference set.
+        """
+        return getattr(document, self.__primary_key) if self.__primary_key else id(document)
+
+    def __find(self, item) -> Any:
+        """
+        Find the dict key of a referenced document equal to the item.
+        Documents without a primary key are looked up by identity first, then by equality.
+        :return: the dict key, or None if the item is not in the reference set
+        """
+        if self.data_type is None or not isinstance(item, self.data_type):
+            return None
+        if self.__primary_key:
+            key = getattr(item, self.__primary_key)
+            document = self.__ref_documents.get(key)
+            return key if document is not None and (document is item or document == item) else None
+        if id(item) in self.__ref_documents:
+            return id(item)
+        return next((slot for slot, document in self.__ref_documents.items() if document == item), None)
+
     def __add_references(self, *documents: Document) -> None:
         """
-        Add references to the reference set.
+        Add references to the reference set. Documents already in the reference set are ignored.
+        DuplicateKeyError is raised, and no reference is added, if another document with the same key exists.
         :param documents: Documents instances of the same type
         """
         if len(documents) == 0:
@@ -89,28 +141,46 @@ class ReferenceSet:
         if not self.data_type:  # set type if not set yet
             self.data_type = type(documents[0])
             self.__primary_key = self.data_type._primary_key
+        new_documents = {}
         for document in documents:
-            if document not in self.__ref_documents:
-                self.__ref_documents.append(document)
-            if self.__primary_key:
-                key_value = getattr(document, self.__primary_key)
-                if key_value in self.__index:
-                    from models.base.document import Document
-                    raise Document.DuplicateKeyError(self.__primary_key, key_value)
-                self.__index[key_value] = document
-        for reference in documents:
-            reference._add_referrer(self.__owner)
+            slot = self.__slot(document)
+            if self.__primary_key and (slot in self.__ref_documents or slot in new_documents):
+                from models.base.document import Document
+                raise Document.DuplicateKeyError(self.__primary_key, slot)
+            new_documents[slot] = document
+        if self.__owner is not None:
+            for document in new_documents.values():
+                document._check_attach()
+            self.__owner._snapshot()
+            for slot in new_documents:
+                self.__owner._record_reference_change(self, slot, None)
+        self.__ref_documents.update(new_documents)
+        if self.__owner is not None:  # otherwise bound when assigned to a field
+            for reference in new_documents.values():
+                reference._add_referrer(self.__owner, self.__field_name)
+            self.__record_change('add', new_documents)
+
+    def __record_change(self, operation: str, value) -> None:
+        """
+        Record a change to the slots of this reference set with its owner, see Document._record_change.
+        Slots keyed by identity cannot be found again once written, so the owner is then written in full.
+        """
+        if self.__primary_key:
+            self.__owner._record_change(operation, self.__field_name, value)
+        else:
+            self.__owner._record_change()
 
     def __iter__(self) -> Iterator[Document]:
-        return iter(self.__ref_documents)
+        return iter(self.__ref_documents.values())
 
     def add(self, *references) -> None:
         """
         Add documents to the reference set. Changes are automatically saved.
         :param references: documents of the same type
         """
-        self.__add_references(*references)
-        self.__owner.save()
+        with self.__owner._changes_lock:
+            self.__add_references(*references)
+            self.__owner.save()
 
     def remove(self, item) -> None:
         """
@@ -118,13 +188,18 @@ class ReferenceSet:
         A ValueError is raised if the item is not in the reference set.
         :param item: a document existing in the reference set
         """
-        if self.__primary_key:
-            self.__index.pop(item.key)
-        i = self.__ref_documents.index(item)
-        self.__ref_documents[i]._remove_referrer(self.__owner)
-        self.__ref_documents[i].save()
-        self.__ref_documents.remove(item)
-        self.__owner.save()
+        from models.base.document import IndexedDocument
+        slot = self.__find(item)
+        if slot is None:
+            raise ValueError(f'{item} is not in the reference set')
+        with IndexedDocument.transaction():
+            self.__owner._snapshot()
+            self.__owner._record_reference_change(self, slot, self.__ref_documents[slot])
+            document = self.__ref_documents.pop(slot)
+            document._remove_referrer(self.__owner, self.__field_name)
+            self.__record_change('remove', slot)
+            document.save()
+            self.__owner.save()
 
     def get(self, key) -> Union[Document, None]:
         """
@@ -135,66 +210,152 @@ class ReferenceSet:
         """
         if not self.__primary_key:
             raise self.UnindexedReferenceError()
-        return self.__index.get(key)
+        return self.__ref_documents.get(key)
 
     def __contains__(self, item):
-        return item in self.__ref_documents
+        return self.__find(item) is not None
 
     def __getitem__(self, item):
         if not self.__primary_key:
             raise self.UnindexedReferenceError()
-        return self.__index[item]
+        return self.__ref_documents[item]
 
     def __delitem__(self, key):
+        from models.base.document import IndexedDocument
         if not self.__primary_key:
             raise self.UnindexedReferenceError()
-        item = self.__index[key]
-        self.__ref_documents.remove(item)
-        del self.__index[key]
-        item._remove_referrer(self.__owner)
-        item.save()
-        self.__owner.save()
+        with IndexedDocument.transaction():
+            self.__owner._snapshot()
+            self.__owner._record_reference_change(self, key, self.__ref_documents[key])
+            item = self.__ref_documents.pop(key)
+            item._remove_referrer(self.__owner, self.__field_name)
+            self.__record_change('remove', key)
+            item.save()
+            self.__owner.save()
 
     def __len__(self):
         return len(self.__ref_documents)
 
     def __str__(self):
-        return f'{self.__class__.__name__}[{",".join([str(item) for item in self.__ref_documents])}]'
+        return f'{self.__class__.__name__}[{",".join([str(item) for item in self.__ref_documents.values()])}]'
+
+    def __setstate__(self, state):
+        """
+        Convert reference sets pickled by earlier versions, which stored the references in a list.
+        """
+        references = state.get('_ReferenceSet__ref_documents')
+        if isinstance(references, list):
+            # Keyed by identity until the index restores its references
+            state.pop('_ReferenceSet__index', None)
+            state['_ReferenceSet__ref_documents'] = {id(document): document for document in references}
+            state['_ReferenceSet__rekey'] = True
+        self.__dict__.update(state)
+
+    def _snapshot(self) -> tuple[dict, list[tuple[Any, Union[Document, None]]]]:
+        """
+        Get the state of this reference set, to restore it with _rollback, see Document._snapshot.
+        The references are not copied: the owner records each slot before it changes in the undo log of the state,
+        see Document._record_reference_change, so that taking the state does not depend on the number of references.
+        :return: the attributes of this reference set, and the undo log of (slot, previous document or None)
+        """
+        return self.__dict__.copy(), []
+
+    def _rollback(self, state: tuple[dict, list[tuple[Any, Union[Document, None]]]]) -> None:
+        """
+        Restore the state of this reference set in place, as returned by _snapshot, undoing the recorded changes
+        to its slots in reverse order. Removed documents are restored at the end of the insertion order.
+        """
+        attributes, undo_log = state
+        references = attributes['_ReferenceSet__ref_documents']
+        for slot, previous in reversed(undo_log):
+            if previous is None:
+                references.pop(slot, None)
+            else:
+                references[slot] = previous
+        self.__dict__.clear()
+        self.__dict__.update(attributes)
+
+    def _loaded(self, slot) -> Union[Document, None]:
+        """
+        Get a document of a loaded reference set by its primary key, before the set is bound to its owner,
+        e.g. to replay a recorded change to it, see Document._record_change.
+        """
+        self.__rekey_loaded()
+        return self.__ref_documents.get(slot)
+
+    def _load_change(self, slot, document: Union[Document, None]) -> None:
+        """
+        Replay a recorded change to a slot of a loaded reference set, before it is bound to its owner,
+        see Document._record_change.
+        :param slot: the primary key of the document in the slot
+        :param document: the loaded document added to the slot, or None if it was removed
+        """
+        self.__rekey_loaded()
+        if document is None:
+            self.__ref_documents.pop(slot, None)
+        else:
+            self.__ref_documents[slot] = document
+
+    def __rekey_loaded(self) -> None:
+        """
+        Key the references of a reference set pickled by earlier versions by primary key, see __setstate__,
+        including deferred references to other indexes.
+        """
+        if self.__dict__.pop('_ReferenceSet__rekey', False) and self.__primary_key:
+            self.__ref_documents = {document.key: document for document in self.__ref_documents.values()}
+
+    def _restore(self, owner: Document, field_name: str, documents: list[Document] = None) -> None:
+        """
+        Bind a loaded reference set to its owner in place, as when it is assigned to the field of the owner.
+        :param owner: the document owning this reference set
+        :param field_name: the field of the owner holding this reference set
+        :param documents: the referenced documents, replacing the loaded references in the same order,
+                          e.g. to resolve deferred references to other indexes. None drops a reference.
+        """
+        if documents is not None or self.__dict__.pop('_ReferenceSet__rekey', False):
+            self.__ref_documents = {self.__slot(document): document
+                                    for document in (self.__ref_documents.values() if documents is None else documents)
+                                    if document is not None}
+        self._with_owner(owner, field_name, loaded=True)
 
 
 class ReferenceDocumentsField(Field):
     """
     A field that references a set of documents.
     This field maintains a two-way binding between the owner and the referenced documents.
+    The binding is established when the field is assigned, so reading the field does not depend on its size.
     """
 
-    def __init__(self, data_type: Type[Document] = None, **kwargs):
+    def __init__(self, data_type: Type[Document] = None, single_owner: bool = False, **kwargs):
         """
         :param data_type: the type of the referenced documents
+        :param single_owner: whether a document is referenced by at most one owner through this field.
+                             The owner is then kept as a parent pointer on the referenced documents,
+                             see Document.find_owner.
         """
         super().__init__(**kwargs)
         self._data_type = data_type
+        self.single_owner = single_owner
 
     def __set__(self, instance, value: Union[ReferenceSet, Sequence[Document]]):
-        if isinstance(value, ReferenceSet):
-            if value.data_type is None:
-                value.data_type = self._data_type
-            elif value.data_type != self._data_type:
-                raise ReferenceSet.MultipleTypeError
-            super().__set__(instance, value._with_owner(instance))
-        else:
-            value = value or []  # avoid TypeError when initialising document with optional reference field
-            try:
-                for doc in value:
-                    assert hasattr(doc, "_referenced_by")
-            except (TypeError, AssertionError):
-                raise self.InvalidValueError(value)
+        with instance._changes_lock:
             if instance._initialised:
-                for document in self.__get__(instance, instance.__class__):
-                    if getattr(document, "_referenced_by", None) is not None:
-                        document._remove_referrer(instance)  # Remove the old references
-            super().__set__(instance, ReferenceSet(value, self._data_type, instance))
-
-    def __get__(self, instance, owner):
-        obj = super().__get__(instance, owner)
-        return obj._with_owner(instance)
+                instance._snapshot()
+            if isinstance(value, ReferenceSet):
+                if value.data_type is None:
+                    value.data_type = self._data_type
+                elif value.data_type != self._data_type:
+                    raise ReferenceSet.MultipleTypeError
+                super().__set__(instance, value._with_owner(instance, self.name))
+            else:
+                value = value or []  # avoid TypeError when initialising document with optional reference field
+                try:
+                    for doc in value:
+                        assert hasattr(doc, "_referenced_by")
+                except (TypeError, AssertionError):
+                    raise self.InvalidValueError(value)
+                if instance._initialised:
+                    for document in self.__get__(instance, instance.__class__):
+                        if getattr(document, "_referenced_by", None) is not None:
+                            document._remove_referrer(instance, self.name)  # Remove the old references
+                super().__set__(instance, ReferenceSet(value, self._data_type, instance, self.name))
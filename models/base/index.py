@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import bisect
+import math
+from typing import Any, TYPE_CHECKING, Iterator
+
+if TYPE_CHECKING:
+    from models.base.document import Document
+
+
+class HashIndex:
+    """
+    A hash index from the values of a field to the documents having them.
+    Documents are keyed by identity, so that equal documents are indexed separately.
+    Indexed values must be hashable.
+    """
+
+    def __init__(self, field_name: str, unique: bool = False):
+        """
+        :param field_name: name of the indexed field
+        :param unique: whether two documents may not have the same value. None values are not checked.
+        """
+        self.field_name = field_name
+        self.unique = unique
+        self.__documents: dict[Any, dict[int, Document]] = {}  # {value: {id(document): document}}
+        self.__values: dict[int, Any] = {}  # {id(document): value}
+
+    def check(self, value, document: Document = None) -> None:
+        """
+        Check that a document can have the value without breaking the unique constraint.
+        DuplicateKeyError is raised otherwise.
+        :param value: the new value
+        :param document: the document to be updated, if already indexed
+        """
+        if not self.unique or value is None:
+            return
+        documents = self.__documents.get(value, {})
+        if len(documents) > (1 if document is not None and id(document) in documents else 0):
+            from models.base.document import Document
+            raise Document.DuplicateKeyError(self.field_name, value)
+
+    def add(self, document: Document, value) -> None:
+        """
+        Index a document with the value, replacing its previous value if it is already indexed.
+        """
+        self.remove(document)
+        self.__documents.setdefault(value, {})[id(document)] = document
+        self.__values[id(document)] = value
+
+    def remove(self, document: Document) -> None:
+        """
+        Remove a document from the index, if it is indexed.
+        """
+        if id(document) not in self.__values:
+            return
+        value = self.__values.pop(id(document))
+        documents = self.__documents[value]
+        del documents[id(document)]
+        if not documents:
+            del self.__documents[value]
+
+    def find(self, value) -> list[Document]:
+        """
+        Find the documents having the value.
+        """
+        return list(self.__documents.get(value, {}).values())
+
+    def count(self, value) -> int:
+        """
+        Count the documents having the value.
+        """
+        return len(self.__documents.get(value, {}))
+
+    def clear(self) -> None:
+        self.__documents = {}
+        self.__values = {}
+
+    def __contains__(self, document) -> bool:
+        return id(document) in self.__values
+
+    def __len__(self):
+        return len(self.__values)
+
+
+class SortedIndex:
+    """
+    A sorted index of the values of a field, supporting range queries in O(log n + k) for k results.
+    Entries are kept in a list sorted with bisect, with an insertion sequence number to order equal values,
+    so that adding and removing a document locates its entry in O(log n).
+    Documents with a None value are indexed separately and never returned by range queries.
+    Indexed values must be comparable with each other.
+    """
+
+    def __init__(self, field_name: str, unique: bool = False):
+        """
+        :param field_name: name of the indexed field
+        :param unique: whether two documents may not have the same value. None values are not checked.
+        """
+        self.field_name = field_name
+        self.unique = unique
+        self.__keys: list[tuple[Any, int]] = []  # sorted (value, sequence number)
+        self.__documents: list[Document] = []  # documents in the order of __keys
+        self.__entries: dict[int, tuple[Any, int]] = {}  # {id(document): (value, sequence number)}
+        self.__none: dict[int, Document] = {}  # {id(document): document} for documents with a None value
+        self.__sequence = 0
+
+    def check(self, value, document: Document = None) -> None:
+        """
+        Check that a document can have the value without breaking the unique constraint.
+        DuplicateKeyError is raised otherwise.
+        :param value: the new value
+        :param document: the document to be updated, if already indexed
+        """
+        if not self.unique or value is None:
+            return
+        existing = self.find(value)
+        if existing and not (len(existing) == 1 and existing[0] is document):
+            from models.base.document import Document
+            raise Document.DuplicateKeyError(self.field_name, value)
+
+    def add(self, document: Document, value) -> None:
+        """
+        Index a document with the value, replacing its previous value if it is already indexed.
+        """
+        self.remove(document)
+        self.__sequence += 1
+        entry = (value, self.__sequence)
+        self.__entries[id(document)] = entry
+        if value is None:
+            self.__none[id(document)] = document
+            return
+        i = bisect.bisect_right(self.__keys, entry)
+        self.__keys.insert(i, entry)
+        self.__documents.insert(i, document)
+
+    def remove(self, document: Document) -> None:
+        """
+        Remove a document from the index, if it is indexed.
+        """
+        entry = self.__entries.pop(id(document), None)
+        if entry is None:
+            return
+        if entry[0] is None:
+            del self.__none[id(document)]
+            return
+        i = bisect.bisect_left(self.__keys, entry)
+        del self.__keys[i]
+        del self.__documents[i]
+
+    def find(self, value) -> list[Document]:
+        """
+        Find the documents having the value.
+        """
+        if value is None:
+            return list(self.__none.values())
+        return list(self.range(value, value, include_high=True))
+
+    def count(self, value) -> int:
+        """
+        Count the documents having the value.
+        """
+        if value is None:
+            return len(self.__none)
+        return bisect.bisect_right(self.__keys, (value, math.inf)) - bisect.bisect_left(self.__keys, (value,))
+
+    def range(self, low=None, high=None, include_low: bool = True, include_high: bool = False) -> Iterator[Document]:
+        """
+        Iterate over the documents with values between low and high, in the order of the values.
+        :param low: lower bound, or None for no lower bound
+        :param high: upper bound, or None for no upper bound
+        :param include_low: whether documents with a value equal to low are included
+        :param include_high: whether documents with a value equal to high are included
+        """
+        start, end = self.__bounds(low, high, include_low, include_high)
+        return iter(self.__documents[start:end])
+
+    def count_range(self, low=None, high=None, include_low: bool = True, include_high: bool = False) -> int:
+        """
+        Count the documents with values between low and high in O(log n), see range.
+        """
+        start, end = self.__bounds(low, high, include_low, include_high)
+        return max(end - start, 0)
+
+    def __bounds(self, low, high, include_low: bool, include_high: bool) -> tuple[int, int]:
+        """
+        Find the positions of the first entry in the range and of the entry after the range.
+        """
+        if low is None:
+            start = 0
+        elif include_low:
+            start = bisect.bisect_left(self.__keys, (low,))
+        else:
+            start = bisect.bisect_right(self.__keys, (low, math.inf))
+        if high is None:
+            end = len(self.__keys)
+        elif include_high:
+            end = bisect.bisect_right(self.__keys, (high, math.inf))
+        else:
+            end = bisect.bisect_left(self.__keys, (high,))
+        return start, end
+
+    def clear(self) -> None:
+        self.__keys = []
+        self.__documents = []
+        self.__entries = {}
+        self.__none = {}
+
+    def __contains__(self, document) -> bool:
+        return id(document) in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
@@ -1,12 +1,16 @@
+import pickle
 import sys
 
-from models.base.field import Field
+from models.base.field import Field, ReferenceDocumentsField
+from models.base.index import HashIndex, SortedIndex
 
 
 class MetaDocument(type):
     """
     A metaclass for documents to register all fields and identify the primary key.
+    Document classes are also registered by module and qualified name, see find_class.
     """
+    __classes = {}  # {(module, qualname): class} of all document classes
 
     class MultiplePrimaryKeyError(Exception):
         def __init__(self):
@@ -44,26 +48,51 @@ class MetaDocument(type):
             doc_fields[attr_name] = attr_value
         attrs["_primary_key"] = primary_key
         attrs["_fields"] = doc_fields
+        attrs["_reference_fields"] = tuple(field_name for field_name, field in doc_fields.items()
+                                           if isinstance(field, ReferenceDocumentsField))
+        attrs["_embedded_index"] = {}  # Referenced documents by primary key, if the class sets _global_index
+        attrs["_attached_documents"] = {}  # Referenced documents of this class by identity, to scan them
+        # Indexes of fields declared with index=True, maintained separately for each class
+        attrs["_field_indexes"] = {
+            field_name: (SortedIndex if field.index == 'sorted' else HashIndex)(field_name, field.unique)
+            for field_name, field in doc_fields.items() if field.index}
 
-        return super().__new__(cls, name, bases, attrs)
+        new_class = super().__new__(cls, name, bases, attrs)
+        MetaDocument.__classes[(new_class.__module__, new_class.__qualname__)] = new_class
+        return new_class
+
+    @staticmethod
+    def find_class(module: str, qualname: str) -> type:
+        """
+        Find a class by module and qualified name, as named by references to documents in storage.
+        Document classes are found in the registry, and other classes (e.g. enums) are imported.
+        :param module: the module of the class
+        :param qualname: the qualified name of the class within the module
+        """
+        found = MetaDocument.__classes.get((module, qualname))
+        if found is None:
+            __import__(module)
+            found = pickle._getattribute(sys.modules[module], qualname)[0]
+        return found
 
 
 class MetaIndexedDocument(MetaDocument):
     """
-    A metaclass for IndexedDocument to load the index at class definition.
+    A metaclass for IndexedDocument to set the storage of the index at class definition.
+    Subclasses of another IndexedDocument share the storage of their top-most persisted parent class.
     """
 
     def __new__(cls, name, bases, attrs):
-        if "_persistence_path" not in attrs and name != "IndexedDocument":
-            prefix = 'test_' if 'unittest' in sys.modules else ''
+        prefix = 'test_' if 'unittest' in sys.modules else ''
+        storage_bases = [base for base in bases if hasattr(base, '_persistence_path')]
+        if storage_bases:
+            # Where earlier versions stored the documents of the subclass, to move them to the shared storage
+            attrs["_separate_persistence_path"] = f'{prefix}data/{name}'
+        elif "_persistence_path" not in attrs and name != "IndexedDocument":
             attrs["_persistence_path"] = f'{prefix}data/{name}'
 
-        # record persistence bases, so that subclasses are also persisted to parent classes
-        persistence_bases = []
-        for base in bases:
-            if hasattr(base, '_persistence_path'):
-                persistence_bases.append(base)
-        attrs["_persistence_bases"] = persistence_bases
-
         new_class = super().__new__(cls, name, bases, attrs)
+        if name != "IndexedDocument":
+            # The class whose index stores the documents of this class
+            new_class._storage_class = storage_bases[0]._storage_class if storage_bases else new_class
         return new_class
@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import operator
+from typing import TYPE_CHECKING, Iterator, Optional, Type
+
+from models.base.field import ReferenceDocumentsField
+from models.base.index import SortedIndex
+
+if TYPE_CHECKING:
+    from models.base.document import Document
+
+
+class Query:
+    """
+    A lazy query over the documents of a class, started with Document.query(). For example:
+
+        Refugee.query().where(lastname='Bond', starting_date__gte=date(2022, 1, 1)).within(plan)
+
+    Criteria are field names, optionally followed by a lookup:
+    __ne, __lt, __lte, __gt, __gte, or __in with a collection of values. Without a lookup, values must be equal.
+    within restricts the results to documents referenced, directly or indirectly, by another document.
+
+    The query is planned when it is iterated. The planner estimates how many documents each access path
+    would touch and starts from the cheapest one:
+      - an index of a field, for equality or __in criteria, or for range criteria on a sorted index;
+      - the documents under the document passed to within;
+      - all documents of the class.
+    The remaining criteria are checked on each touched document. explain() reports the plan and its cost.
+    """
+
+    LOOKUPS = {
+        'eq': operator.eq,
+        'ne': operator.ne,
+        'lt': operator.lt,
+        'lte': operator.le,
+        'gt': operator.gt,
+        'gte': operator.ge,
+        'in': lambda value, values: value in values,
+    }
+    RANGE_LOOKUPS = {'lt', 'lte', 'gt', 'gte'}
+
+    class InvalidCriterionError(Exception):
+        def __init__(self, document_type: type, criterion: str):
+            super().__init__(f"{document_type.__name__} cannot be queried by {criterion}")
+
+    def __init__(self, document_type: Type[Document], criteria: tuple = (), container: Document = None):
+        """
+        :param document_type: the class of the queried documents, including subclasses
+        :param criteria: (field name, lookup, value) tuples, all of which must match
+        :param container: the document that must reference the results, if any
+        """
+        self.document_type = document_type
+        self.__criteria = criteria
+        self.__container = container
+        self.__touched = 0
+
+    def where(self, **criteria) -> Query:
+        """
+        Narrow the query with criteria on fields, see Query.
+        :return: a new query with both the existing and the new criteria
+        """
+        parsed = []
+        for criterion, value in criteria.items():
+            field_name, _, lookup = criterion.rpartition('__')
+            # Fields may be private, e.g. _Plan__start_date, so only known lookups are split off
+            if lookup not in self.LOOKUPS:
+                field_name, lookup = criterion, 'eq'
+            field = self.document_type._fields.get(field_name)
+            if field is None or isinstance(field, ReferenceDocumentsField):
+                raise self.InvalidCriterionError(self.document_type, criterion)
+            parsed.append((field_name, lookup, value))
+        return Query(self.document_type, self.__criteria + tuple(parsed), self.__container)
+
+    def within(self, container: Document) -> Query:
+        """
+        Narrow the query to documents referenced, directly or indirectly, by a document. For example,
+        the refugees of a plan are referenced by its camps, which are referenced by the plan.
+        :return: a new query with the same criteria
+        """
+        return Query(self.document_type, self.__criteria, container)
+
+    def __iter__(self) -> Iterator[Document]:
+        self.__touched = 0
+        access = self.__plan()
+        checks = [criterion for criterion in self.__criteria if criterion not in access['criteria']]
+        check_container = self.__container is not None and access['kind'] != 'container'
+        for document in access['documents']():
+            self.__touched += 1
+            if not all(self.__matches(document, criterion) for criterion in checks):
+                continue
+            if check_container and not self.__is_within(document):
+                continue
+            yield document
+
+    def all(self) -> list[Document]:
+        return list(self)
+
+    def first(self) -> Optional[Document]:
+        return next(iter(self), None)
+
+    def count(self) -> int:
+        return sum(1 for _ in self)
+
+    def explain(self) -> dict:
+        """
+        Run the query and report how it was executed.
+        :return: a dictionary with
+                 'access': the access path, e.g. 'index Refugee.lastname' or 'scan Refugee',
+                 'estimated': the number of documents the planner expected to touch,
+                 'filters': the criteria checked on each touched document,
+                 'touched': the number of documents touched,
+                 'returned': the number of results.
+        """
+        access = self.__plan()
+        filters = [self.__describe(criterion) for criterion in self.__criteria if criterion not in access['criteria']]
+        if self.__container is not None and access['kind'] != 'container':
+            filters.append(f'within {self.__container}')
+        returned = self.count()
+        return {'access': access['description'],
+                'estimated': access['estimated'],
+                'filters': filters,
+                'touched': self.__touched,
+                'returned': returned}
+
+    def __plan(self) -> dict:
+        """
+        Choose the access path that is estimated to touch the fewest documents.
+        The documents of the chosen path are only computed when called, so that planning stays cheap.
+        """
+        candidates = [self.__index_access(field_name) for field_name in
+                      dict.fromkeys(field_name for field_name, _, _ in self.__criteria)]
+        if self.__container is not None:
+            candidates.append({'kind': 'container',
+                               'description': f'{self.document_type.__name__} within {self.__container}',
+                               'estimated': self.__estimate_within(),
+                               'documents': self.__documents_within,
+                               'criteria': ()})
+        candidates = [candidate for candidate in candidates if candidate is not None]
+        if not candidates:
+            # Every other access path touches a subset of the documents of the class
+            documents = self.__all_documents()
+            return {'kind': 'scan',
+                    'description': f'scan {self.document_type.__name__}',
+                    'estimated': len(documents),
+                    'documents': lambda: documents,
+                    'criteria': ()}
+        return min(candidates, key=lambda candidate: candidate['estimated'])
+
+    def __index_access(self, field_name: str) -> Optional[dict]:
+        """
+        Plan an access path through the index of a field, if its criteria can use one.
+        """
+        from models.base.document import IndexedDocument
+        index = self.document_type._field_indexes.get(field_name)
+        if index is None:
+            return None
+        if not issubclass(self.document_type, IndexedDocument) and self.document_type.__subclasses__():
+            # Embedded subclasses have separate indexes, unlike subclasses in the index of their parent class
+            return None
+        description = f'index {self.document_type.__name__}.{field_name}'
+        criteria = [criterion for criterion in self.__criteria if criterion[0] == field_name]
+        for criterion in criteria:
+            _, lookup, value = criterion
+            if lookup == 'eq':
+                return {'kind': 'index', 'description': description, 'estimated': index.count(value),
+                        'documents': lambda: index.find(value), 'criteria': (criterion,)}
+            if lookup == 'in':
+                values = list(dict.fromkeys(value))
+                return {'kind': 'index', 'description': description,
+                        'estimated': sum(index.count(value) for value in values),
+                        'documents': lambda: (document for value in values for document in index.find(value)),
+                        'criteria': (criterion,)}
+        ranges = [criterion for criterion in criteria if criterion[1] in self.RANGE_LOOKUPS]
+        if not ranges or not isinstance(index, SortedIndex):
+            return None
+        bounds = {'low': None, 'high': None, 'include_low': True, 'include_high': False}
+        used = []
+        for criterion in ranges:
+            _, lookup, value = criterion
+            # Use the first bound on each side and check any other ones on the documents
+            side = 'low' if lookup in ('gt', 'gte') else 'high'
+            if bounds[side] is not None:
+                continue
+            bounds[side] = value
+            bounds[f'include_{side}'] = lookup in ('gte', 'lte')
+            used.append(criterion)
+        return {'kind': 'index', 'description': description, 'estimated': index.count_range(**bounds),
+                'documents': lambda: index.range(**bounds), 'criteria': tuple(used)}
+
+    def __all_documents(self) -> list[Document]:
+        """
+        Get all queryable documents of the class and its subclasses.
+        Root-level documents are queryable while in their index, and embedded documents while referenced.
+        """
+        from models.base.document import IndexedDocument
+        if issubclass(self.document_type, IndexedDocument):
+            return self.document_type.all()
+        documents = []
+        document_types = [self.document_type]
+        while document_types:
+            document_type = document_types.pop()
+            documents.extend(document_type._attached_documents.values())
+            document_types.extend(document_type.__subclasses__())
+        return documents
+
+    def __walk_within(self, count_only: bool) -> Iterator:
+        """
+        Walk the reference fields under the container without entering other root-level documents.
+        Yields matching documents, or with count_only, the number of matching documents in each typed
+        reference set, without visiting them.
+        """
+        from models.base.document import IndexedDocument
+        visited = {id(self.__container)}
+        stack = [self.__container]
+        while stack:
+            document = stack.pop()
+            for field in document._fields.values():
+                if not isinstance(field, ReferenceDocumentsField):
+                    continue
+                references = getattr(document, field.name)
+                if references is None:
+                    continue
+                if count_only and references.data_type is not None \
+                        and issubclass(references.data_type, self.document_type):
+                    yield len(references)
+                    continue
+                for referee in references:
+                    if id(referee) in visited:
+                        continue
+                    visited.add(id(referee))
+                    if isinstance(referee, self.document_type):
+                        yield 1 if count_only else referee
+                    if not isinstance(referee, IndexedDocument):
+                        stack.append(referee)
+
+    def __estimate_within(self) -> int:
+        return sum(self.__walk_within(count_only=True))
+
+    def __documents_within(self) -> Iterator[Document]:
+        return self.__walk_within(count_only=False)
+
+    def __is_within(self, document: Document) -> bool:
+        """
+        Check whether the container references the document, directly or indirectly.
+        """
+        visited = {id(document)}
+        stack = [document]
+        while stack:
+            for referrer in stack.pop()._referenced_by:
+                if referrer is self.__container:
+                    return True
+                if id(referrer) not in visited:
+                    visited.add(id(referrer))
+                    stack.append(referrer)
+        return False
+
+    def __matches(self, document: Document, criterion: tuple) -> bool:
+        field_name, lookup, value = criterion
+        actual = document._data.get(field_name)
+        if actual is None and lookup in self.RANGE_LOOKUPS:
+            return False
+        return self.LOOKUPS[lookup](actual, value)
+
+    @staticmethod
+    def __describe(criterion: tuple) -> str:
+        field_name, lookup, value = criterion
+        return f'{field_name}__{lookup}={value!r}'
@@ -0,0 +1,1167 @@
+from __future__ import annotations
+
+import glob
+import io
+import lzma
+import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+import zlib
+from datetime import date
+from enum import Enum
+from typing import TYPE_CHECKING, Any, Callable, Collection, Iterable, Iterator, Optional, Type, BinaryIO
+
+from models.base.codec import DocumentCodec
+from models.base.field import ReferenceSet
+
+if TYPE_CHECKING:
+    from models.base.document import IndexedDocument
+
+
+class Storage:
+    """
+    Persistence of the index of an IndexedDocument class on disk, selected with its _storage_mode attribute.
+    Eager storages load all documents of the index at once.
+    Lazy storages only list the stored keys when loaded, and load each document when it is first requested.
+    In terms of documents, the interface is:
+    - load: load() and keys(), which list the stored documents, and stored_classes(), their classes;
+    - get by key: load_document(key), for lazy storages, or read_document(key) to read without loading;
+    - upsert and delete: save(objects, documents, deleted), writing each changed document as it is in objects,
+      or as deleted if its key is in deleted, and compact(objects), writing all of them;
+    - search: find_keys(criteria), for storages with indexed columns.
+    Storages with patches write the changes to a loaded document instead of the whole document when they are
+    recorded, see IndexedDocument._unwritten_changes.
+
+    Files are never truncated in place: they are either replaced by renaming a complete temporary file over them,
+    or appended to, with any incomplete record at the end ignored or removed when loading.
+    Whether writes are flushed to the disk with fsync is selected with the _durability attribute of the class:
+    - 'none' (default): the operating system decides when to write. Writes survive the process crashing,
+      but may be lost if the machine does.
+    - 'commit': the files written when saving are synced once the changes are written, i.e. when the outermost
+      transaction commits.
+    - 'write': appended records are also synced one by one.
+    """
+    lazy = False
+    archiving = False  # Whether documents can be moved to an archive tier with archive()
+    patches = False  # Whether the changes to documents are written instead of whole documents when recorded
+    DURABILITY_LEVELS = ('none', 'commit', 'write')
+
+    def __init__(self, document_type: Type[IndexedDocument], path: str = None):
+        """
+        :param document_type: the class of the index
+        :param path: the path of the files, _persistence_path of the class by default
+        """
+        self.document_type = document_type
+        self.path = path or document_type._persistence_path
+
+    def load(self) -> dict:
+        """
+        Load the index.
+        :return: all documents by key for eager storages, or an empty dictionary for lazy storages
+        """
+        raise NotImplementedError
+
+    def keys(self) -> Iterable:
+        """
+        Get the keys of the stored documents. Only lazy storages list them.
+        """
+        return ()
+
+    def stored_classes(self) -> dict:
+        """
+        Get the classes of the stored documents by key, as their module and qualified name, for lazy storages,
+        so that the documents of a class can be loaded without loading the others.
+        Documents stored without their class, e.g. by earlier versions, are not listed.
+        """
+        return {}
+
+    def load_document(self, key) -> Optional[Any]:
+        """
+        Load a stored document of a lazy storage.
+        :return: the unpickled document, or None if there is no document with the key
+        """
+        raise NotImplementedError
+
+    def read_document(self, key) -> Optional[Any]:
+        """
+        Read a stored document of a lazy storage without loading it, e.g. to search the archive tier.
+        Unlike with load_document, the document is not recorded as loaded, so compacting does not remove it
+        when it is not in the index.
+        :return: the unpickled document, or None if there is no document with the key
+        """
+        raise NotImplementedError
+
+    def archived_keys(self) -> Iterable:
+        """
+        Get the keys of the documents in the archive tier. They are included in keys().
+        """
+        return ()
+
+    def archive(self, document: IndexedDocument) -> None:
+        """
+        Move a document to the archive tier, where it is stored compressed and only loaded when requested.
+        Later changes to the document are also written to the archive.
+        """
+        raise NotImplementedError(f'{type(self).__name__} does not support archiving')
+
+    def find_keys(self, criteria: dict) -> Optional[list]:
+        """
+        Find the keys of the stored documents that may match criteria on indexed fields, without loading them.
+        :param criteria: field values by field name, all of which must match
+        :return: the keys of the matching documents not in the archive tier, possibly with others,
+                 or None if the storage cannot search by the criteria
+        """
+        return None
+
+    def save(self, objects: dict, documents: Iterable[IndexedDocument], deleted: Collection = ()) -> None:
+        """
+        Write changed documents.
+        A document is written as deleted if its key is in deleted and it is not in the index again.
+        A document neither in the index nor deleted is not written, see _changes.
+        :param objects: the loaded documents of the index by key
+        :param documents: the changed documents
+        :param deleted: the keys of the documents deleted from the index
+        """
+        self.compact(objects)
+
+    @staticmethod
+    def _changes(objects: dict, documents: Iterable[IndexedDocument],
+                 deleted: Collection) -> Iterator[tuple[Any, Optional[IndexedDocument]]]:
+        """
+        Get the changes to write when saving, as each key with its document in the index, or None if deleted.
+        Documents that are neither in the index nor deleted are skipped: they were unloaded since they changed,
+        e.g. when the index was reloaded, so the stored document is current.
+        """
+        for document in documents:
+            current = objects.get(document.key)
+            if current is not None or document.key in deleted:
+                yield document.key, current
+
+    def compact(self, objects: dict) -> None:
+        """
+        Rewrite the whole index.
+        :param objects: the loaded documents of the index by key
+        """
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        """
+        Remove all stored documents, and any temporary files left by interrupted writes.
+        """
+        for path in self._paths():
+            self._remove(path)
+            for temporary_path in glob.glob(f'{glob.escape(path)}.*.tmp'):
+                self._remove(temporary_path)
+
+    def _paths(self) -> list[str]:
+        """
+        Get the paths of all files of the storage.
+        """
+        return [self.path]
+
+    def _class_name(self, document) -> tuple[str, str]:
+        """
+        Get the class of a document, as listed by stored_classes.
+        """
+        if isinstance(document, self.document_type.DeferredReference):
+            # Copied as unpickled, with a reference to a subclass instance stored in its own index
+            return document.module, document.classname
+        document_class = type(document)
+        return document_class.__module__, getattr(document_class, '__qualname__', document_class.__name__)
+
+    def _uses_document_codec(self) -> bool:
+        """
+        Whether documents are encoded with DocumentCodec, as selected by the _document_codec attribute of the class.
+        """
+        return self.document_type._document_codec == 'binary'
+
+    def _dumps(self, document: IndexedDocument) -> bytes:
+        """
+        Encode a single document, with references to any other document of the index,
+        with the codec selected by the _document_codec attribute of the class.
+        """
+        if self._uses_document_codec():
+            return DocumentCodec(self.document_type, root=document).encode(document)
+        buffer = io.BytesIO()
+        self.document_type.Pickler(buffer, self.document_type, root=document).dump(document)
+        return buffer.getvalue()
+
+    def _loads(self, data: bytes):
+        """
+        Decode a single document, encoded with either codec.
+        """
+        if data.startswith(DocumentCodec.MAGIC):
+            return DocumentCodec(self.document_type).decode(data)
+        return self.document_type.Unpickler(io.BytesIO(data)).load()
+
+    def _dumps_changes(self, document: IndexedDocument, changes: list[tuple]) -> bytes:
+        """
+        Encode the changes to a single document with DocumentCodec, see IndexedDocument._unwritten_changes.
+        Documents added to reference sets are encoded as they are when written.
+        """
+        return DocumentCodec(self.document_type, root=document).encode(changes)
+
+    def _apply_changes(self, document, data: bytes) -> None:
+        """
+        Apply changes encoded by _dumps_changes to a decoded document, before its references are restored.
+        Changes to embedded documents no longer in the document are skipped, e.g. when changes written again after
+        a failed write are replayed twice, which gives the same document.
+        """
+        for path, operation, field_name, value in DocumentCodec(self.document_type).decode(data):
+            target = document
+            for step_field_name, slot in path:
+                references = target._data.get(step_field_name)
+                target = references._loaded(slot) if isinstance(references, ReferenceSet) else None
+                if target is None:
+                    break
+            else:
+                if operation == 'set':
+                    target._data[field_name] = value
+                    continue
+                references = target._data.get(field_name)
+                if not isinstance(references, ReferenceSet):
+                    continue
+                if operation == 'add':
+                    for slot, added in value.items():
+                        references._load_change(slot, added)
+                else:
+                    references._load_change(value, None)
+
+    def _make_directory(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _write_file(self, path: str, write: Callable[[BinaryIO], None]) -> None:
+        """
+        Replace a file atomically, by writing a temporary file next to it and renaming it over the file.
+        The temporary file has a unique name, so that concurrent writers never write to the same one,
+        and it is removed if writing fails.
+        :param write: a function writing the content to the open temporary file
+        """
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path) or None,
+                                                      prefix=f'{os.path.basename(path)}.', suffix='.tmp')
+        try:
+            with open(descriptor, 'wb') as f:
+                write(f)
+                self._sync(f)
+            os.replace(temporary_path, path)
+        except BaseException:
+            self._remove(temporary_path)
+            raise
+        self._sync_directory(path)
+
+    def _sync(self, f: BinaryIO, record: bool = False) -> None:
+        """
+        Flush a written file to the disk, as required by the durability level.
+        :param record: whether a single record was appended, which is only synced at the 'write' level
+        """
+        durability = self.document_type._durability
+        if durability not in self.DURABILITY_LEVELS:
+            raise ValueError(f'Unknown durability level {durability}')
+        if durability == 'none' or (record and durability != 'write'):
+            return
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _sync_directory(self, path: str) -> None:
+        """
+        Flush the directory entry of a created, renamed or removed file to the disk, as required by the durability
+        level. Not supported on all platforms.
+        """
+        if self.document_type._durability == 'none' or not hasattr(os, 'O_DIRECTORY'):
+            return
+        descriptor = os.open(os.path.dirname(path) or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _migrate(self, previous_type: Type[Storage]) -> None:
+        """
+        Move the documents of the index from another storage mode to this one, if there are any.
+        The documents are copied as unpickled, so references to other documents are restored when they are loaded.
+        """
+        previous = previous_type(self.document_type, self.path)
+        objects = previous.load()
+        for key in previous.keys():
+            objects[key] = previous.load_document(key)
+        if objects:
+            self.compact(objects)
+            previous.clear()
+
+    def merge(self, path: str, objects: dict) -> dict:
+        """
+        Move the documents stored at another path with the same storage mode to this storage,
+        such as the documents of a subclass stored in their own files by earlier versions.
+        The documents are copied as unpickled, as when migrating from another storage mode.
+        :param path: the path of the files of the other storage
+        :param objects: the loaded documents of the index by key, to which the moved documents are added
+        :return: the moved documents by key
+        """
+        previous = type(self)(self.document_type, path)
+        documents = previous.load()
+        for key in previous.keys():
+            documents[key] = previous.load_document(key)
+        objects.update(documents)
+        if documents:
+            self.save(objects, documents.values())
+        previous.clear()
+        return documents
+
+
+class SnapshotStorage(Storage):
+    """
+    The whole index is pickled to data/{classname}, and rewritten on every change.
+    The snapshot is followed by its generation, counting the times it was written in log mode.
+    With the binary document codec, the index is encoded with DocumentCodec and the encoded bytes are pickled.
+    """
+
+    def __init__(self, document_type: Type[IndexedDocument], path: str = None):
+        super().__init__(document_type, path)
+        self._generation = 0
+
+    def load(self) -> dict:
+        try:
+            with open(self.path, 'rb') as f:
+                objects = self.document_type.Unpickler(f).load()
+                if isinstance(objects, bytes):
+                    objects = self._loads(objects)
+                try:
+                    self._generation = pickle.load(f)
+                except EOFError:
+                    self._generation = 0  # Written by an earlier version
+                return objects
+        except FileNotFoundError:
+            return {}
+
+    def compact(self, objects: dict) -> None:
+        self._make_directory()
+
+        def write(f):
+            if self._uses_document_codec():
+                pickle.dump(DocumentCodec(self.document_type).encode(objects), f)
+            else:
+                self.document_type.Pickler(f, self.document_type).dump(objects)
+            pickle.dump(self._generation, f)
+
+        self._write_file(self.path, write)
+
+    def clear(self) -> None:
+        super().clear()
+        self._generation = 0
+
+
+class LogStorage(SnapshotStorage):
+    """
+    The changes to each changed document are appended as a record to data/{classname}.log: the encoded changes
+    when they are recorded with the binary document codec, see IndexedDocument._unwritten_changes,
+    or the whole document otherwise.
+    The log is replayed on top of the last snapshot when the index is loaded, and folded into a new snapshot
+    once its size reaches _log_compaction_ratio times the size of the snapshot, and at least
+    _log_compaction_min_size bytes, so that replaying the log costs at most about as much as loading the snapshot.
+    The log starts with the generation of the snapshot it applies to, so that a log left behind
+    by an interrupted compaction is not replayed on top of the newer snapshot.
+    """
+
+    def __init__(self, document_type: Type[IndexedDocument], path: str = None):
+        super().__init__(document_type, path)
+        self.log_path = f'{self.path}.log'
+        self.__log_size = 0  # In bytes, as the size of the snapshot
+        self.__snapshot_size = 0
+
+    @property
+    def patches(self) -> bool:
+        return self._uses_document_codec()
+
+    def load(self) -> dict:
+        objects = super().load()
+        self.__log_size = 0
+        self.__snapshot_size = self.__file_size(self.path)
+        self.__replay_log(objects)
+        return objects
+
+    def __replay_log(self, objects: dict) -> None:
+        """
+        Apply the records of the log to the loaded snapshot.
+        A truncated record at the end of the log (e.g. from an interrupted write) is removed.
+        """
+        try:
+            with open(self.log_path, 'rb') as f:
+                end = 0
+                records = []
+                while True:
+                    try:
+                        records.append(self.document_type.Unpickler(f).load())
+                    except (EOFError, pickle.UnpicklingError, ValueError):
+                        break
+                    end = f.tell()
+                size = f.seek(0, os.SEEK_END)
+        except FileNotFoundError:
+            return
+        if records and records[0][0] == 'generation':
+            generation = records.pop(0)[1]
+        else:
+            generation = 0  # Written by an earlier version
+        if generation != self._generation:
+            self._remove(self.log_path)  # Already in the snapshot
+            return
+        if end < size:
+            os.truncate(self.log_path, end)
+        for operation, key, document in records:
+            if operation == 'upsert':
+                objects[key] = self._loads(document) if isinstance(document, bytes) else document
+            elif operation == 'patch':
+                if key in objects:
+                    self._apply_changes(objects[key], document)
+            else:
+                objects.pop(key, None)
+        self.__log_size = end
+
+    def save(self, objects: dict, documents: Iterable[IndexedDocument], deleted: Collection = ()) -> None:
+        """
+        Append a record for each document to the log.
+        A document in the index is recorded as a patch with its changes if they are recorded, or as an upsert,
+        and a deleted one as a deletion.
+        """
+        self._make_directory()
+        with open(self.log_path, 'ab') as f:
+            if f.tell() == 0:
+                pickle.dump(('generation', self._generation, None), f)
+            for key, current in self._changes(objects, documents, deleted):
+                changes = None if current is None else self.document_type._unwritten_changes(current)
+                if current is None:
+                    record = ('delete', key, None)
+                elif changes is not None and self.patches:
+                    record = ('patch', current.key, self._dumps_changes(current, changes))
+                elif self._uses_document_codec():
+                    record = ('upsert', current.key, self._dumps(current))
+                else:
+                    record = ('upsert', current.key, current)
+                self.document_type.Pickler(f, self.document_type, root=current).dump(record)
+                self._sync(f, record=True)
+            self._sync(f)
+            self.__log_size = f.tell()
+        if self.__log_size >= max(self.document_type._log_compaction_ratio * self.__snapshot_size,
+                                  self.document_type._log_compaction_min_size):
+            self.compact(objects)
+
+    def compact(self, objects: dict) -> None:
+        self._generation += 1
+        super().compact(objects)
+        self.__snapshot_size = self.__file_size(self.path)
+        self._remove(self.log_path)
+        self._sync_directory(self.log_path)
+        self.__log_size = 0
+
+    @staticmethod
+    def __file_size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    def clear(self) -> None:
+        super().clear()
+        self.__log_size = self.__snapshot_size = 0
+
+    def _paths(self) -> list[str]:
+        return [self.log_path, self.path]  # The log is removed first, as it applies to the snapshot
+
+
+class PagedStorage(Storage):
+    """
+    Lazy storage with each document pickled separately as a record of data/{classname}.pages.
+    Changed documents are appended as new records, and a per-key offset table in data/{classname}.offsets
+    locates the latest record of each document, so that it can be loaded without reading the others.
+    Records appended after the offset table was last written (e.g. before an interrupted write)
+    are found by scanning the record headers from the end of the table.
+    The pages file is rewritten without superseded records once there are _log_compaction_threshold of them.
+    The offset table is removed while the pages file is replaced, so that it is rebuilt by scanning the new file
+    if the compaction is interrupted.
+    The offset table also lists the class of each document. Records found by scanning are listed without it.
+    """
+    lazy = True
+    HEADER = struct.Struct('>II')  # Lengths of the pickled key and of the pickled document, 0 for a deletion
+
+    def __init__(self, document_type: Type[IndexedDocument], path: str = None):
+        super().__init__(document_type, path)
+        self.pages_path = f'{self.path}.pages'
+        self.offsets_path = f'{self.path}.offsets'
+        self.__offsets: dict[Any, tuple[int, int]] = {}  # {key: (position of the pickled document, length)}
+        self.__classes: dict[Any, tuple[str, str]] = {}  # {key: class of the document}, see stored_classes
+        self.__size = 0  # Size of the pages file
+        self.__superseded = 0  # Number of records replaced by later records
+        self.__loaded = set()  # Keys of the documents loaded or written since loading
+
+    def load(self) -> dict:
+        try:
+            with open(self.offsets_path, 'rb') as f:
+                # Offset tables written before classes were listed do not have them
+                self.__size, self.__superseded, self.__offsets, self.__classes = (*pickle.load(f), {})[:4]
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.__size, self.__superseded, self.__offsets, self.__classes = 0, 0, {}, {}
+        self.__loaded = set()
+        self.__scan()
+        if not self.__offsets:
+            # Written in snapshot or log mode before
+            self._migrate(LogStorage)
+            self.__loaded = set()
+        return {}
+
+    def __scan(self) -> None:
+        """
+        Add the records after the end of the offset table to it.
+        A truncated record at the end of the file is removed.
+        """
+        try:
+            file_size = os.path.getsize(self.pages_path)
+        except FileNotFoundError:
+            file_size = 0
+        if self.__size > file_size:
+            # The offset table does not belong to this pages file
+            self.__size, self.__superseded, self.__offsets, self.__classes = 0, 0, {}, {}
+        if self.__size == file_size:
+            return
+        with open(self.pages_path, 'rb') as f:
+            f.seek(self.__size)
+            while True:
+                header = f.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    break
+                key_length, document_length = self.HEADER.unpack(header)
+                key_data = f.read(key_length)
+                position = f.tell()
+                if len(key_data) < key_length or position + document_length > file_size:
+                    break
+                f.seek(document_length, os.SEEK_CUR)
+                self.__record(pickle.loads(key_data), position, document_length)
+                self.__size = f.tell()
+        if self.__size < file_size:
+            os.truncate(self.pages_path, self.__size)
+
+    def __record(self, key, position: int, length: int, class_name: tuple[str, str] = None) -> None:
+        """
+        Point the offset table to a new record of a key, with a length of 0 for a deletion.
+        :param class_name: the class of the document, if known
+        """
+        if key in self.__offsets:
+            self.__superseded += 1
+        if length and class_name is not None:
+            self.__classes[key] = class_name
+        else:
+            self.__classes.pop(key, None)
+        if length:
+            self.__offsets[key] = (position, length)
+        elif self.__offsets.pop(key, None) is not None:
+            self.__superseded += 1  # The deletion record itself is not needed either
+
+    def keys(self) -> Iterable:
+        return list(self.__offsets)
+
+    def stored_classes(self) -> dict:
+        return dict(self.__classes)
+
+    def load_document(self, key) -> Optional[Any]:
+        document = self.read_document(key)
+        if key in self.__offsets:
+            self.__loaded.add(key)
+        return document
+
+    def read_document(self, key) -> Optional[Any]:
+        entry = self.__offsets.get(key)
+        if entry is None:
+            return None
+        position, length = entry
+        with open(self.pages_path, 'rb') as f:
+            f.seek(position)
+            data = f.read(length)
+        return self._loads(data)
+
+    def save(self, objects: dict, documents: Iterable[IndexedDocument], deleted: Collection = ()) -> None:
+        self._make_directory()
+        with open(self.pages_path, 'ab') as f:
+            for key, current in self._changes(objects, documents, deleted):
+                key_data = pickle.dumps(key)
+                document_data = b'' if current is None else self._dumps(current)
+                f.write(self.HEADER.pack(len(key_data), len(document_data)) + key_data + document_data)
+                self._sync(f, record=True)
+                self.__record(key, self.__size + self.HEADER.size + len(key_data), len(document_data),
+                              None if current is None else self._class_name(current))
+                self.__loaded.add(key)
+                self.__size += self.HEADER.size + len(key_data) + len(document_data)
+            self._sync(f)
+        if self.__superseded >= self.document_type._log_compaction_threshold:
+            self.compact(objects)
+        else:
+            self.__write_offsets()
+
+    def compact(self, objects: dict) -> None:
+        """
+        Rewrite the pages file with the latest record of each document.
+        Documents that have not been loaded are copied without unpickling them.
+        """
+        self._make_directory()
+        offsets, classes, size = {}, {}, 0
+
+        def write(f):
+            nonlocal size
+            with open(self.pages_path, 'ab+') as pages:
+                for key in dict.fromkeys([*self.__offsets, *objects]):
+                    if key in objects:
+                        document_data = self._dumps(objects[key])
+                    elif key in self.__loaded or key not in self.__offsets:
+                        continue  # Deleted since loading
+                    else:
+                        position, length = self.__offsets[key]
+                        pages.seek(position)
+                        document_data = pages.read(length)
+                    key_data = pickle.dumps(key)
+                    f.write(self.HEADER.pack(len(key_data), len(document_data)) + key_data + document_data)
+                    offsets[key] = (size + self.HEADER.size + len(key_data), len(document_data))
+                    class_name = self._class_name(objects[key]) if key in objects else self.__classes.get(key)
+                    if class_name is not None:
+                        classes[key] = class_name
+                    size += self.HEADER.size + len(key_data) + len(document_data)
+
+        self._remove(self.offsets_path)
+        self._write_file(self.pages_path, write)
+        self.__offsets, self.__classes, self.__size, self.__superseded = offsets, classes, size, 0
+        self.__loaded = set(objects)
+        self.__write_offsets()
+
+    def __write_offsets(self) -> None:
+        table = (self.__size, self.__superseded, self.__offsets, self.__classes)
+        self._write_file(self.offsets_path, lambda f: pickle.dump(table, f))
+
+    def clear(self) -> None:
+        super().clear()
+        self.__offsets, self.__classes, self.__size, self.__superseded, self.__loaded = {}, {}, 0, 0, set()
+
+    def _paths(self) -> list[str]:
+        return [self.pages_path, self.offsets_path]
+
+
+class PartitionedStorage(Storage):
+    """
+    Lazy storage with each document pickled in its own segment file, data/{classname}.segments/{number},
+    listed by key in a manifest, data/{classname}.manifest, with the class of each document.
+    Saving a document only rewrites its own segment, and the manifest when documents are added or deleted,
+    so changes to a document never touch the segments of the others.
+    When the changes to a loaded document are recorded, see IndexedDocument._unwritten_changes, they are appended
+    to the log of its segment, data/{classname}.segments/{number}.log, instead. The segment is rewritten once
+    its log reaches _log_compaction_ratio times its size, and the log is then removed.
+    The log starts with the checksum of the segment it applies to, so that a log left behind by an interrupted
+    rewrite is not replayed on top of the newer segment.
+    Archived documents are moved to an lzma-compressed segment in data/{classname}.archive/{number}.xz.
+    Segments are written before the manifest lists them, and each file is replaced atomically.
+    """
+    lazy = True
+    archiving = True
+
+    def __init__(self, document_type: Type[IndexedDocument], path: str = None):
+        super().__init__(document_type, path)
+        self.segments_path = f'{self.path}.segments'
+        self.archive_path = f'{self.path}.archive'
+        self.manifest_path = f'{self.path}.manifest'
+        self.__segments: dict[Any, int] = {}  # {key: segment number}
+        self.__classes: dict[Any, tuple[str, str]] = {}  # {key: class of the document}, see stored_classes
+        self.__archived = set()  # Keys of the documents with a segment in the archive
+        self.__next_segment = 0
+        self.__loaded = set()  # Keys of the documents loaded or written since loading
+        # Logs of the segments loaded or written since loading, not archived:
+        # {key: (checksum of the segment, size of the segment, size of the log up to its last complete record)}
+        self.__logs: dict[Any, tuple[int, int, int]] = {}
+
+    @property
+    def patches(self) -> bool:
+        return self._uses_document_codec()
+
+    def load(self) -> dict:
+        self.__logs = {}
+        try:
+            with open(self.manifest_path, 'rb') as f:
+                manifest = pickle.load(f)
+            # Manifests written before archiving was supported do not list archived documents,
+            # and manifests written before classes were listed do not have them
+            defaults = (set(), {})
+            self.__next_segment, self.__segments, self.__archived, self.__classes = \
+                (*manifest, *defaults[len(manifest) - 2:])
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.__next_segment, self.__segments, self.__archived, self.__classes = 0, {}, set(), {}
+            # Written in another storage mode before
+            self._migrate(PagedStorage)
+        self.__loaded = set()
+        return {}
+
+    def keys(self) -> Iterable:
+        return list(self.__segments)
+
+    def archived_keys(self) -> Iterable:
+        return list(self.__archived)
+
+    def stored_classes(self) -> dict:
+        return dict(self.__classes)
+
+    def load_document(self, key) -> Optional[Any]:
+        if key in self.__segments:
+            self.__loaded.add(key)
+        document, log = self.__read(key)
+        if log is not None:
+            self.__logs[key] = log
+        return document
+
+    def read_document(self, key) -> Optional[Any]:
+        return self.__read(key)[0]
+
+    def __read(self, key) -> tuple[Optional[Any], Optional[tuple[int, int, int]]]:
+        """
+        Read a stored document, with the changes in the log of its segment applied.
+        :return: the document, or None if there is no document with the key,
+                 and the log of its segment as in __logs, or None for an archived document
+        """
+        number = self.__segments.get(key)
+        if number is None:
+            return None, None
+        try:
+            if key in self.__archived:
+                with open(self.__archive_path(number), 'rb') as f:
+                    return self._loads(lzma.decompress(f.read())), None
+            with open(self.__segment_path(number), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, None  # Deleted before the manifest was written
+        document = self._loads(data)
+        checksum = zlib.crc32(data)
+        return document, (checksum, len(data), self.__replay_log(number, checksum, document))
+
+    def __replay_log(self, number: int, checksum: int, document) -> int:
+        """
+        Apply the records of the log of a segment to the document read from it.
+        An incomplete record at the end of the log (e.g. from an interrupted write) is ignored,
+        and overwritten by the next record appended.
+        :return: the size of the log up to its last complete record, or 0 if there is no log of the segment,
+                 including a log left behind by an interrupted rewrite of the segment
+        """
+        try:
+            with open(self.__log_path(number), 'rb') as f:
+                try:
+                    if pickle.load(f) != ('segment', checksum):
+                        return 0
+                except (EOFError, pickle.UnpicklingError, ValueError):
+                    return 0
+                end = f.tell()
+                while True:
+                    try:
+                        changes = pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError, ValueError):
+                        return end
+                    self._apply_changes(document, changes)
+                    end = f.tell()
+        except FileNotFoundError:
+            return 0
+
+    def archive(self, document: IndexedDocument) -> None:
+        """
+        Write the document to the archive, then list it as archived and remove its segment.
+        """
+        if document.key in self.__archived:
+            return
+        self.__write_segment(document.key, document, archive=True)
+        self.__archived.add(document.key)
+        self.__write_manifest()
+        self._remove(self.__segment_path(self.__segments[document.key]))
+        self._remove(self.__log_path(self.__segments[document.key]))
+
+    def save(self, objects: dict, documents: Iterable[IndexedDocument], deleted: Collection = ()) -> None:
+        """
+        Write the segment of each changed document, or append its changes to the log of its segment
+        if they are recorded and the segment was loaded.
+        """
+        manifest_changed = False
+        for key, current in self._changes(objects, documents, deleted):
+            changes = None if current is None else self.document_type._unwritten_changes(current)
+            if changes is not None and self.patches and key in self.__logs:
+                manifest_changed |= self.__append_changes(key, current, changes)
+            else:
+                manifest_changed |= self.__write_segment(key, current)
+        if manifest_changed:
+            self.__write_manifest()
+
+    def __append_changes(self, key, document: IndexedDocument, changes: list[tuple]) -> bool:
+        """
+        Append the changes to a document to the log of its segment, and rewrite the segment once the log is large
+        enough, see PartitionedStorage.
+        :return: whether the manifest has to be written
+        """
+        checksum, segment_size, log_size = self.__logs[key]
+        data = self._dumps_changes(document, changes)
+        with open(self.__log_path(self.__segments[key]), 'ab') as f:
+            if f.tell() != log_size:
+                # An incomplete record, or a log left behind by an interrupted rewrite of the segment
+                f.truncate(log_size)
+                f.seek(log_size)
+            if log_size == 0:
+                pickle.dump(('segment', checksum), f)
+            pickle.dump(data, f)
+            self._sync(f)
+            log_size = f.tell()
+        self.__logs[key] = (checksum, segment_size, log_size)
+        if log_size >= self.document_type._log_compaction_ratio * segment_size:
+            return self.__write_segment(key, document)
+        return False
+
+    def compact(self, objects: dict) -> None:
+        """
+        Rewrite the segments of the loaded documents, and remove the segments of deleted documents.
+        """
+        for key in [key for key in self.__segments if key in self.__loaded and key not in objects]:
+            self.__write_segment(key, None)
+        for key, document in objects.items():
+            self.__write_segment(key, document)
+        self.__write_manifest()
+
+    def __write_segment(self, key, document: Optional[IndexedDocument], archive: bool = False) -> bool:
+        """
+        Write the segment of a document, or remove it if the document is None.
+        :param archive: whether to write the segment to the archive, as for documents already archived
+        :return: whether the manifest has to be written
+        """
+        self.__loaded.add(key)
+        self.__logs.pop(key, None)
+        if document is None:
+            self.__classes.pop(key, None)
+            number = self.__segments.pop(key, None)
+            if number is not None:
+                path = self.__archive_path(number) if key in self.__archived else self.__segment_path(number)
+                self.__archived.discard(key)
+                self._remove(path)
+                self._remove(self.__log_path(number))
+            return number is not None
+        number = self.__segments.get(key)
+        added = number is None
+        if added:
+            number = self.__segments[key] = self.__next_segment
+            self.__next_segment += 1
+        class_name = self._class_name(document)
+        class_changed = self.__classes.get(key) != class_name
+        self.__classes[key] = class_name
+        if archive or key in self.__archived:
+            os.makedirs(self.archive_path, exist_ok=True)
+            data = lzma.compress(self._dumps(document))
+            self._write_file(self.__archive_path(number), lambda f: f.write(data))
+        else:
+            os.makedirs(self.segments_path, exist_ok=True)
+            data = self._dumps(document)
+            self._write_file(self.__segment_path(number), lambda f: f.write(data))
+            self._remove(self.__log_path(number))  # Folded into the segment
+            self.__logs[key] = (zlib.crc32(data), len(data), 0)
+        return added or class_changed
+
+    def __segment_path(self, number: int) -> str:
+        return os.path.join(self.segments_path, str(number))
+
+    def __log_path(self, number: int) -> str:
+        return os.path.join(self.segments_path, f'{number}.log')
+
+    def __archive_path(self, number: int) -> str:
+        return os.path.join(self.archive_path, f'{number}.xz')
+
+    def __write_manifest(self) -> None:
+        self._make_directory()
+        manifest = (self.__next_segment, self.__segments, self.__archived, self.__classes)
+        self._write_file(self.manifest_path, lambda f: pickle.dump(manifest, f))
+
+    def clear(self) -> None:
+        super().clear()
+        for directory in (self.segments_path, self.archive_path):
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+                os.rmdir(directory)
+        self.__segments, self.__archived, self.__classes = {}, set(), {}
+        self.__next_segment, self.__loaded, self.__logs = 0, set(), {}
+
+    def _paths(self) -> list[str]:
+        return [self.manifest_path]
+
+
+class SqliteStorage(Storage):
+    """
+    Lazy storage in an SQLite database, data/{classname}.sqlite, with a row per pickled document.
+    Each save updates the rows of the changed documents in a single SQLite transaction.
+    Fields declared with Field(index=...) by the class or its subclasses also have an indexed column,
+    so that find_keys only selects the rows with matching values. Values are stored in these columns
+    if they are strings, numbers, dates, or enums of them.
+    Rows stored without the values of all columns are selected by every search.
+    Archived documents are flagged and stored lzma-compressed.
+    The class of each document is stored as 'module:qualified name' in the class_name column.
+    With any durability level but 'none', SQLite syncs each transaction to the disk.
+    The database is only created when documents are first written.
+    """
+    lazy = True
+    archiving = True
+    UNSUPPORTED = object()  # Column value of a field value that cannot be stored in a column
+
+    def __init__(self, document_type: Type[IndexedDocument], path: str = None):
+        super().__init__(document_type, path)
+        self.database_path = f'{self.path}.sqlite'
+        self.__connection: Optional[sqlite3.Connection] = None
+        self.__columns = self.__indexed_fields(document_type)
+        self.__archived = set()  # Keys of the archived documents
+        self.__loaded = set()  # Keys of the documents loaded or written since loading
+        columns = ''.join(f', {self.__quote(name)}' for name in self.__columns)
+        placeholders = ', ?' * len(self.__columns)
+        self.__upsert = f'INSERT OR REPLACE INTO documents (key, data, archived, indexed, class_name{columns}) ' \
+                        f'VALUES (?, ?, ?, ?, ?{placeholders})'
+
+    @staticmethod
+    def __indexed_fields(document_type: Type[IndexedDocument]) -> list[str]:
+        """
+        Get the names of the indexed fields of the class and of its subclasses sharing its storage.
+        """
+        names, classes = {}, [document_type]
+        while classes:
+            document_class = classes.pop(0)
+            classes.extend(document_class.__subclasses__())
+            names.update(dict.fromkeys(document_class._field_indexes))
+        return list(names)
+
+    def load(self) -> dict:
+        if not os.path.exists(self.database_path):
+            # Written in another storage mode before
+            self._migrate(PartitionedStorage)
+        self.__archived = {pickle.loads(key) for key, in self.__select('SELECT key FROM documents WHERE archived')}
+        self.__loaded = set()
+        return {}
+
+    def __database(self) -> sqlite3.Connection:
+        """
+        Get the connection to the database, creating or updating its tables when connecting.
+        """
+        if self.__connection is not None:
+            return self.__connection
+        self._make_directory()
+        connection = sqlite3.connect(self.database_path, check_same_thread=False)
+        synchronous = 'OFF' if self.document_type._durability == 'none' else 'FULL'
+        connection.execute(f'PRAGMA synchronous = {synchronous}')
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS documents (key BLOB PRIMARY KEY, data BLOB NOT NULL, '
+                               'archived INTEGER NOT NULL, indexed INTEGER NOT NULL, class_name TEXT)')
+            existing = {row[1] for row in connection.execute('PRAGMA table_info(documents)')}
+            if 'class_name' not in existing:
+                connection.execute('ALTER TABLE documents ADD COLUMN class_name TEXT')
+            for name in self.__columns:
+                if name not in existing:
+                    connection.execute(f'ALTER TABLE documents ADD COLUMN {self.__quote(name)}')
+                    # Rows already stored do not have the values of the new column
+                    connection.execute('UPDATE documents SET indexed = 0')
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {self.__quote(f"documents_{name}")} '
+                                   f'ON documents ({self.__quote(name)})')
+            connection.execute('CREATE INDEX IF NOT EXISTS documents_not_indexed ON documents (key) WHERE NOT indexed')
+        self.__connection = connection
+        return connection
+
+    def __select(self, query: str, parameters: Iterable = ()) -> list:
+        """
+        Select rows, without creating the database if nothing was written to it yet.
+        """
+        if self.__connection is None and not os.path.exists(self.database_path):
+            return []
+        return self.__database().execute(query, tuple(parameters)).fetchall()
+
+    def keys(self) -> Iterable:
+        return [pickle.loads(key) for key, in self.__select('SELECT key FROM documents')]
+
+    def stored_classes(self) -> dict:
+        return {pickle.loads(key): tuple(class_name.split(':', 1)) for key, class_name
+                in self.__select('SELECT key, class_name FROM documents WHERE class_name IS NOT NULL')}
+
+    def archived_keys(self) -> Iterable:
+        return list(self.__archived)
+
+    def load_document(self, key) -> Optional[Any]:
+        document = self.read_document(key)
+        if document is not None:
+            self.__loaded.add(key)
+        return document
+
+    def read_document(self, key) -> Optional[Any]:
+        rows = self.__select('SELECT data, archived FROM documents WHERE key = ?', (pickle.dumps(key),))
+        if not rows:
+            return None
+        data, archived = rows[0]
+        return self._loads(lzma.decompress(data) if archived else data)
+
+    def find_keys(self, criteria: dict) -> Optional[list]:
+        values = [self.__column_value(value) for value in criteria.values()]
+        if not criteria or any(name not in self.__columns for name in criteria) or self.UNSUPPORTED in values:
+            return None
+        conditions = ' AND '.join(f'{self.__quote(name)} IS ?' for name in criteria)
+        rows = self.__select(f'SELECT key FROM documents WHERE {conditions} AND NOT archived '
+                             f'UNION SELECT key FROM documents WHERE NOT indexed AND NOT archived', values)
+        return [pickle.loads(key) for key, in rows]
+
+    def archive(self, document: IndexedDocument) -> None:
+        if document.key in self.__archived:
+            return
+        with self.__database():
+            self.__write_row(document.key, document, archive=True)
+        self.__archived.add(document.key)
+
+    def save(self, objects: dict, documents: Iterable[IndexedDocument], deleted: Collection = ()) -> None:
+        with self.__database():
+            for key, current in self._changes(objects, documents, deleted):
+                self.__write_row(key, current)
+
+    def compact(self, objects: dict) -> None:
+        """
+        Rewrite the rows of the loaded documents, and delete the rows of deleted documents.
+        """
+        with self.__database():
+            for key in [key for key in self.__loaded if key not in objects]:
+                self.__write_row(key, None)
+            for key, document in objects.items():
+                self.__write_row(key, document)
+
+    def __write_row(self, key, document: Optional[IndexedDocument], archive: bool = False) -> None:
+        """
+        Write the row of a document, or delete it if the document is None.
+        :param archive: whether to write the row to the archive tier, as for documents already archived
+        """
+        self.__loaded.add(key)
+        if document is None:
+            self.__database().execute('DELETE FROM documents WHERE key = ?', (pickle.dumps(key),))
+            self.__archived.discard(key)
+            return
+        archived = archive or key in self.__archived
+        data = self._dumps(document)
+        values = self.__column_values(document)
+        self.__database().execute(self.__upsert, (pickle.dumps(key), lzma.compress(data) if archived else data,
+                                                  archived, values is not None,
+                                                  ':'.join(self._class_name(document)),
+                                                  *(values or [None] * len(self.__columns))))
+
+    def __column_values(self, document) -> Optional[list]:
+        """
+        :return: the values of the indexed columns of a document, or None if they cannot all be stored
+        """
+        data = getattr(document, '_data', None)
+        if data is None:
+            return None  # Copied as unpickled, with a reference to a subclass instance stored in its own index
+        values = [self.__column_value(data.get(name)) for name in self.__columns]
+        return None if self.UNSUPPORTED in values else values
+
+    @classmethod
+    def __column_value(cls, value):
+        if isinstance(value, Enum):
+            value = value.value
+        if isinstance(value, date):
+            value = value.isoformat()
+        if value is None or isinstance(value, (str, int, float)):
+            return value
+        return cls.UNSUPPORTED
+
+    @staticmethod
+    def __quote(name: str) -> str:
+        return '"' + name.replace('"', '""') + '"'
+
+    def clear(self) -> None:
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+        super().clear()
+        self.__archived, self.__loaded = set(), set()
+
+    def _paths(self) -> list[str]:
+        return [self.database_path, f'{self.database_path}-journal']
+
+
+class MemoryStorage(Storage):
+    """
+    Lazy storage keeping each pickled document in memory, without any file I/O, for example for tests.
+    Storages of the same path share their documents for the lifetime of the process.
+    Documents are pickled when saved and unpickled when loaded as with the storages on disk,
+    so reloading an index discards unsaved changes and creates new instances.
+    """
+    lazy = True
+    archiving = True
+    # {path: ({key: pickled document}, archived keys, {key: class of the document})}
+    __stores: dict[str, tuple[dict, set, dict]] = {}
+
+    def __init__(self, document_type: Type[IndexedDocument], path: str = None):
+        super().__init__(document_type, path)
+        self.__documents, self.__archived, self.__classes = self.__stores.setdefault(self.path, ({}, set(), {}))
+        self.__loaded = set()  # Keys of the documents loaded or written since loading
+
+    def load(self) -> dict:
+        self.__loaded = set()
+        return {}
+
+    def keys(self) -> Iterable:
+        return list(self.__documents)
+
+    def archived_keys(self) -> Iterable:
+        return list(self.__archived)
+
+    def stored_classes(self) -> dict:
+        return dict(self.__classes)
+
+    def load_document(self, key) -> Optional[Any]:
+        if key in self.__documents:
+            self.__loaded.add(key)
+        return self.read_document(key)
+
+    def read_document(self, key) -> Optional[Any]:
+        data = self.__documents.get(key)
+        if data is None:
+            return None
+        return self._loads(data)
+
+    def archive(self, document: IndexedDocument) -> None:
+        self.__write(document.key, document)
+        self.__archived.add(document.key)
+
+    def save(self, objects: dict, documents: Iterable[IndexedDocument], deleted: Collection = ()) -> None:
+        for key, current in self._changes(objects, documents, deleted):
+            self.__write(key, current)
+
+    def compact(self, objects: dict) -> None:
+        for key in [key for key in self.__documents if key in self.__loaded and key not in objects]:
+            self.__write(key, None)
+        for key, document in objects.items():
+            self.__write(key, document)
+
+    def __write(self, key, document: Optional[IndexedDocument]) -> None:
+        self.__loaded.add(key)
+        if document is None:
+            self.__documents.pop(key, None)
+            self.__archived.discard(key)
+            self.__classes.pop(key, None)
+        else:
+            self.__documents[key] = self._dumps(document)
+            self.__classes[key] = self._class_name(document)
+
+    def clear(self) -> None:
+        self.__documents.clear()
+        self.__archived.clear()
+        self.__classes.clear()
+        self.__loaded = set()
+
+
+STORAGE_MODES = {
+    'snapshot': SnapshotStorage,
+    'log': LogStorage,
+    'paged': PagedStorage,
+    'partitioned': PartitionedStorage,
+    'sqlite': SqliteStorage,
+    'memory': MemoryStorage,
+}
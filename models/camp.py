@@ -6,14 +6,21 @@ from models.volunteer import Volunteer
 
 class Camp(Document):
     name = Field(primary_key=True)
-    volunteers = ReferenceDocumentsField(data_type=Volunteer)
-    refugees = ReferenceDocumentsField(data_type=Refugee)
+    volunteers = ReferenceDocumentsField(data_type=Volunteer, single_owner=True)
+    refugees = ReferenceDocumentsField(data_type=Refugee, single_owner=True)
+    __num_of_volunteers = None  # Active volunteers, once counted
+    __num_of_refugees = None  # Refugees including family members, once counted
 
     class InvalidName(Exception):
 
         def __init__(self, name):
             super().__init__(f'Invalid name: "{name}"')
 
+    class CountMismatchError(Exception):
+
+        def __init__(self, name, counted, count, recount):
+            super().__init__(f'Camp "{name}" counts {count} {counted} but has {recount}')
+
     def __init__(self, name: str):
         if not name:
             raise self.InvalidName(name)
@@ -25,21 +32,79 @@ class Camp(Document):
     @property
     def plan(self):
         from models.plan import Plan
-        return self.find_referred_by(referrer_type=Plan)
+        return self.find_owner(Plan.camps)
 
     def count_volunteers(self) -> int:
         """
         Function to find the number of active volunteers at a camp.
         If a volunteer is not active then they will not be included in the count.
+        The count is maintained as volunteers join, leave or change status, after it is first computed.
         """
-        volunteer_count = sum([1 for volunteer in self.volunteers
-                               if volunteer.availability and volunteer.account_activated])
-        return volunteer_count
+        if self.__num_of_volunteers is None:
+            self.__num_of_volunteers = self.recount_volunteers()
+        return self.__num_of_volunteers
 
     def count_refugees(self) -> int:
         """
         Function to find the number of refugees at a camp.
         Includes the count of both the head of family and the family members in a single count.
+        The count is maintained as refugees join, leave or change family size, after it is first computed.
+        """
+        if self.__num_of_refugees is None:
+            self.__num_of_refugees = self.recount_refugees()
+        return self.__num_of_refugees
+
+    def recount_volunteers(self) -> int:
+        """
+        Count the active volunteers by checking every volunteer at the camp.
+        """
+        return sum([1 for volunteer in self.volunteers if self.__is_active(volunteer)])
+
+    def recount_refugees(self) -> int:
+        """
+        Count the refugees by adding up the families of every refugee at the camp.
         """
-        refugee_count = sum([refugee.num_of_family_member for refugee in self.refugees])
-        return refugee_count
+        return sum([refugee.num_of_family_member for refugee in self.refugees])
+
+    def check_counts(self) -> None:
+        """
+        Check that the maintained counts match a full recount.
+        CountMismatchError is raised otherwise.
+        """
+        for name, count, recount in (('volunteers', self.__num_of_volunteers, self.recount_volunteers),
+                                     ('refugees', self.__num_of_refugees, self.recount_refugees)):
+            if count is not None and count != recount():
+                raise self.CountMismatchError(self.name, name, count, recount())
+
+    @staticmethod
+    def __is_active(volunteer: Volunteer) -> bool:
+        return bool(volunteer.availability and volunteer.account_activated)
+
+    def _referee_added(self, field_name: str, document) -> None:
+        if field_name == 'refugees' and self.__num_of_refugees is not None:
+            self.__num_of_refugees += document.num_of_family_member
+        elif field_name == 'volunteers' and self.__num_of_volunteers is not None:
+            self.__num_of_volunteers += self.__is_active(document)
+
+    def _referee_removed(self, field_name: str, document) -> None:
+        if field_name == 'refugees' and self.__num_of_refugees is not None:
+            self.__num_of_refugees -= document.num_of_family_member
+        elif field_name == 'volunteers' and self.__num_of_volunteers is not None:
+            self.__num_of_volunteers -= self.__is_active(document)
+
+    def _referee_changed(self, document, field_name: str, old_value, new_value) -> None:
+        if isinstance(document, Refugee) and field_name == 'num_of_family_member':
+            if self.__num_of_refugees is not None:
+                self.__num_of_refugees += new_value - old_value
+        elif isinstance(document, Volunteer) and field_name in ('availability', 'account_activated'):
+            if self.__num_of_volunteers is not None:
+                other_field_name = 'account_activated' if field_name == 'availability' else 'availability'
+                was_active = bool(old_value and getattr(document, other_field_name))
+                self.__num_of_volunteers += self.__is_active(document) - was_active
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # The counts are recomputed after loading, as the referenced documents are relinked while loading
+        state.pop('_Camp__num_of_volunteers', None)
+        state.pop('_Camp__num_of_refugees', None)
+        return state
@@ -1,6 +1,6 @@
 from datetime import date, datetime
 from enum import Enum
-from typing import Iterable, Union
+from typing import Iterable, Union, Iterator
 import math
 
 from models.base.document import IndexedDocument
@@ -13,15 +13,17 @@ class Plan(IndexedDocument):
     An emergency plan consisting of camps.
     """
     TARGET_REFUGEE_VOLUNTEER_RATIO = 20  # The target ratio of refugee volunteers to volunteers.
+    # Plans embed all camps and refugees, so each plan is saved to its own segment and loaded when needed.
+    _storage_mode = 'partitioned'
 
     name = Field(primary_key=True)
-    emergency = Field()
+    emergency = Field(index=True)
     description = Field()
     geographical_area = Field()
-    __start_date = Field()
+    __start_date = Field(index='sorted')
     __is_closed = Field()
-    __close_date = Field()
-    camps = ReferenceDocumentsField(data_type=Camp)
+    __close_date = Field(index='sorted')
+    camps = ReferenceDocumentsField(data_type=Camp, single_owner=True)
 
     class EmergencyType(Enum):
         """
@@ -85,6 +87,26 @@ class Plan(IndexedDocument):
                          _Plan__is_closed=False,
                          camps=camps)
 
+    @classmethod
+    def started_between(cls, start: date = None, end: date = None) -> Iterator['Plan']:
+        """
+        Iterate over the plans started from the start date until the end date (both inclusive), by start date.
+        :param start: the earliest start date, or None for no lower bound
+        :param end: the latest start date, or None for no upper bound
+        """
+        return cls.find_range('_Plan__start_date', start, end, include_high=True)
+
+    @classmethod
+    def closed_between(cls, start: date = None, end: date = None) -> Iterator['Plan']:
+        """
+        Iterate over the plans closed from the start date until the end date (both inclusive), by close date.
+        Archived plans are loaded to find them.
+        :param start: the earliest close date, or None for no lower bound
+        :param end: the latest close date, or None for no upper bound
+        """
+        cls.load_all(include_archived=True)
+        return cls.find_range('_Plan__close_date', start, end, include_high=True)
+
     @property
     def start_date(self) -> date:
         """
@@ -127,10 +149,13 @@ class Plan(IndexedDocument):
     def close(self):
         """
         Set __is_closed flag to be True if plan is closed.
+        The closed plan is moved to the archive, so that it is no longer loaded with the open plans,
+        if the storage mode of plans has an archive tier.
         """
         self.__is_closed = True
         self.__close_date = datetime.today().date()
         self.save()
+        self.archive()
 
     @property
     def close_date(self) -> Union[date, None]:
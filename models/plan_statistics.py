@@ -0,0 +1,97 @@
+from typing import Iterable, Optional
+
+from models.plan import Plan
+
+
+class PlanStatistics:
+    """
+    Statistics of the camps of many plans, for a dashboard across plans.
+    The camps are extracted once into columns, one entry per camp, and each statistic is computed
+    over whole columns: the volunteers compared with the standard, totals grouped by plan, emergency type
+    or geographical area, and rankings of the camps needing volunteers.
+    """
+    GROUP_COLUMNS = ('plan_name', 'emergency', 'geographical_area')
+
+    class InvalidColumnError(Exception):
+        def __init__(self, column):
+            super().__init__(f'Statistics cannot be grouped by "{column}"')
+
+    def __init__(self, plans: Iterable[Plan] = None):
+        """
+        Extract the camps of the plans.
+        :param plans: the plans to include, all plans by default
+        """
+        self.plan_name: list[str] = []
+        self.emergency: list[Plan.EmergencyType] = []
+        self.geographical_area: list[str] = []
+        self.camp_name: list[str] = []
+        self.num_of_refugees: list[int] = []
+        self.num_of_volunteers: list[int] = []
+        self.__plan_rows: dict[str, range] = {}  # Camps of each plan are extracted next to each other
+        for plan in Plan.all() if plans is None else plans:
+            start = len(self.camp_name)
+            for camp in plan.camps:
+                self.plan_name.append(plan.name)
+                self.emergency.append(plan.emergency)
+                self.geographical_area.append(plan.geographical_area)
+                self.camp_name.append(camp.name)
+                self.num_of_refugees.append(camp.count_refugees())
+                self.num_of_volunteers.append(camp.count_volunteers())
+            self.__plan_rows[plan.name] = range(start, len(self.camp_name))
+        ratio = Plan.TARGET_REFUGEE_VOLUNTEER_RATIO
+        # Rounded up as in Plan.statistics, with integer division to stay exact for any number of refugees
+        self.num_of_ideal_volunteers = [-(-num_of_refugees // ratio) for num_of_refugees in self.num_of_refugees]
+        self.num_volunteers_vs_standard = [num_of_volunteers - num_of_ideal_volunteers
+                                           for num_of_volunteers, num_of_ideal_volunteers
+                                           in zip(self.num_of_volunteers, self.num_of_ideal_volunteers)]
+
+    def __len__(self):
+        return len(self.camp_name)
+
+    def plan_statistics(self, plan_name: str) -> dict:
+        """
+        Get the statistics of the camps in a plan, in the format of Plan.statistics.
+        :return: {'Camp': {'num_of_refugees': int, 'num_of_volunteers': int, 'num_volunteers_vs_standard': int}}
+        """
+        return {self.camp_name[row]: {'num_of_refugees': self.num_of_refugees[row],
+                                      'num_of_volunteers': self.num_of_volunteers[row],
+                                      'num_volunteers_vs_standard': self.num_volunteers_vs_standard[row]}
+                for row in self.__plan_rows.get(plan_name, ())}
+
+    def totals_by(self, column: str) -> dict:
+        """
+        Add up the statistics of the camps by plan name, emergency type or geographical area.
+        :param column: one of GROUP_COLUMNS
+        :return: {group: {'num_of_camps': int, 'num_of_refugees': int, 'num_of_volunteers': int,
+                          'num_volunteers_vs_standard': int, 'num_of_volunteers_needed': int}}
+                 where the volunteers needed only add up the camps with fewer volunteers than the standard.
+        """
+        if column not in self.GROUP_COLUMNS:
+            raise self.InvalidColumnError(column)
+        totals = {}
+        for group, num_of_refugees, num_of_volunteers, num_volunteers_vs_standard in zip(
+                getattr(self, column), self.num_of_refugees, self.num_of_volunteers,
+                self.num_volunteers_vs_standard):
+            total = totals.get(group)
+            if total is None:
+                total = totals[group] = {'num_of_camps': 0, 'num_of_refugees': 0, 'num_of_volunteers': 0,
+                                         'num_volunteers_vs_standard': 0, 'num_of_volunteers_needed': 0}
+            total['num_of_camps'] += 1
+            total['num_of_refugees'] += num_of_refugees
+            total['num_of_volunteers'] += num_of_volunteers
+            total['num_volunteers_vs_standard'] += num_volunteers_vs_standard
+            total['num_of_volunteers_needed'] += max(-num_volunteers_vs_standard, 0)
+        return totals
+
+    def neediest_camps(self, limit: Optional[int] = None) -> list[tuple[str, str, int]]:
+        """
+        Rank the camps with fewer volunteers than the standard, the largest shortfall first.
+        :param limit: the maximum number of camps to return, or None for all of them
+        :return: [(plan name, camp name, num_volunteers_vs_standard)]
+        """
+        rows = sorted((row for row, num_volunteers_vs_standard in enumerate(self.num_volunteers_vs_standard)
+                       if num_volunteers_vs_standard < 0),
+                      key=lambda row: (self.num_volunteers_vs_standard[row], self.plan_name[row],
+                                       self.camp_name[row]))
+        return [(self.plan_name[row], self.camp_name[row], self.num_volunteers_vs_standard[row])
+                for row in rows[:limit]]
@@ -34,11 +34,13 @@ class Refugee(Document):
         TUBERCULOSIS = "Tuberculosis"
         OTHERS = "Others"
 
+    _global_index = True  # Find refugees by user_id across all plans and camps
+
     user_id = Field(primary_key=True)
     firstname = Field()
-    lastname = Field()
-    num_of_family_member = Field()
-    starting_date = Field()
+    lastname = Field(index=True)
+    num_of_family_member = Field(index='sorted')
+    starting_date = Field(index='sorted')
     medical_condition_type = Field()
 
     def __init__(self,
@@ -113,13 +115,15 @@ class Refugee(Document):
     @property
     def camp(self):
         from models.camp import Camp
-        return self.find_referred_by(referrer_type=Camp)
+        return self.find_owner(Camp.refugees)
 
     def __str__(self):
-        return f"Refugee family {self.firstname} {self.lastname} located in {self.camp}.\n" \
+        camp = self.camp
+        plan = camp.plan
+        return f"Refugee family {self.firstname} {self.lastname} located in {camp}.\n" \
                f"Number of Family Member: {self.num_of_family_member}\n" \
-               f"Camp: '{self.camp.name}'\n" \
-               f"Plan: '{self.camp.plan.name}' {'(Closed)' if self.camp.plan.is_closed else ''}\n" \
+               f"Camp: '{camp.name}'\n" \
+               f"Plan: '{plan.name}' {'(Closed)' if plan.is_closed else ''}\n" \
                f"Creation Date: {self.starting_date}\n" \
                f"Medical Condition: " \
                f"{', '.join([condition.value for condition in self.medical_condition_type]) or 'None'}\n"
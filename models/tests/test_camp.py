@@ -259,3 +259,107 @@ class RefugeeInCampTest(unittest.TestCase):
 
         self.assertEqual(refugee_count_camp1, 0)
         self.assertEqual(refugee_count_camp2, 7)
+
+
+class CampNavigationTest(unittest.TestCase):
+    """
+    Class for testing the parent pointers between plans, camps, refugees and volunteers.
+    """
+
+    def setUp(self):
+        Plan.delete_all()
+        Volunteer.delete_all()
+
+    def tearDown(self):
+        Plan.delete_all()
+        Volunteer.delete_all()
+
+    def test_navigation_after_reload(self):
+        camp = Camp(name='camp1')
+        Plan(name='test_plan',
+             emergency_type=Plan.EmergencyType.EARTHQUAKE,
+             description='Test emergency plan',
+             geographical_area='London',
+             camps=[camp])
+        refugee = Refugee(firstname='Tom', lastname='Bond', num_of_family_member=2, starting_date=date(2020, 1, 2))
+        volunteer = Volunteer(username='William', password='root', firstname='William', lastname='Yin',
+                              phone='+447519953189')
+        camp.refugees.add(refugee)
+        camp.volunteers.add(volunteer)
+        Plan.reload()
+        plan = Plan.find('test_plan')
+        camp = plan.camps.get('camp1')
+        self.assertIs(camp.plan, plan)
+        self.assertIs(camp.refugees.get(refugee.user_id).camp, camp)
+        self.assertIs(Volunteer.find('William').camp, camp)
+
+
+class CampCountTest(unittest.TestCase):
+    """
+    Class for testing that maintained camp counts match a full recount.
+    """
+
+    def setUp(self):
+        Plan.delete_all()
+        Volunteer.delete_all()
+        self.camp = Camp(name='camp1')
+        Plan(name='test_plan',
+             emergency_type=Plan.EmergencyType.EARTHQUAKE,
+             description='Test emergency plan',
+             geographical_area='London',
+             camps=[self.camp])
+        # Count before any changes, so that the changes below update the counts
+        self.assertEqual((self.camp.count_refugees(), self.camp.count_volunteers()), (0, 0))
+
+    def tearDown(self):
+        Plan.delete_all()
+        Volunteer.delete_all()
+
+    def test_refugee_changes(self):
+        refugee_1 = Refugee(firstname='Tom', lastname='Bond', num_of_family_member=2, starting_date=date(2020, 1, 2))
+        refugee_2 = Refugee(firstname='Tim', lastname='Bond', num_of_family_member=5, starting_date=date(2020, 1, 2))
+        self.camp.refugees.add(refugee_1, refugee_2)
+        self.assertEqual(self.camp.count_refugees(), 7)
+        refugee_1.num_of_family_member = 4
+        self.assertEqual(self.camp.count_refugees(), 9)
+        self.camp.refugees.remove(refugee_2)
+        self.assertEqual(self.camp.count_refugees(), 4)
+        refugee_2.num_of_family_member = 1  # No longer at the camp
+        refugee_1.delete()
+        self.assertEqual(self.camp.count_refugees(), 0)
+        self.camp.check_counts()
+
+    def test_volunteer_changes(self):
+        volunteer_a = Volunteer(username='William', password='root', firstname='William', lastname='Yin',
+                                phone='+447519953189')
+        volunteer_b = Volunteer(username='Mary', password='root', firstname='Mary', lastname='Shoemaker',
+                                phone='+447519955439')
+        self.camp.volunteers.add(volunteer_a, volunteer_b)
+        self.assertEqual(self.camp.count_volunteers(), 2)
+        volunteer_a.availability = False
+        volunteer_a.account_activated = False
+        self.assertEqual(self.camp.count_volunteers(), 1)
+        volunteer_a.availability = True
+        self.assertEqual(self.camp.count_volunteers(), 1)
+        volunteer_a.account_activated = True
+        self.assertEqual(self.camp.count_volunteers(), 2)
+        volunteer_b.delete()
+        self.assertEqual(self.camp.count_volunteers(), 1)
+        self.camp.check_counts()
+
+    def test_counts_after_reload(self):
+        self.camp.refugees.add(Refugee(firstname='Tom', lastname='Bond', num_of_family_member=3,
+                                       starting_date=date(2020, 1, 2)))
+        Plan.reload()
+        camp = Plan.find('test_plan').camps.get('camp1')
+        self.assertEqual(camp.count_refugees(), 3)
+        camp.refugees.get(next(iter(camp.refugees)).user_id).num_of_family_member = 1
+        self.assertEqual(camp.count_refugees(), 1)
+        camp.check_counts()
+
+    def test_check_counts(self):
+        refugee = Refugee(firstname='Tom', lastname='Bond', num_of_family_member=3, starting_date=date(2020, 1, 2))
+        self.camp.refugees.add(refugee)
+        refugee._data['num_of_family_member'] = 1  # Bypasses the field
+        with self.assertRaises(Camp.CountMismatchError):
+            self.camp.check_counts()
@@ -1,76 +1,215 @@
+import ast
+import gc
+import glob
+import os
+import random
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from datetime import date
+from decimal import Decimal
+from enum import Enum
+from typing import Optional
 from unittest import TestCase
+from unittest.mock import patch
 
+from models.base.codec import DocumentCodec
 from models.base.document import IndexedDocument, Document
 from models.base.field import Field, ReferenceDocumentsField, ReferenceSet
 from models.base.meta_document import MetaDocument
+from models.base.query import Query
+from models.base.storage import SnapshotStorage, LogStorage, PagedStorage, PartitionedStorage, SqliteStorage
+
+
+def remove_files(*document_types) -> None:
+    """
+    Delete all documents of demo classes, and remove their files in any storage mode,
+    so that tests leave no files behind.
+    """
+    for document_type in document_types:
+        document_type.delete_all()
+    for document_type in document_types:
+        path = document_type._persistence_path
+        for file_path in [path, *glob.glob(f'{glob.escape(path)}.*')]:
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+            elif os.path.exists(file_path):
+                os.remove(file_path)
 
 
 class MetaDocumentTest(TestCase):
+    class DemoRegisteredDocument(IndexedDocument):
+        id = Field(primary_key=True)
+
     def test_multiple_primary_key(self):
         with self.assertRaises(MetaDocument.MultiplePrimaryKeyError):
             class DemoIndexedDocument(IndexedDocument):
                 id = Field(primary_key=True)
                 name = Field(primary_key=True)
 
+    def test_find_class(self):
+        with patch('pickle._getattribute') as getattribute:
+            self.assertIs(MetaDocument.find_class(__name__, 'MetaDocumentTest.DemoRegisteredDocument'),
+                          self.DemoRegisteredDocument)
+        getattribute.assert_not_called()
+        self.assertIs(MetaDocument.find_class('datetime', 'date'), date)  # Not a document class
+
+    def test_restore_all(self):
+        self.DemoRegisteredDocument.delete_all()
+        documents = [self.DemoRegisteredDocument(id=i) for i in range(3)]
+        references = [IndexedDocument.DeferredReference(__name__, 'MetaDocumentTest.DemoRegisteredDocument', key)
+                      for key in (2, 0, 5, 2)]
+        self.assertEqual(IndexedDocument.DeferredReference.restore_all(references),
+                         [documents[2], documents[0], None, documents[2]])
+        self.DemoRegisteredDocument.delete_all()
+
 
 class BasicDocumentTest(TestCase):
-    class DemoIndexedDocument(IndexedDocument):
+    class DemoBasicDocument(IndexedDocument):
         name = Field(primary_key=True)
         password = Field()
 
     def setUp(self) -> None:
-        self.DemoIndexedDocument.delete_all()
+        self.DemoBasicDocument.delete_all()
 
     def test_create_document(self):
-        doc = self.DemoIndexedDocument(name='test', password='test')
+        doc = self.DemoBasicDocument(name='test', password='test')
         self.assertEqual(doc.name, 'test')
         self.assertEqual(doc.password, 'test')
 
     def test_compulsory_primary_key(self):
         with self.assertRaises(Document.PrimaryKeyNotSetError):
-            self.DemoIndexedDocument(password='test')
+            self.DemoBasicDocument(password='test')
 
     def test_duplicate_primary_key(self):
-        self.DemoIndexedDocument(name='test_duplicate', password='test1')
+        self.DemoBasicDocument(name='test_duplicate', password='test1')
         with self.assertRaises(Document.DuplicateKeyError):
-            self.DemoIndexedDocument(name='test_duplicate', password='test2')
+            self.DemoBasicDocument(name='test_duplicate', password='test2')
 
     def tearDown(self) -> None:
-        self.DemoIndexedDocument.delete_all()
+        remove_files(self.DemoBasicDocument)
 
 
 class DocumentPersistenceTest(TestCase):
-    class DemoIndexedDocument(IndexedDocument):
+    class DemoPersistedDocument(IndexedDocument):
         id = Field(primary_key=True)
         name = Field()
 
     def setUp(self) -> None:
-        self.DemoIndexedDocument.delete_all()
-        self.DemoIndexedDocument(id=1, name='a')
-        self.DemoIndexedDocument(id=2, name='b')
-        self.DemoIndexedDocument(id=3, name='c')
+        self.DemoPersistedDocument.delete_all()
+        self.DemoPersistedDocument(id=1, name='a')
+        self.DemoPersistedDocument(id=2, name='b')
+        self.DemoPersistedDocument(id=3, name='c')
 
     def test_persistence(self):
-        self.DemoIndexedDocument.reload()
-        self.assertEqual(len(self.DemoIndexedDocument.all()), 3)
+        self.DemoPersistedDocument.reload()
+        self.assertEqual(len(self.DemoPersistedDocument.all()), 3)
 
     def test_find(self):
-        document = self.DemoIndexedDocument.find(1)
+        document = self.DemoPersistedDocument.find(1)
         self.assertEqual(document.name, 'a')
-        document = self.DemoIndexedDocument.find(10)
+        document = self.DemoPersistedDocument.find(10)
         self.assertIsNone(document)
 
     def test_delete(self):
-        self.DemoIndexedDocument(id=4, name='d')
-        document = self.DemoIndexedDocument.find(4)
+        self.DemoPersistedDocument(id=4, name='d')
+        document = self.DemoPersistedDocument.find(4)
         self.assertIsNotNone(document)
         document.delete()
-        self.DemoIndexedDocument.reload()
-        document = self.DemoIndexedDocument.find(4)
+        self.DemoPersistedDocument.reload()
+        document = self.DemoPersistedDocument.find(4)
         self.assertIsNone(document)
 
     def tearDown(self) -> None:
-        self.DemoIndexedDocument.delete_all()
+        remove_files(self.DemoPersistedDocument)
+
+
+class SubclassStorageTest(TestCase):
+    class DemoPerson(IndexedDocument):
+        id = Field(primary_key=True)
+        name = Field(index=True)
+
+    class DemoStaff(DemoPerson):
+        role = Field(index=True)
+
+    class DemoGuest(DemoPerson):
+        pass
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+        self.DemoPerson.reload()  # In the storage mode of the class, if replaced by a previous test
+        self.DemoPerson.delete_all()
+
+    def test_single_storage(self):
+        self.assertIs(self.DemoStaff._storage_class, self.DemoPerson)
+        self.assertEqual(self.DemoStaff._persistence_path, self.DemoPerson._persistence_path)
+        with patch.object(SnapshotStorage, 'compact', autospec=True, side_effect=SnapshotStorage.compact) as compact:
+            self.DemoStaff(id=1, name='a', role='cook')
+        self.assertEqual([storage.document_type for (storage, _), _ in compact.call_args_list], [self.DemoPerson])
+        self.assertTrue(os.path.exists(self.DemoPerson._persistence_path))
+        self.assertFalse(os.path.exists(self.DemoStaff._separate_persistence_path))
+
+    def test_polymorphic_views(self):
+        for storage_mode in ('snapshot', 'log', 'paged', 'partitioned', 'sqlite'):
+            with self.subTest(storage_mode=storage_mode), \
+                    patch.object(self.DemoPerson, '_storage_mode', storage_mode):
+                self.DemoPerson.reload()
+                self.DemoPerson.delete_all()
+                self.DemoPerson(id=1, name='a')
+                self.DemoStaff(id=2, name='a', role='cook')
+                self.DemoGuest(id=3, name='b')
+                for index in (self.DemoStaff, self.DemoPerson):
+                    index.reload()
+                staff = self.DemoPerson.find(2)
+                self.assertIsInstance(staff, self.DemoStaff)
+                self.assertIs(self.DemoStaff.find(2), staff)
+                self.assertIsNone(self.DemoStaff.find(3))
+                self.assertEqual({person.id for person in self.DemoPerson.find_by(name='a')}, {1, 2})
+                self.assertEqual(self.DemoStaff.find_by(role='cook'), [staff])
+                self.assertEqual({person.id for person in self.DemoPerson.all()}, {1, 2, 3})
+                self.assertEqual([guest.id for guest in self.DemoGuest.all()], [3])
+                with self.assertRaises(Document.DuplicateKeyError):
+                    self.DemoGuest(id=2, name='c')
+                self.DemoPerson.delete_all()
+
+    def test_delete_all_subclass(self):
+        self.DemoPerson(id=1, name='a')
+        self.DemoStaff(id=2, name='a', role='cook')
+        self.DemoGuest(id=3, name='b')
+        self.DemoStaff.delete_all()
+        self.DemoPerson.reload()
+        self.assertEqual({person.id for person in self.DemoPerson.all()}, {1, 3})
+        self.assertEqual([person.id for person in self.DemoPerson.find_by(name='a')], [1])
+        self.assertEqual(self.DemoStaff.all(), [])
+
+    def test_separately_stored_subclass_moved(self):
+        for storage_type in (SnapshotStorage, PagedStorage):
+            with self.subTest(storage_mode=storage_type.__name__), \
+                    patch.object(self.DemoPerson, '_storage_mode', 'snapshot' if storage_type is SnapshotStorage
+                                 else 'paged'):
+                self.DemoPerson.reload()
+                self.DemoPerson.delete_all()
+                person = self.DemoPerson(id=1, name='a')
+                staff = self.DemoStaff(id=2, name='a', role='cook')
+                self.DemoPerson.delete_all()
+                # As stored by earlier versions, with a reference to the subclass instance stored in its own files
+                reference = IndexedDocument.DeferredReference(__name__, 'SubclassStorageTest.DemoStaff', 2)
+                storage_type(self.DemoPerson).save({1: person, 2: reference}, [person, reference])
+                separate = storage_type(self.DemoPerson, self.DemoStaff._separate_persistence_path)
+                separate.save({2: staff}, [staff])
+                self.DemoPerson.reload()
+                self.assertEqual(self.DemoStaff.find(2).role, 'cook')
+                self.assertEqual(self.DemoPerson.find(1).name, 'a')
+                self.assertFalse(any(os.path.exists(path) for path in separate._paths()))
+                self.DemoPerson.reload()
+                self.assertEqual({person.id for person in self.DemoPerson.all()}, {1, 2})
+                self.assertEqual(self.DemoStaff.find_by(role='cook'), [self.DemoPerson.find(2)])
+                self.DemoPerson.delete_all()
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoPerson)
 
 
 class DocumentReferenceTest(TestCase):
@@ -81,6 +220,9 @@ class DocumentReferenceTest(TestCase):
         name = Field(primary_key=True)
         children = ReferenceDocumentsField()
 
+    class DemoMiddleDocument(Document):
+        children = ReferenceDocumentsField()
+
     def setUp(self) -> None:
         self.DemoNestedDocument.delete_all()
         children = [
@@ -158,6 +300,19 @@ class DocumentReferenceTest(TestCase):
         for referee in document.children:
             self.assertFalse(root_referee in referee.children)
 
+    def test_reload_restores_references_in_place(self):
+        other = self.DemoNestedDocument(name='test_1', children=[])
+        middle = self.DemoMiddleDocument(children=[])
+        self.DemoNestedDocument(name='test_2', children=[middle])
+        middle.children.add(other)
+        with patch.object(ReferenceDocumentsField, '__set__') as set_field:
+            self.DemoNestedDocument.reload()
+        set_field.assert_not_called()
+        middle, = self.DemoNestedDocument.find('test_2').children
+        self.assertEqual(list(middle.children), [self.DemoNestedDocument.find('test_1')])
+        self.assertIs(next(iter(middle.children)).find_referred_by(self.DemoMiddleDocument, 'children'), middle)
+        self.assertEqual(len(self.DemoNestedDocument.find('test').children), 3)
+
     def test_typed_reference_field(self):
         """
         Test that type checking is enforced when defining ReferenceDocumentsField with a specific data_type.
@@ -181,6 +336,30 @@ class DocumentReferenceTest(TestCase):
         with self.assertRaises(Document.ReferrerNotFound):
             referee.find_referred_by(referrer_type=self.DemoNestedDocument, field_name='children')
 
+    def test_caching_roots(self):
+        referee = self.DemoDocument(name='e')
+        middle = self.DemoMiddleDocument(children=[referee])
+        first_root = self.DemoNestedDocument(name='test_1', children=[middle])
+        second_root = self.DemoNestedDocument(name='test_2', children=[])
+        with Document._caching_roots():
+            self.assertIs(referee._get_root_document(), first_root)
+            first_root.children.remove(middle)
+            second_root.children.add(middle)
+            self.assertIs(referee._get_root_document(), first_root)  # Cached until the end of the pass
+        self.assertIs(referee._get_root_document(), second_root)
+
+    def test_roots_walked_once_when_persisted(self):
+        self.document.delete()
+        middle = self.DemoMiddleDocument(children=[self.DemoDocument(name=name) for name in 'def'])
+        root = self.DemoNestedDocument(name='test_1', children=[middle])
+        with patch.object(self.DemoNestedDocument, '_get_root_document', autospec=True,
+                          side_effect=IndexedDocument._get_root_document) as get_root:
+            self.DemoNestedDocument._persist(root)
+        self.assertEqual(get_root.call_count, 2)  # From the middle document, and once for all its children
+        self.DemoNestedDocument.reload()
+        children = self.DemoNestedDocument.find('test_1').children
+        self.assertEqual(sorted(child.name for child in next(iter(children)).children), ['d', 'e', 'f'])
+
     def test_add_duplicate_referee(self):
         class KeyedReferee(Document):
             name = Field(primary_key=True)
@@ -191,4 +370,1435 @@ class DocumentReferenceTest(TestCase):
             self.DemoNestedDocument(name='test', children=[referee_1, referee_2])
 
     def tearDown(self) -> None:
-        self.DemoNestedDocument.delete_all()
+        remove_files(self.DemoNestedDocument)
+
+
+class DocumentLogStorageTest(TestCase):
+    class DemoLoggedEntry(Document):
+        name = Field(primary_key=True)
+        value = Field()
+
+    class DemoLoggedDocument(IndexedDocument):
+        _storage_mode = 'log'
+        _log_compaction_min_size = 2048
+        id = Field(primary_key=True)
+        name = Field()
+        children = ReferenceDocumentsField()
+        entries = ReferenceDocumentsField()
+
+    class DemoReferencedDocument(IndexedDocument):
+        id = Field(primary_key=True)
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+        self.DemoLoggedDocument.delete_all()
+        self.DemoReferencedDocument.delete_all()
+        self.log_path = f'{self.DemoLoggedDocument._persistence_path}.log'
+
+    def test_changes_appended_to_log(self):
+        self.DemoLoggedDocument(id=1, name='a', children=[])
+        document = self.DemoLoggedDocument(id=2, name='b', children=[])
+        self.assertTrue(os.path.exists(self.log_path))
+        self.assertFalse(os.path.exists(self.DemoLoggedDocument._persistence_path))
+        document.name = 'c'
+        document.save()
+        self.DemoLoggedDocument.reload()
+        self.assertEqual(len(self.DemoLoggedDocument.all()), 2)
+        self.assertEqual(self.DemoLoggedDocument.find(2).name, 'c')
+
+    def test_delete_replayed(self):
+        self.DemoLoggedDocument(id=1, name='a', children=[])
+        self.DemoLoggedDocument(id=2, name='b', children=[]).delete()
+        self.DemoLoggedDocument.reload()
+        self.assertIsNotNone(self.DemoLoggedDocument.find(1))
+        self.assertIsNone(self.DemoLoggedDocument.find(2))
+
+    def test_compact(self):
+        self.DemoLoggedDocument(id=1, name='a', children=[])
+        self.DemoLoggedDocument.compact()
+        self.assertFalse(os.path.exists(self.log_path))
+        self.DemoLoggedDocument(id=2, name='b', children=[])
+        self.DemoLoggedDocument.reload()
+        self.assertEqual({1, 2}, {document.id for document in self.DemoLoggedDocument.all()})
+
+    def test_compaction_by_size(self):
+        document = self.DemoLoggedDocument(id=1, name='a', children=[])
+        while not os.path.exists(self.DemoLoggedDocument._persistence_path):
+            self.assertLess(os.path.getsize(self.log_path), self.DemoLoggedDocument._log_compaction_min_size)
+            document.name += 'a'
+            document.save()
+        self.assertFalse(os.path.exists(self.log_path))
+        self.DemoLoggedDocument.reload()
+        self.assertEqual(self.DemoLoggedDocument.find(1).name, document.name)
+
+    def test_changes_logged_instead_of_document(self):
+        document = self.DemoLoggedDocument(id=1, name='a', children=[], entries=[
+            self.DemoLoggedEntry(name=str(i), value=i) for i in range(1000)])
+        self.DemoLoggedDocument.compact()
+        snapshot_size = os.path.getsize(self.DemoLoggedDocument._persistence_path)
+        document.entries.get('7').value = 'changed'
+        document.entries.get('7').save()
+        document.entries.add(self.DemoLoggedEntry(name='new', value=0))
+        document.entries.remove(document.entries.get('8'))
+        self.assertLess(os.path.getsize(self.log_path) * 10, snapshot_size)
+        self.DemoLoggedDocument.reload()
+        entries = self.DemoLoggedDocument.find(1).entries
+        self.assertEqual(entries.get('7').value, 'changed')
+        self.assertEqual(entries.get('new').value, 0)
+        self.assertIsNone(entries.get('8'))
+        self.assertEqual(len(entries), 1000)
+
+    def test_references_restored(self):
+        referee = self.DemoReferencedDocument(id=1)
+        sibling = self.DemoLoggedDocument(id=1, name='a', children=[])
+        self.DemoLoggedDocument.compact()
+        self.DemoLoggedDocument(id=2, name='b', children=[sibling])
+        self.DemoLoggedDocument(id=3, name='c', children=[referee])
+        sibling.name = 'd'
+        sibling.save()
+        self.DemoLoggedDocument.reload()
+        self.assertIs(self.DemoLoggedDocument.find(2).children.get(1), self.DemoLoggedDocument.find(1))
+        self.assertEqual(self.DemoLoggedDocument.find(2).children.get(1).name, 'd')
+        self.assertIs(self.DemoLoggedDocument.find(3).children.get(1), referee)
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoLoggedDocument, self.DemoReferencedDocument)
+
+
+class DocumentPagedStorageTest(TestCase):
+    class DemoPagedDocument(IndexedDocument):
+        _storage_mode = 'paged'
+        _log_compaction_threshold = 10
+        id = Field(primary_key=True)
+        name = Field(index=True)
+        children = ReferenceDocumentsField()
+        others = ReferenceDocumentsField()
+
+    class DemoOtherPagedDocument(IndexedDocument):
+        _storage_mode = 'paged'
+        id = Field(primary_key=True)
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+        self.DemoPagedDocument.delete_all()
+        self.DemoOtherPagedDocument.delete_all()
+        self.pages_path = f'{self.DemoPagedDocument._persistence_path}.pages'
+        self.offsets_path = f'{self.DemoPagedDocument._persistence_path}.offsets'
+
+    def test_documents_loaded_when_found(self):
+        for i in range(5):
+            self.DemoPagedDocument(id=i, name=str(i), children=[])
+        self.DemoPagedDocument.reload()
+        with patch.object(PagedStorage, 'load_document', autospec=True,
+                          side_effect=PagedStorage.load_document) as load_document:
+            self.assertEqual(self.DemoPagedDocument.find(3).name, '3')
+            self.assertIsNone(self.DemoPagedDocument.find(7))
+            self.assertEqual(load_document.call_count, 1)
+            self.assertEqual(len(self.DemoPagedDocument.find_by(name='1')), 1)
+            self.assertEqual(load_document.call_count, 5)
+
+    def test_referenced_documents_loaded(self):
+        other = self.DemoOtherPagedDocument(id=1)
+        sibling = self.DemoPagedDocument(id=1, name='a', children=[])
+        self.DemoPagedDocument(id=2, name='b', children=[sibling], others=[other])
+        self.DemoPagedDocument(id=3, name='c', children=[])
+        self.DemoPagedDocument.reload()
+        self.DemoOtherPagedDocument.reload()
+        with patch.object(PagedStorage, 'load_document', autospec=True,
+                          side_effect=PagedStorage.load_document) as load_document:
+            other = self.DemoOtherPagedDocument.find(1)
+            # Only the referring document and the documents it references are loaded
+            self.assertEqual(load_document.call_count, 3)
+        document = other.find_referred_by(self.DemoPagedDocument, 'others')
+        self.assertEqual(document.id, 2)
+        self.assertIs(document.children.get(1), self.DemoPagedDocument.find(1))
+
+    def test_changes_appended(self):
+        document = self.DemoPagedDocument(id=1, name='a', children=[])
+        self.DemoPagedDocument(id=2, name='b', children=[])
+        size = os.path.getsize(self.pages_path)
+        document.name = 'c'
+        document.save()
+        self.assertGreater(os.path.getsize(self.pages_path), size)
+        self.DemoPagedDocument(id=3, name='d', children=[]).delete()
+        self.DemoPagedDocument.reload()
+        self.assertEqual(self.DemoPagedDocument.find(1).name, 'c')
+        self.assertEqual({document.id for document in self.DemoPagedDocument.all()}, {1, 2})
+
+    def test_offsets_rebuilt(self):
+        self.DemoPagedDocument(id=1, name='a', children=[])
+        self.DemoPagedDocument(id=2, name='b', children=[])
+        os.remove(self.offsets_path)
+        with open(self.pages_path, 'ab') as f:
+            f.write(b'\x00\x00')  # Interrupted write
+        self.DemoPagedDocument.reload()
+        self.assertEqual(self.DemoPagedDocument.find(2).name, 'b')
+        self.DemoPagedDocument(id=3, name='c', children=[])
+        self.DemoPagedDocument.reload()
+        self.assertEqual(len(self.DemoPagedDocument.all()), 3)
+
+    def test_compaction_copies_unloaded_documents(self):
+        self.DemoPagedDocument(id=1, name='a', children=[])
+        document = self.DemoPagedDocument(id=2, name='b', children=[])
+        for i in range(self.DemoPagedDocument._log_compaction_threshold - 1):
+            document.name = str(i)
+            document.save()
+        self.DemoPagedDocument.reload()
+        document = self.DemoPagedDocument.find(2)
+        size = os.path.getsize(self.pages_path)
+        self.DemoPagedDocument.compact()
+        self.assertLess(os.path.getsize(self.pages_path), size)
+        self.DemoPagedDocument.reload()
+        self.assertEqual(self.DemoPagedDocument.find(1).name, 'a')
+        self.assertEqual(self.DemoPagedDocument.find(2).name, document.name)
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoPagedDocument, self.DemoOtherPagedDocument)
+
+
+class DocumentPartitionedStorageTest(TestCase):
+    class DemoPartitionedDocument(IndexedDocument):
+        _storage_mode = 'partitioned'
+        id = Field(primary_key=True)
+        name = Field()
+        children = ReferenceDocumentsField()
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+        self.DemoPartitionedDocument.delete_all()
+        self.segments_path = f'{self.DemoPartitionedDocument._persistence_path}.segments'
+        self.manifest_path = f'{self.DemoPartitionedDocument._persistence_path}.manifest'
+
+    def segment_times(self):
+        return {name: os.stat(os.path.join(self.segments_path, name)).st_mtime_ns
+                for name in os.listdir(self.segments_path)}
+
+    def test_change_only_writes_own_segment(self):
+        document = self.DemoPartitionedDocument(id=1, name='a', children=[])
+        self.DemoPartitionedDocument(id=2, name='b', children=[])
+        times = self.segment_times()
+        manifest_time = os.stat(self.manifest_path).st_mtime_ns
+        with patch('builtins.open', wraps=open) as opened:
+            document.name = 'c'
+            document.save()
+        written = [call.args[0] for call in opened.call_args_list if set(call.args[1]) & {'w', 'a'}]
+        self.assertEqual(len(written), 1)
+        self.assertEqual(os.stat(self.manifest_path).st_mtime_ns, manifest_time)
+        self.assertEqual({name: time for name, time in self.segment_times().items() if name in times}, times)
+        self.DemoPartitionedDocument.reload()
+        self.assertEqual(self.DemoPartitionedDocument.find(1).name, 'c')
+
+    def test_documents_loaded_when_found(self):
+        sibling = self.DemoPartitionedDocument(id=1, name='a', children=[])
+        self.DemoPartitionedDocument(id=2, name='b', children=[sibling])
+        self.DemoPartitionedDocument(id=3, name='c', children=[])
+        self.DemoPartitionedDocument.reload()
+        with patch.object(PartitionedStorage, 'load_document', autospec=True,
+                          side_effect=PartitionedStorage.load_document) as load_document:
+            document = self.DemoPartitionedDocument.find(2)
+            self.assertEqual({call.args[1] for call in load_document.call_args_list}, {1, 2})
+        self.assertIs(document.children.get(1), self.DemoPartitionedDocument.find(1))
+
+    def test_changes_appended_to_segment_log(self):
+        document = self.DemoPartitionedDocument(id=1, name='a', children=[])
+        self.DemoPartitionedDocument(id=2, name='b', children=[])
+        segments = set(os.listdir(self.segments_path))
+        document.name = 'c'
+        document.save()
+        logs = set(os.listdir(self.segments_path)) - segments
+        self.assertEqual(len(logs), 1)
+        self.DemoPartitionedDocument.reload()
+        document = self.DemoPartitionedDocument.find(1)
+        self.assertEqual(document.name, 'c')
+        # Folded into the segment once the log is as large as the segment
+        while set(os.listdir(self.segments_path)) != segments:
+            document.name += 'c'
+            document.save()
+        self.DemoPartitionedDocument.reload()
+        self.assertEqual(self.DemoPartitionedDocument.find(1).name, document.name)
+
+    def test_log_of_rewritten_segment_ignored(self):
+        document = self.DemoPartitionedDocument(id=1, name='a', children=[])
+        document.name = 'b'
+        document.save()
+        log_path = os.path.join(self.segments_path, next(name for name in os.listdir(self.segments_path)
+                                                         if name.endswith('.log')))
+        shutil.copy(log_path, f'{log_path}.copy')
+        document.name = 'c'
+        self.DemoPartitionedDocument.compact()
+        self.assertFalse(os.path.exists(log_path))
+        os.replace(f'{log_path}.copy', log_path)  # As if the rewrite was interrupted before removing the log
+        self.DemoPartitionedDocument.reload()
+        document = self.DemoPartitionedDocument.find(1)
+        self.assertEqual(document.name, 'c')
+        document.name = 'd'
+        document.save()
+        self.DemoPartitionedDocument.reload()
+        self.assertEqual(self.DemoPartitionedDocument.find(1).name, 'd')
+
+    def test_delete(self):
+        self.DemoPartitionedDocument(id=1, name='a', children=[])
+        self.DemoPartitionedDocument(id=2, name='b', children=[]).delete()
+        self.assertEqual(len(os.listdir(self.segments_path)), 1)
+        self.DemoPartitionedDocument.reload()
+        self.assertEqual([document.id for document in self.DemoPartitionedDocument.all()], [1])
+
+    def test_archive(self):
+        document = self.DemoPartitionedDocument(id=1, name='a', children=[])
+        self.DemoPartitionedDocument(id=2, name='b', children=[])
+        document.archive()
+        archive_path = f'{self.DemoPartitionedDocument._persistence_path}.archive'
+        self.assertEqual(len(os.listdir(archive_path)), 1)
+        self.assertEqual(len(os.listdir(self.segments_path)), 1)
+        document.name = 'c'
+        document.save()
+        self.assertEqual(len(os.listdir(self.segments_path)), 1)
+        self.DemoPartitionedDocument.reload()
+        self.assertEqual([document.id for document in self.DemoPartitionedDocument.all()], [2])
+        self.assertEqual(self.DemoPartitionedDocument.find(1).name, 'c')
+        self.DemoPartitionedDocument.find(1).delete()
+        self.assertEqual(os.listdir(archive_path), [])
+        self.assertEqual(self.DemoPartitionedDocument.archived_keys(), [])
+
+    def test_archive_not_supported(self):
+        IndexedDocument.override_storage_mode('snapshot')
+        document = SaveTest.DemoRoot(name='a', children=[])
+        self.assertFalse(SaveTest.DemoRoot.has_archive_tier())
+        document.archive()
+        self.assertEqual(SaveTest.DemoRoot.archived_keys(), [])
+        self.assertEqual(SaveTest.DemoRoot.all(), [document])
+        SaveTest.DemoRoot.delete_all()
+
+    def test_migrated_from_log(self):
+        self.DemoPartitionedDocument._storage_mode = 'log'
+        try:
+            self.DemoPartitionedDocument.reload()
+            sibling = self.DemoPartitionedDocument(id=1, name='a', children=[])
+            self.DemoPartitionedDocument(id=2, name='b', children=[sibling])
+        finally:
+            self.DemoPartitionedDocument._storage_mode = 'partitioned'
+        self.DemoPartitionedDocument.reload()
+        self.assertFalse(os.path.exists(f'{self.DemoPartitionedDocument._persistence_path}.log'))
+        document = self.DemoPartitionedDocument.find(2)
+        self.assertIs(document.children.get(1), self.DemoPartitionedDocument.find(1))
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoPartitionedDocument)
+
+
+class DocumentChangesTest(TestCase):
+    """
+    Apply random changes to documents in the storage modes writing the changes to documents instead of whole
+    documents, and check that reloading gives the documents as they were changed.
+    """
+
+    class DemoPart(Document):
+        name = Field(primary_key=True)
+        value = Field()
+
+    class DemoItem(Document):
+        name = Field(primary_key=True)
+        value = Field()
+        parts = ReferenceDocumentsField()
+
+    class DemoChangedDocument(IndexedDocument):
+        _log_compaction_min_size = 1024
+        id = Field(primary_key=True)
+        name = Field()
+        items = ReferenceDocumentsField()
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+
+    def state(self) -> dict:
+        return {document.id: (document.name, {item.name: (item.value, {part.name: part.value for part in item.parts})
+                                              for item in document.items})
+                for document in self.DemoChangedDocument.all()}
+
+    def change(self, random: random.Random) -> None:
+        documents = self.DemoChangedDocument.all()
+        document = random.choice(documents)
+        items = list(document.items)
+        item = random.choice(items) if items else None
+        operation = random.randrange(7)
+        if operation == 0:
+            document.name = random.random()
+            document.save()
+        elif operation == 1 and item is not None:
+            item.value = random.random()
+            item.save()
+        elif operation == 2 and (name := random.randrange(20)) not in {item.name for item in items}:
+            document.items.add(self.DemoItem(name=name, value=0, parts=[self.DemoPart(name=0, value=0)]))
+        elif operation == 3 and item is not None:
+            document.items.remove(item)
+        elif operation == 4 and item is not None:
+            part = item.parts.get(name := random.randrange(3))
+            if part is None:
+                item.parts.add(self.DemoPart(name=name, value=random.random()))
+            else:
+                part.value = random.random()
+                part.save()
+        elif operation == 5 and item is not None:
+            other = random.choice(documents)
+            if item.name not in {other_item.name for other_item in other.items}:
+                with IndexedDocument.transaction():
+                    document.items.remove(item)
+                    other.items.add(item)
+        elif operation == 6:
+            try:
+                with IndexedDocument.transaction():
+                    document.name = 'rolled back'
+                    document.save()
+                    if item is not None:
+                        document.items.remove(item)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+
+    def test_reload_after_changes(self):
+        for mode in ('log', 'partitioned'):
+            with self.subTest(mode=mode):
+                IndexedDocument.override_storage_mode(mode)
+                self.DemoChangedDocument.delete_all()
+                for i in range(3):
+                    self.DemoChangedDocument(id=i, name=None, items=[])
+                generator = random.Random(mode)
+                for i in range(300):
+                    self.change(generator)
+                    if i % 50 == 49:
+                        state = self.state()
+                        self.DemoChangedDocument.reload()
+                        self.assertEqual(self.state(), state)
+                self.DemoChangedDocument.delete_all()
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoChangedDocument)
+
+
+class DocumentSqliteStorageTest(TestCase):
+    class DemoSqliteDocument(IndexedDocument):
+        _storage_mode = 'sqlite'
+        id = Field(primary_key=True)
+        name = Field(index=True)
+        code = Field(unique=True)
+        children = ReferenceDocumentsField()
+
+    class DemoTaggedSqliteDocument(DemoSqliteDocument):
+        tag = Field(index=True)
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+        self.DemoSqliteDocument.delete_all()
+
+    def loaded_keys(self, load_document) -> set:
+        return {call.args[1] for call in load_document.call_args_list}
+
+    def test_documents_loaded_when_found(self):
+        sibling = self.DemoSqliteDocument(id=1, name='a', code='x', children=[])
+        self.DemoSqliteDocument(id=2, name='b', code='y', children=[sibling])
+        self.DemoSqliteDocument(id=3, name='c', code='z', children=[])
+        self.DemoSqliteDocument.reload()
+        with patch.object(SqliteStorage, 'load_document', autospec=True,
+                          side_effect=SqliteStorage.load_document) as load_document:
+            document = self.DemoSqliteDocument.find(2)
+            self.assertEqual(self.loaded_keys(load_document), {1, 2})
+        self.assertIs(document.children.get(1), self.DemoSqliteDocument.find(1))
+
+    def test_find_by_loads_matching(self):
+        self.DemoSqliteDocument(id=1, name='a', code='x', children=[])
+        self.DemoSqliteDocument(id=2, name='b', code='y', children=[])
+        self.DemoSqliteDocument(id=3, name='a', code='z', children=[])
+        self.DemoSqliteDocument.reload()
+        with patch.object(SqliteStorage, 'load_document', autospec=True,
+                          side_effect=SqliteStorage.load_document) as load_document:
+            self.assertEqual({document.id for document in self.DemoSqliteDocument.find_by(name='a')}, {1, 3})
+            self.assertEqual(self.loaded_keys(load_document), {1, 3})
+            with self.assertRaises(Document.DuplicateKeyError):
+                self.DemoSqliteDocument(id=4, name='b', code='y', children=[])
+            self.assertEqual(self.loaded_keys(load_document), {1, 2, 3})
+
+    def test_find_by_subclass_field_loads_matching(self):
+        self.DemoSqliteDocument(id=1, name='a', code='x', children=[])
+        self.DemoTaggedSqliteDocument(id=2, name='a', code='y', children=[], tag='t')
+        self.DemoTaggedSqliteDocument(id=3, name='a', code='z', children=[], tag='u')
+        self.DemoSqliteDocument.reload()
+        with patch.object(SqliteStorage, 'load_document', autospec=True,
+                          side_effect=SqliteStorage.load_document) as load_document:
+            self.assertEqual([document.id for document in self.DemoTaggedSqliteDocument.find_by(tag='t')], [2])
+            self.assertEqual(self.loaded_keys(load_document), {2})
+
+    def test_changes_saved(self):
+        document = self.DemoSqliteDocument(id=1, name='a', code='x', children=[])
+        self.DemoSqliteDocument(id=2, name='b', code='y', children=[]).delete()
+        document.name = 'c'
+        document.save()
+        self.DemoSqliteDocument.reload()
+        self.assertEqual([document.name for document in self.DemoSqliteDocument.all()], ['c'])
+        self.assertEqual(self.DemoSqliteDocument.find_by(name='a'), [])
+
+    def test_archive(self):
+        document = self.DemoSqliteDocument(id=1, name='a', code='x', children=[])
+        self.DemoSqliteDocument(id=2, name='b', code='y', children=[])
+        document.archive()
+        self.DemoSqliteDocument.reload()
+        self.assertEqual(self.DemoSqliteDocument.archived_keys(), [1])
+        self.assertEqual([document.id for document in self.DemoSqliteDocument.all()], [2])
+        self.assertEqual(self.DemoSqliteDocument.find(1).name, 'a')
+
+    def test_migrated_from_log(self):
+        self.DemoSqliteDocument._storage_mode = 'log'
+        try:
+            self.DemoSqliteDocument.reload()
+            sibling = self.DemoSqliteDocument(id=1, name='a', code='x', children=[])
+            self.DemoSqliteDocument(id=2, name='b', code='y', children=[sibling])
+        finally:
+            self.DemoSqliteDocument._storage_mode = 'sqlite'
+        self.DemoSqliteDocument.reload()
+        self.assertFalse(os.path.exists(f'{self.DemoSqliteDocument._persistence_path}.log'))
+        document = self.DemoSqliteDocument.find(2)
+        self.assertIs(document.children.get(1), self.DemoSqliteDocument.find(1))
+        self.assertEqual(self.DemoSqliteDocument.find_by(name='b'), [document])
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoSqliteDocument)
+
+
+class DocumentMemoryStorageTest(TestCase):
+    class DemoMemoryDocument(IndexedDocument):
+        _storage_mode = 'log'  # Replaced for the test case
+        id = Field(primary_key=True)
+        name = Field()
+        children = ReferenceDocumentsField()
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode('memory'))
+        self.DemoMemoryDocument.delete_all()
+
+    def test_no_files_written(self):
+        with patch('builtins.open') as opened:
+            document = self.DemoMemoryDocument(id=1, name='a', children=[])
+            document.name = 'b'
+            document.save()
+            self.DemoMemoryDocument.reload()
+        opened.assert_not_called()
+        self.assertFalse(os.path.exists(f'{self.DemoMemoryDocument._persistence_path}.log'))
+        self.assertEqual(self.DemoMemoryDocument.find(1).name, 'b')
+
+    def test_reload_round_trip(self):
+        sibling = self.DemoMemoryDocument(id=1, name='a', children=[])
+        document = self.DemoMemoryDocument(id=2, name='b', children=[sibling])
+        document.name = 'c'  # Not saved
+        self.DemoMemoryDocument.reload()
+        reloaded = self.DemoMemoryDocument.find(2)
+        self.assertIsNot(reloaded, document)
+        self.assertEqual(reloaded.name, 'b')
+        self.assertIs(reloaded.children.get(1), self.DemoMemoryDocument.find(1))
+
+    def test_delete_and_archive(self):
+        self.DemoMemoryDocument(id=1, name='a', children=[]).archive()
+        self.DemoMemoryDocument(id=2, name='b', children=[]).delete()
+        self.DemoMemoryDocument.reload()
+        self.assertEqual(self.DemoMemoryDocument.all(), [])
+        self.assertEqual([document.id for document in self.DemoMemoryDocument.all(include_archived=True)], [1])
+
+    def test_override_restored(self):
+        self.DemoMemoryDocument(id=1, name='a', children=[])
+        previous = IndexedDocument.override_storage_mode(None)
+        try:
+            self.assertIsNone(self.DemoMemoryDocument.find(1))
+        finally:
+            IndexedDocument.override_storage_mode(previous)
+        self.assertIsNotNone(self.DemoMemoryDocument.find(1))
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoMemoryDocument)
+
+
+class DocumentCodecTest(TestCase):
+    class Colour(Enum):
+        RED = 'red'
+        BLUE = 'blue'
+
+    class DemoEmbeddedDocument(Document):
+        name = Field()
+        colour = Field()
+        born = Field()
+
+    class DemoCodecDocument(IndexedDocument):
+        _storage_mode = 'partitioned'
+        id = Field(primary_key=True)
+        name = Field()
+        extra = Field()
+        children = ReferenceDocumentsField()
+        members = ReferenceDocumentsField()
+
+    class DemoOtherDocument(IndexedDocument):
+        id = Field(primary_key=True)
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+        self.DemoCodecDocument.delete_all()
+        self.DemoOtherDocument.delete_all()
+
+    def test_round_trip(self):
+        other = self.DemoOtherDocument(id=1)
+        members = [self.DemoEmbeddedDocument(name=f'm{i}', colour=self.Colour.BLUE, born=date(2020, 1, i + 1))
+                   for i in range(3)]
+        document = self.DemoCodecDocument(id=1, name='a', children=[other], members=members,
+                                          extra={'values': [1, 2.5, (None, True)], 'set': frozenset({b'x'}),
+                                                 'fallback': Decimal('1.5'), 'first': members[0]})
+        decoded = DocumentCodec(self.DemoCodecDocument, root=document).decode(
+            DocumentCodec(self.DemoCodecDocument, root=document).encode(document))
+        self.assertEqual(decoded.name, 'a')
+        self.assertEqual(decoded.extra['values'], [1, 2.5, (None, True)])
+        self.assertEqual(decoded.extra['set'], frozenset({b'x'}))
+        self.assertEqual(decoded.extra['fallback'], Decimal('1.5'))
+        self.assertEqual([member.born for member in decoded.members], [date(2020, 1, i + 1) for i in range(3)])
+        self.assertIs(decoded.extra['first'], list(decoded.members)[0])
+        self.assertIs(decoded.extra['first'].colour, self.Colour.BLUE)
+        reference, = decoded.children._ReferenceSet__ref_documents.values()
+        self.assertIsInstance(reference, IndexedDocument.DeferredReference)
+        self.assertEqual(reference.key, 1)
+
+    def test_enum_member_added(self):
+        document = self.DemoCodecDocument(id=1, name='a', children=[], members=[], extra=self.Colour.RED)
+        encoded = DocumentCodec(self.DemoCodecDocument, root=document).encode(document)
+        # A member added before the existing ones, as in an alphabetical list
+        colour = Enum('Colour', [('AMBER', 'amber'), ('BLUE', 'blue'), ('RED', 'red')])
+        with patch.object(DocumentCodecTest, 'Colour', colour):
+            decoded = DocumentCodec(self.DemoCodecDocument).decode(encoded)
+        self.assertIs(decoded.extra, colour.RED)
+
+    def test_missing_field(self):
+        document = self.DemoCodecDocument(id=1, name='a', children=[], members=[])
+        del document._data['name']  # e.g. saved before the field was added
+        data = DocumentCodec(self.DemoCodecDocument, root=document).encode(document)
+        self.assertNotIn('name', DocumentCodec(self.DemoCodecDocument).decode(data)._data)
+
+    def test_invalid_record(self):
+        with self.assertRaises(DocumentCodec.InvalidRecordError):
+            DocumentCodec(self.DemoCodecDocument).decode(DocumentCodec.MAGIC + b'invalid')
+
+    def test_smaller_than_pickle(self):
+        members = [self.DemoEmbeddedDocument(name=f'm{i}', colour=self.Colour.RED, born=date(2020, 1, 1))
+                   for i in range(100)]
+        document = self.DemoCodecDocument(id=1, name='a', children=[], members=members)
+        storage = PartitionedStorage(self.DemoCodecDocument)
+        with patch.object(self.DemoCodecDocument, '_document_codec', 'pickle'):
+            pickled = storage._dumps(document)
+        encoded = storage._dumps(document)
+        self.assertTrue(encoded.startswith(DocumentCodec.MAGIC))
+        self.assertLess(len(encoded), len(pickled) * 0.75)
+
+    def test_pickled_documents_loaded(self):
+        for storage_mode in ('snapshot', 'log', 'paged', 'partitioned', 'sqlite'):
+            with self.subTest(storage_mode=storage_mode), \
+                    patch.object(self.DemoCodecDocument, '_storage_mode', storage_mode):
+                self.DemoCodecDocument.reload()
+                self.DemoCodecDocument.delete_all()
+                with patch.object(self.DemoCodecDocument, '_document_codec', 'pickle'):
+                    self.DemoCodecDocument(id=1, name='a', children=[], members=[
+                        self.DemoEmbeddedDocument(name='m', colour=self.Colour.RED, born=date(2020, 1, 1))])
+                    self.DemoCodecDocument(id=2, name='b', children=[], members=[])
+                self.DemoCodecDocument.reload()
+                document = self.DemoCodecDocument.find(1)
+                self.assertEqual(document.name, 'a')
+                self.assertEqual(len(document.members), 1)
+                document.name = 'c'
+                document.save()
+                self.DemoCodecDocument.reload()
+                self.assertEqual(self.DemoCodecDocument.find(1).name, 'c')
+                self.assertEqual(self.DemoCodecDocument.find(2).name, 'b')
+                self.DemoCodecDocument.delete_all()
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoCodecDocument, self.DemoOtherDocument)
+
+
+class CrashInjectionTest(TestCase):
+    """
+    Kill a writer process after it writes a random number of bytes, and check that the stored state is consistent
+    when reloaded.
+    """
+
+    class DemoCrashSnapshotDocument(IndexedDocument):
+        id = Field(primary_key=True)
+        name = Field()
+
+    class DemoCrashLoggedDocument(IndexedDocument):
+        _storage_mode = 'log'
+        _log_compaction_min_size = 256
+        id = Field(primary_key=True)
+        name = Field()
+
+    class DemoCrashPagedDocument(IndexedDocument):
+        _storage_mode = 'paged'
+        _log_compaction_threshold = 3
+        id = Field(primary_key=True)
+        name = Field()
+
+    class DemoCrashPartitionedDocument(IndexedDocument):
+        _storage_mode = 'partitioned'
+        id = Field(primary_key=True)
+        name = Field()
+
+    CRASH_EXIT_CODE = 70
+    # Crashes injected for each storage mode, each in a writer process; more with the EMS_CRASH_SCENARIOS
+    # environment variable
+    SCENARIOS = int(os.environ.get('EMS_CRASH_SCENARIOS') or 3)
+
+    class CrashingFile:
+        """
+        A file that kills the process once the budget of the injector is spent,
+        after writing what the budget allows to the file.
+        """
+
+        def __init__(self, f, injector):
+            self.__file = f
+            self.__injector = injector
+
+        def write(self, data) -> int:
+            data = bytes(data)
+            written = min(len(data), self.__injector.budget)
+            self.__injector.budget -= written
+            self.__file.write(data[:written])
+            if written < len(data):
+                self.__file.flush()
+                self.__injector.crash()
+            return written
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.__file.close()
+
+        def __getattr__(self, name):
+            return getattr(self.__file, name)
+
+    class CrashInjector:
+        """
+        Patch the storage to kill the process after writing a number of bytes, counting renames and removals
+        as one byte.
+        """
+
+        def __init__(self, budget: int):
+            self.budget = budget
+
+        @staticmethod
+        def crash():
+            os._exit(CrashInjectionTest.CRASH_EXIT_CODE)
+
+        def open(self, path, mode='r', *args, **kwargs):
+            f = open(path, mode, *args, **kwargs)
+            return f if mode.startswith('r') else CrashInjectionTest.CrashingFile(f, self)
+
+        def operation(self, function):
+            def crashing(*args, **kwargs):
+                if self.budget < 1:
+                    self.crash()
+                self.budget -= 1
+                return function(*args, **kwargs)
+
+            return crashing
+
+        def __enter__(self):
+            self.__patches = [patch('models.base.storage.open', self.open, create=True),
+                              patch('os.replace', self.operation(os.replace)),
+                              patch('os.remove', self.operation(os.remove))]
+            for p in self.__patches:
+                p.start()
+            return self
+
+        def __exit__(self, *exc_info):
+            for p in self.__patches:
+                p.stop()
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+
+    @classmethod
+    def write_until_crash(cls, type_name: str, budget: int) -> None:
+        """
+        Apply changes in this process until it is killed once the budget is spent.
+        The state after each change is printed, and then the budget spent if the process was not killed.
+        """
+        IndexedDocument.override_storage_mode(None)
+        document_type = getattr(cls, type_name)
+        document_type.delete_all()
+        operations = [
+            lambda: document_type(id=1, name='a'),
+            lambda: document_type(id=2, name='b'),
+            lambda: cls.rename(document_type.find(1), 'c'),
+            lambda: document_type.find(2).delete(),
+            lambda: document_type(id=3, name='d'),
+            lambda: cls.rename(document_type.find(3), 'e'),
+            lambda: cls.rename(document_type.find(1), 'f'),
+            lambda: document_type(id=4, name='g'),
+        ]
+        if document_type._storage_mode == 'partitioned':
+            operations.insert(5, lambda: document_type.find(1).archive())
+        with cls.CrashInjector(budget) as injector:
+            for operation in operations:
+                operation()
+                print(repr(cls.state(document_type)), flush=True)
+        print(budget - injector.budget, flush=True)
+
+    def run_scenario(self, document_type, budget: int) -> tuple[list[dict], Optional[int]]:
+        """
+        Apply changes in a writer process, see write_until_crash.
+        :return: the states after each change, starting with the empty state before the first change,
+                 and the budget spent, or None if the writer was killed
+        """
+        script = f'from {__name__} import CrashInjectionTest\n' \
+                 f'CrashInjectionTest.write_until_crash({document_type.__name__!r}, {budget})'
+        # Imports this module as the test runner did, e.g. as a package under pytest
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        writer = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                env=environment)
+        self.assertIn(writer.returncode, (0, self.CRASH_EXIT_CODE), writer.stderr.decode())
+        output = [ast.literal_eval(line) for line in writer.stdout.decode().splitlines()]
+        if writer.returncode == 0:
+            return [{}] + output[:-1], output[-1]
+        return [{}] + output, None
+
+    @staticmethod
+    def rename(document, name):
+        document.name = name
+        document.save()
+
+    @staticmethod
+    def state(document_type) -> dict:
+        return {document.id: document.name for document in document_type.all(include_archived=True)}
+
+    def test_reload_after_crash(self):
+        for document_type in (self.DemoCrashSnapshotDocument, self.DemoCrashLoggedDocument, self.DemoCrashPagedDocument,
+                              self.DemoCrashPartitionedDocument):
+            states, total = self.run_scenario(document_type, 10 ** 9)
+            for seed in range(self.SCENARIOS):
+                budget = random.Random(seed).randint(0, total)
+                with self.subTest(mode=document_type._storage_mode, budget=budget):
+                    completed = len(self.run_scenario(document_type, budget)[0]) - 1
+                    document_type.reload()
+                    state = self.state(document_type)
+                    self.assertIn(state, states[completed:completed + 2])
+                    document_type(id=5, name='h')
+                    document_type.reload()
+                    self.assertEqual(self.state(document_type), {**state, 5: 'h'})
+            document_type.delete_all()
+
+    def test_durability(self):
+        document_type = self.DemoCrashLoggedDocument
+        for durability, syncs in (('none', 0), ('commit', 1), ('write', 2)):
+            document_type.delete_all()
+            document_type._durability = durability
+            try:
+                with patch('os.fsync') as fsync:
+                    document_type(id=1, name='a')
+                self.assertEqual(fsync.call_count, syncs, durability)
+            finally:
+                del document_type._durability
+        document_type.delete_all()
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoCrashSnapshotDocument, self.DemoCrashLoggedDocument, self.DemoCrashPagedDocument,
+                     self.DemoCrashPartitionedDocument)
+
+
+class WriteBehindTest(TestCase):
+    class DemoWriteBehindItem(Document):
+        name = Field()
+
+    class DemoWriteBehindDocument(IndexedDocument):
+        _storage_mode = 'log'
+        _write_behind_delay = 0.05
+        _write_behind_max_delay = 0.3
+        id = Field(primary_key=True)
+        name = Field()
+        items = ReferenceDocumentsField()
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+        self.DemoWriteBehindDocument.delete_all()
+        self.written = threading.Event()
+        original_save = LogStorage.save
+
+        def save(storage, objects, documents, deleted=()):
+            original_save(storage, objects, documents, deleted)
+            self.written.set()
+
+        patcher = patch.object(LogStorage, 'save', autospec=True, side_effect=save)
+        self.save = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_written_after_delay(self):
+        document = self.DemoWriteBehindDocument(id=1, name='a')
+        document.name = 'b'
+        document.save()
+        self.assertFalse(self.written.is_set())
+        self.assertTrue(self.written.wait(2))
+        self.assertEqual(self.save.call_count, 1)
+        self.DemoWriteBehindDocument.reload()
+        self.assertEqual(self.DemoWriteBehindDocument.find(1).name, 'b')
+
+    def test_max_delay(self):
+        document = self.DemoWriteBehindDocument(id=1, name='a')
+        start = time.monotonic()
+        while not self.written.is_set():
+            self.assertLess(time.monotonic() - start, 2)
+            document.name = str(time.monotonic())  # Changes more often than the delay
+            document.save()
+            time.sleep(0.01)
+
+    def test_flush(self):
+        with patch.object(self.DemoWriteBehindDocument, '_write_behind_delay', 60):
+            self.DemoWriteBehindDocument(id=1, name='a')
+            self.assertFalse(self.written.is_set())
+            IndexedDocument.flush()
+            self.assertEqual(self.save.call_count, 1)
+
+    def fail_saves(self, count: int) -> None:
+        failures = [OSError('No space left on device')] * count
+        save = self.save.side_effect
+
+        def failing_save(storage, objects, documents, deleted=()):
+            if failures:
+                raise failures.pop()
+            save(storage, objects, documents, deleted)
+
+        self.save.side_effect = failing_save
+
+    def test_failure_logged_and_retried(self):
+        self.fail_saves(1)
+        with self.assertLogs('models.base.document', 'ERROR'):
+            self.DemoWriteBehindDocument(id=1, name='a')
+            self.assertTrue(self.written.wait(2))  # Retried after the delay
+        IndexedDocument.flush()  # Not raised once written
+        self.DemoWriteBehindDocument.reload()
+        self.assertEqual(self.DemoWriteBehindDocument.find(1).name, 'a')
+
+    def test_failure_raised_by_flush(self):
+        self.fail_saves(2)
+        with patch.object(self.DemoWriteBehindDocument, '_write_behind_delay', 60):
+            self.DemoWriteBehindDocument(id=1, name='a')
+            with self.assertRaises(Document.PersistenceError):
+                IndexedDocument.flush()
+            with self.assertRaises(Document.PersistenceError):
+                IndexedDocument.flush()  # Still waiting to be written
+            IndexedDocument.flush()
+        self.DemoWriteBehindDocument.reload()
+        self.assertEqual(self.DemoWriteBehindDocument.find(1).name, 'a')
+
+    def test_changes_while_writing(self):
+        """
+        Test that documents changed continuously are only written between changes, and each time in full.
+        """
+        document = self.DemoWriteBehindDocument(id=1, name='a')
+        written_names = []
+        save = self.save.side_effect
+
+        def recording_save(storage, objects, documents, deleted=()):
+            written_names.extend(document.name for document in documents)
+            save(storage, objects, documents, deleted)
+
+        self.save.side_effect = recording_save
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)  # Switch threads often, so that writes overlap changes
+        with patch.object(self.DemoWriteBehindDocument, '_write_behind_delay', 0), \
+                patch('models.base.document.logger') as logger:
+            for i in range(500):
+                document.items.add(self.DemoWriteBehindItem(name=str(i)))
+                document.name = str(i)
+                if i % 50 == 0:
+                    with IndexedDocument.transaction():
+                        document.name = 'in transaction'
+                        document.save()
+                        time.sleep(0.01)  # The background thread waits until the transaction ends
+                        document.name = str(i)
+                document.save()
+            IndexedDocument.flush()
+        logger.exception.assert_not_called()
+        self.assertNotIn('in transaction', written_names)
+        self.DemoWriteBehindDocument.reload()
+        document = self.DemoWriteBehindDocument.find(1)
+        self.assertEqual(document.name, '499')
+        self.assertEqual(len(document.items), 500)
+
+    def test_reload_writes_first(self):
+        with patch.object(self.DemoWriteBehindDocument, '_write_behind_delay', 60):
+            self.DemoWriteBehindDocument(id=1, name='a')
+            self.DemoWriteBehindDocument.reload()
+            self.assertEqual(self.DemoWriteBehindDocument.find(1).name, 'a')
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoWriteBehindDocument)
+
+
+class TransactionTest(TestCase):
+    class DemoTransactionDocument(IndexedDocument):
+        id = Field(primary_key=True)
+        name = Field()
+        children = ReferenceDocumentsField()
+
+    class DemoDocument(Document):
+        name = Field()
+
+    def setUp(self) -> None:
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+        self.DemoTransactionDocument.delete_all()
+        self.document = self.DemoTransactionDocument(id=1, name='a', children=[])
+
+    def test_changes_written_at_commit(self):
+        with IndexedDocument.transaction():
+            self.DemoTransactionDocument(id=2, name='b', children=[])
+            self.DemoTransactionDocument.reload()
+            self.assertIsNone(self.DemoTransactionDocument.find(2))
+            self.DemoTransactionDocument(id=2, name='b', children=[])
+        self.DemoTransactionDocument.reload()
+        self.assertIsNotNone(self.DemoTransactionDocument.find(2))
+
+    def test_index_written_once(self):
+        with patch.object(SnapshotStorage, 'compact', autospec=True, side_effect=SnapshotStorage.compact) as compact:
+            with IndexedDocument.transaction():
+                self.document.children.add(self.DemoDocument(name='a'), self.DemoDocument(name='b'))
+                self.document.children.remove(self.DemoDocument(name='a'))
+                self.DemoTransactionDocument(id=2, name='b', children=[])
+                with IndexedDocument.transaction():  # nested transactions join the outer one
+                    self.document.name = 'c'
+                    self.document.save()
+            self.assertEqual(compact.call_count, 1)
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with IndexedDocument.transaction():
+                self.document.name = 'b'
+                self.document.save()
+                self.DemoTransactionDocument(id=2, name='b', children=[])
+                raise ValueError()
+        self.assertEqual(self.DemoTransactionDocument.find(1).name, 'a')
+        self.assertIsNone(self.DemoTransactionDocument.find(2))
+
+    def test_rollback_in_place(self):
+        child = self.DemoDocument(name='x')
+        self.document.children.add(child)
+        with self.assertRaises(ValueError):
+            with IndexedDocument.transaction():
+                self.document.children.remove(child)
+                self.DemoTransactionDocument(id=2, name='b', children=[child])
+                raise ValueError()
+        self.assertIs(self.DemoTransactionDocument.find(1), self.document)
+        self.assertIn(child, self.document.children)
+        self.assertEqual(list(child._referenced_by), [self.document])
+        with self.assertRaises(ValueError):
+            with IndexedDocument.transaction():
+                self.document.delete()
+                raise ValueError()
+        self.assertIs(self.DemoTransactionDocument.find(1), self.document)
+        self.assertEqual(list(child._referenced_by), [self.document])
+
+    def test_rollback_reference_changes(self):
+        children = [self.DemoDocument(name=name) for name in 'abc']
+        self.document.children.add(*children)
+        added = self.DemoDocument(name='d')
+        references = self.document.children._ReferenceSet__ref_documents
+        with self.assertRaises(ValueError):
+            with IndexedDocument.transaction():
+                self.document.children.remove(children[1])
+                self.document.children.add(added)
+                self.document.children.remove(children[0])
+                raise ValueError()
+        # Undone in place, without copying the references when the transaction changed them
+        self.assertIs(self.document.children._ReferenceSet__ref_documents, references)
+        self.assertEqual({child.name for child in self.document.children}, {'a', 'b', 'c'})
+        self.assertNotIn(added, self.document.children)
+        self.assertEqual(len(added._referenced_by), 0)
+        for child in children:
+            self.assertEqual(list(child._referenced_by), [self.document])
+
+    def test_save_held_document_after_rollback(self):
+        for mode in ('snapshot', 'log', 'paged', 'partitioned', 'sqlite', 'memory'):
+            with self.subTest(mode=mode):
+                IndexedDocument.override_storage_mode(mode)
+                self.DemoTransactionDocument.delete_all()
+                document = self.DemoTransactionDocument(id=1, name='a', children=[])
+                with self.assertRaises(ValueError):
+                    with IndexedDocument.transaction():
+                        document.name = 'b'
+                        document.save()
+                        self.DemoTransactionDocument(id=2, name='b', children=[])
+                        raise ValueError()
+                self.assertIs(self.DemoTransactionDocument.find(1), document)
+                self.assertEqual(document.name, 'a')
+                document.name = 'c'
+                document.save()
+                self.DemoTransactionDocument.reload()
+                self.assertEqual(self.DemoTransactionDocument.find(1).name, 'c')
+                self.assertIsNone(self.DemoTransactionDocument.find(2))
+                self.DemoTransactionDocument.delete_all()
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoTransactionDocument)
+
+
+class SaveTest(TestCase):
+    class DemoNode(Document):
+        name = Field()
+        children = ReferenceDocumentsField()
+
+    class DemoRoot(IndexedDocument):
+        name = Field(primary_key=True)
+        children = ReferenceDocumentsField()
+
+    def setUp(self) -> None:
+        self.DemoRoot.delete_all()
+
+    def test_index_persisted_once(self):
+        nodes = [self.DemoNode(name=str(i), children=[]) for i in range(50)]
+        root = self.DemoRoot(name='root', children=nodes)
+        leaf = self.DemoNode(name='leaf', children=[])
+        for node in nodes:
+            node.children.add(leaf)  # the leaf reaches the root through every node
+        with patch.object(self.DemoRoot, '_persist', wraps=self.DemoRoot._persist) as persist:
+            leaf.save()
+            persist.assert_called_once_with(root)
+
+    def test_single_add_visits_changed_documents(self):
+        node = self.DemoNode(name='node', children=[self.DemoNode(name=str(i), children=[]) for i in range(100)])
+        root = self.DemoRoot(name='root', children=[node])
+        other = self.DemoRoot(name='other', children=[])
+        leaf = self.DemoNode(name='leaf', children=[])
+        visited = []
+        find_associated_documents = Document._find_associated_documents
+
+        def find(document):
+            associated = find_associated_documents(document)
+            visited.extend(associated)
+            return associated
+
+        with patch.object(Document, '_find_associated_documents', find):
+            node.children.add(leaf)
+            self.assertEqual({id(document) for document in visited}, {id(node), id(root)})
+            holder = self.DemoNode(name='holder', children=[other])
+            visited.clear()
+            node.children.add(holder)
+            # The referenced root-level document is saved to record its new referrer
+            self.assertEqual({id(document) for document in visited}, {id(node), id(root), id(other)})
+
+    def test_deep_graph(self):
+        node = self.DemoNode(name='0', children=[])
+        for i in range(sys.getrecursionlimit() // 2 + 100):
+            node = self.DemoNode(name=str(i), children=[node])
+        node.save()  # does not raise RecursionError
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoRoot)
+
+
+class ReferenceSetTest(TestCase):
+    class KeyedDocument(Document):
+        id = Field(primary_key=True)
+
+    class UnkeyedDocument(Document):
+        name = Field()
+
+    class Owner(Document):
+        children = ReferenceDocumentsField()
+
+    def test_insertion_order(self):
+        owner = self.Owner(children=[self.KeyedDocument(id=i) for i in (3, 1, 2)])
+        owner.children.add(self.KeyedDocument(id=0))
+        self.assertEqual([document.id for document in owner.children], [3, 1, 2, 0])
+
+    def test_duplicate_key_not_added(self):
+        owner = self.Owner(children=[self.KeyedDocument(id=1)])
+        with self.assertRaises(Document.DuplicateKeyError):
+            owner.children.add(self.KeyedDocument(id=2), self.KeyedDocument(id=1))
+        self.assertEqual(len(owner.children), 1)
+        self.assertIsNone(owner.children.get(2))
+
+    def test_contains_by_equality(self):
+        owner = self.Owner(children=[self.UnkeyedDocument(name='a')])
+        self.assertIn(self.UnkeyedDocument(name='a'), owner.children)
+        self.assertNotIn(self.UnkeyedDocument(name='b'), owner.children)
+        self.assertNotIn(self.KeyedDocument(id=1), owner.children)
+        owner = self.Owner(children=[self.KeyedDocument(id=1)])
+        self.assertIn(self.KeyedDocument(id=1), owner.children)
+        self.assertNotIn(self.KeyedDocument(id=2), owner.children)
+
+    def test_remove_missing(self):
+        owner = self.Owner(children=[self.KeyedDocument(id=1)])
+        with self.assertRaises(ValueError):
+            owner.children.remove(self.KeyedDocument(id=2))
+
+    def test_access_does_not_rebind(self):
+        child = self.KeyedDocument(id=1)
+        owner = self.Owner(children=[child])
+        with patch.object(ReferenceSet, '_with_owner') as with_owner:
+            self.assertIn(child, owner.children)
+            with_owner.assert_not_called()
+        self.assertIs(child.find_referred_by(self.Owner, 'children'), owner)
+
+    def test_restore_replaces_references(self):
+        children = [self.KeyedDocument(id=i) for i in range(3)]
+        references = ReferenceSet(children[:2], self.KeyedDocument)
+        owner = self.Owner(children=[])
+        references._restore(owner, 'children', [children[1], None, children[2]])
+        self.assertEqual(list(references), [children[1], children[2]])
+        self.assertIs(references.get(2), children[2])
+        self.assertIs(children[2].find_referred_by(self.Owner, 'children'), owner)
+
+    def test_restore_rekeys_list_pickled_by_earlier_versions(self):
+        child = self.KeyedDocument(id=1)
+        references = ReferenceSet.__new__(ReferenceSet)
+        references.__setstate__({'_ReferenceSet__ref_documents': [child], 'data_type': self.KeyedDocument,
+                                 '_ReferenceSet__primary_key': 'id', '_ReferenceSet__owner': None,
+                                 '_ReferenceSet__field_name': None})
+        owner = self.Owner(children=[])
+        references._restore(owner, 'children')
+        self.assertIs(references.get(1), child)
+        self.assertIs(child.find_referred_by(self.Owner, 'children'), owner)
+
+
+class ReferrerSetTest(TestCase):
+    class Referee(Document):
+        name = Field()
+
+    class WeakReferee(Document):
+        _weak_referrers = True
+        name = Field()
+
+    class Owner(Document):
+        children = ReferenceDocumentsField()
+        others = ReferenceDocumentsField()
+
+    class SubOwner(Owner):
+        pass
+
+    def test_find_by_type_and_field(self):
+        referee = self.Referee(name='a')
+        owner = self.Owner(children=[referee], others=[])
+        sub_owner = self.SubOwner(children=[], others=[referee])
+        self.assertIs(referee.find_referred_by(self.SubOwner), sub_owner)
+        self.assertIs(referee.find_referred_by(self.Owner, 'children'), owner)
+        self.assertIs(referee.find_referred_by(field_name='others'), sub_owner)
+        self.assertEqual(len(referee._referenced_by), 2)
+
+    def test_remove_one_field(self):
+        referee = self.Referee(name='a')
+        owner = self.Owner(children=[referee], others=[referee])
+        owner.children.remove(referee)
+        self.assertIn(owner, referee._referenced_by)
+        self.assertIs(referee.find_referred_by(field_name='others'), owner)
+        with self.assertRaises(Document.ReferrerNotFound):
+            referee.find_referred_by(field_name='children')
+        owner.others.remove(referee)
+        self.assertNotIn(owner, referee._referenced_by)
+
+    def test_weak_referrers(self):
+        referee = self.WeakReferee(name='a')
+        owner = self.Owner(children=[referee], others=[])
+        self.assertIs(referee.find_referred_by(self.Owner), owner)
+        del owner
+        gc.collect()
+        self.assertEqual(len(referee._referenced_by), 0)
+        with self.assertRaises(Document.ReferrerNotFound):
+            referee.find_referred_by(self.Owner)
+
+
+class OwnerPointerTest(TestCase):
+    class Child(Document):
+        name = Field(primary_key=True)
+
+    class Parent(Document):
+        name = Field(primary_key=True)
+        children = ReferenceDocumentsField(single_owner=True)
+
+    def test_find_owner(self):
+        child = self.Child(name='a')
+        parent = self.Parent(name='p1', children=[child])
+        self.assertIs(child.find_owner(self.Parent.children), parent)
+
+    def test_owner_moved(self):
+        child = self.Child(name='a')
+        parent_1 = self.Parent(name='p1', children=[child])
+        parent_2 = self.Parent(name='p2', children=[])
+        parent_1.children.remove(child)
+        with self.assertRaises(Document.ReferrerNotFound):
+            child.find_owner(self.Parent.children)
+        parent_2.children.add(child)
+        self.assertIs(child.find_owner(self.Parent.children), parent_2)
+
+    def test_field_reassigned(self):
+        child = self.Child(name='a')
+        parent = self.Parent(name='p1', children=[child])
+        parent.children = []
+        with self.assertRaises(Document.ReferrerNotFound):
+            child.find_owner(self.Parent.children)
+
+
+class FieldIndexTest(TestCase):
+    class DemoFieldIndexDocument(IndexedDocument):
+        id = Field(primary_key=True)
+        name = Field(index=True)
+        email = Field(unique=True)
+        children = ReferenceDocumentsField()
+
+    class DemoDocument(Document):
+        name = Field(index=True)
+
+    def setUp(self) -> None:
+        self.DemoFieldIndexDocument.delete_all()
+
+    def test_find_by(self):
+        document_1 = self.DemoFieldIndexDocument(id=1, name='a', email='1@test', children=[])
+        document_2 = self.DemoFieldIndexDocument(id=2, name='a', email='2@test', children=[])
+        self.DemoFieldIndexDocument(id=3, name='b', email='3@test', children=[])
+        self.assertEqual(self.DemoFieldIndexDocument.find_by(name='a'), [document_1, document_2])
+        self.assertEqual(self.DemoFieldIndexDocument.find_by(name='a', email='2@test'), [document_2])
+        self.assertEqual(self.DemoFieldIndexDocument.find_by(name='c'), [])
+
+    def test_updated_on_set_and_delete(self):
+        document = self.DemoFieldIndexDocument(id=1, name='a', email='1@test', children=[])
+        document.name = 'b'
+        self.assertEqual(self.DemoFieldIndexDocument.find_by(name='a'), [])
+        self.assertEqual(self.DemoFieldIndexDocument.find_by(name='b'), [document])
+        document.delete()
+        self.assertEqual(self.DemoFieldIndexDocument.find_by(name='b'), [])
+
+    def test_rebuilt_on_reload(self):
+        self.DemoFieldIndexDocument(id=1, name='a', email='1@test', children=[])
+        self.DemoFieldIndexDocument.reload()
+        self.assertEqual(self.DemoFieldIndexDocument.find_by(name='a'), [self.DemoFieldIndexDocument.find(1)])
+
+    def test_unique(self):
+        document = self.DemoFieldIndexDocument(id=1, name='a', email='1@test', children=[])
+        with self.assertRaises(Document.DuplicateKeyError):
+            self.DemoFieldIndexDocument(id=2, name='a', email='1@test', children=[])
+        self.assertIsNone(self.DemoFieldIndexDocument.find(2))
+        self.DemoFieldIndexDocument(id=2, name='a', email='2@test', children=[])
+        with self.assertRaises(Document.DuplicateKeyError):
+            document.email = '2@test'
+        self.assertEqual(document.email, '1@test')
+        document.email = '1@test'  # unchanged value does not conflict with itself
+
+    def test_embedded_documents(self):
+        child = self.DemoDocument(name='x')
+        self.assertEqual(self.DemoDocument.find_by(name='x'), [])
+        self.DemoFieldIndexDocument(id=1, name='a', email='1@test', children=[child])
+        self.assertEqual(len(self.DemoDocument.find_by(name='x')), 1)
+        self.assertIs(self.DemoDocument.find_by(name='x')[0], child)
+        self.DemoFieldIndexDocument.reload()
+        document = self.DemoFieldIndexDocument.find(1)
+        reloaded_child = next(iter(document.children))
+        self.assertEqual(len(self.DemoDocument.find_by(name='x')), 1)
+        self.assertIs(self.DemoDocument.find_by(name='x')[0], reloaded_child)
+        document.children.remove(reloaded_child)
+        self.assertEqual(self.DemoDocument.find_by(name='x'), [])
+
+    def test_not_indexed(self):
+        with self.assertRaises(Document.FieldNotIndexedError):
+            self.DemoFieldIndexDocument.find_by(id=1)
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoFieldIndexDocument)
+
+
+class SortedIndexTest(TestCase):
+    class DemoSortedIndexDocument(IndexedDocument):
+        id = Field(primary_key=True)
+        rank = Field(index='sorted')
+
+    def setUp(self) -> None:
+        self.DemoSortedIndexDocument.delete_all()
+        for i, rank in enumerate([5, 1, 3, 3, None, 9]):
+            self.DemoSortedIndexDocument(id=i, rank=rank)
+
+    def ranks(self, documents):
+        return [document.rank for document in documents]
+
+    def test_range(self):
+        find_range = self.DemoSortedIndexDocument.find_range
+        self.assertEqual(self.ranks(find_range('rank')), [1, 3, 3, 5, 9])
+        self.assertEqual(self.ranks(find_range('rank', 3, 9)), [3, 3, 5])
+        self.assertEqual(self.ranks(find_range('rank', 3, 9, include_low=False, include_high=True)), [5, 9])
+        self.assertEqual(self.ranks(find_range('rank', high=3, include_high=True)), [1, 3, 3])
+        self.assertEqual(self.ranks(find_range('rank', 10)), [])
+
+    def test_find_by(self):
+        self.assertEqual({document.id for document in self.DemoSortedIndexDocument.find_by(rank=3)}, {2, 3})
+        self.assertEqual(self.DemoSortedIndexDocument.find_by(rank=None), [self.DemoSortedIndexDocument.find(4)])
+
+    def test_update(self):
+        document = self.DemoSortedIndexDocument.find(4)
+        document.rank = 4
+        self.DemoSortedIndexDocument.find(0).delete()
+        self.assertEqual(self.ranks(self.DemoSortedIndexDocument.find_range('rank', 2)), [3, 3, 4, 9])
+        self.assertEqual(self.DemoSortedIndexDocument.find_by(rank=None), [])
+
+    def test_not_sorted(self):
+        with self.assertRaises(Document.FieldNotIndexedError):
+            self.DemoSortedIndexDocument.find_range('id')
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoSortedIndexDocument)
+
+
+class QueryTest(TestCase):
+    class DemoDocument(Document):
+        id = Field(primary_key=True)
+        group = Field(index=True)
+        rank = Field(index='sorted')
+        note = Field()
+
+    class DemoQueryDocument(IndexedDocument):
+        id = Field(primary_key=True)
+        items = ReferenceDocumentsField()
+
+    def setUp(self) -> None:
+        self.DemoQueryDocument.delete_all()
+        self.items = [self.DemoDocument(id=i, group=i % 2, rank=i, note='x' if i < 3 else 'y') for i in range(10)]
+        self.root_1 = self.DemoQueryDocument(id=1, items=self.items[:6])
+        self.root_2 = self.DemoQueryDocument(id=2, items=self.items[6:])
+
+    def ids(self, query):
+        return sorted(document.id for document in query)
+
+    def test_where(self):
+        query = self.DemoDocument.query()
+        self.assertEqual(self.ids(query), list(range(10)))
+        self.assertEqual(self.ids(query.where(group=1)), [1, 3, 5, 7, 9])
+        self.assertEqual(self.ids(query.where(group=1, rank__gte=5)), [5, 7, 9])
+        self.assertEqual(self.ids(query.where(rank__gt=2, rank__lte=4)), [3, 4])
+        self.assertEqual(self.ids(query.where(rank__in=[1, 8, 20])), [1, 8])
+        self.assertEqual(self.ids(query.where(note='x', rank__ne=0)), [1, 2])
+
+    def test_within(self):
+        query = self.DemoDocument.query().within(self.root_1)
+        self.assertEqual(self.ids(query), list(range(6)))
+        self.assertEqual(self.ids(query.where(group=0, rank__gte=2)), [2, 4])
+
+    def test_explain(self):
+        explanation = self.DemoDocument.query().where(group=0, rank__gte=8).explain()
+        self.assertEqual(explanation['access'], 'index DemoDocument.rank')
+        self.assertEqual(explanation['filters'], ['group__eq=0'])
+        self.assertEqual((explanation['estimated'], explanation['touched'], explanation['returned']), (2, 2, 1))
+        explanation = self.DemoDocument.query().where(note='y').explain()
+        self.assertEqual(explanation['access'], 'scan DemoDocument')
+        self.assertEqual((explanation['touched'], explanation['returned']), (10, 7))
+        explanation = self.DemoDocument.query().where(group=1).within(self.root_2).explain()
+        self.assertEqual(explanation['estimated'], 4)
+        self.assertEqual((explanation['touched'], explanation['returned']), (4, 2))
+
+    def test_detached_documents_excluded(self):
+        self.root_1.items.remove(self.items[0])
+        self.assertNotIn(0, self.ids(self.DemoDocument.query()))
+        self.assertEqual(self.ids(self.DemoDocument.query().where(group=0, rank__lt=3)), [2])
+
+    def test_invalid_criterion(self):
+        with self.assertRaises(Query.InvalidCriterionError):
+            self.DemoDocument.query().where(missing=1)
+        with self.assertRaises(Query.InvalidCriterionError):
+            self.DemoQueryDocument.query().where(items=[])
+
+    def tearDown(self) -> None:
+        remove_files(self.DemoQueryDocument)
@@ -1,5 +1,7 @@
 import unittest
 from datetime import date
+
+from models.base.document import IndexedDocument
 from models.refugee import Refugee
 from models.volunteer import Volunteer
 from models.camp import Camp
@@ -140,6 +142,24 @@ class PlanTest(unittest.TestCase):
         plan.close()
         self.assertEqual(True, plan.is_closed)
 
+    def test_close_plan_without_archive_tier(self):
+        """
+        Test that closed plans stay with the open plans with storage modes that have no archive tier.
+        """
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode('log'))
+        Plan.delete_all()
+        plan = Plan(name='My Plan',
+                    emergency_type=Plan.EmergencyType.EARTHQUAKE,
+                    description='Test emergency plan',
+                    geographical_area='',
+                    camps=[Camp(name='TestCamp')])
+        plan.close()
+        Plan.reload()
+        self.assertTrue(Plan.find('My Plan').is_closed)
+        self.assertEqual([plan.name for plan in Plan.all()], ['My Plan'])
+        self.assertEqual(Plan.archived_keys(), [])
+        Plan.delete_all()
+
     def test_initialised_plan_no_close_date(self):
         """
         Test that close date is not set during plan creation.
@@ -163,6 +183,98 @@ class PlanTest(unittest.TestCase):
         plan.close()
         self.assertEqual(date.today(), plan.close_date)
 
+    def test_plans_by_date(self):
+        """
+        Test finding plans by start and close dates.
+        """
+        plan_1 = Plan(name='Plan 1',
+                      emergency_type=Plan.EmergencyType.EARTHQUAKE,
+                      description='Test emergency plan',
+                      geographical_area='',
+                      camps=[Camp(name='TestCamp')])
+        plan_2 = Plan(name='Plan 2',
+                      emergency_type=Plan.EmergencyType.FLOOD,
+                      description='Test emergency plan',
+                      geographical_area='',
+                      camps=[Camp(name='TestCamp')])
+        plan_2.close()
+        self.assertEqual(list(Plan.started_between(date.today(), date.today())), [plan_1, plan_2])
+        self.assertEqual(list(Plan.started_between(end=date(2020, 1, 1))), [])
+        self.assertEqual(list(Plan.closed_between(start=date.today())), [plan_2])
+        self.assertEqual(Plan.find_by(emergency=Plan.EmergencyType.FLOOD), [plan_2])
+
+    def test_query_private_date_field(self):
+        """
+        Test querying plans by a range of the private start date field.
+        """
+        plan = Plan(name='Plan 1',
+                    emergency_type=Plan.EmergencyType.EARTHQUAKE,
+                    description='Test emergency plan',
+                    geographical_area='',
+                    camps=[Camp(name='TestCamp')])
+        self.assertEqual(Plan.query().where(_Plan__start_date__gte=date.today()).all(), [plan])
+        self.assertEqual(Plan.query().where(_Plan__start_date__gt=date.today()).all(), [])
+        self.assertEqual(Plan.query().where(_Plan__start_date=date.today()).all(), [plan])
+        self.assertEqual(Plan.query().where(_Plan__start_date__gte=date.today()).explain()['access'],
+                         'index Plan._Plan__start_date')
+
+    def test_close_rolled_back(self):
+        """
+        Test that closing a plan in a transaction that fails leaves it open and out of the archive.
+        """
+        plan = Plan(name='Plan 1',
+                    emergency_type=Plan.EmergencyType.EARTHQUAKE,
+                    description='Test emergency plan',
+                    geographical_area='',
+                    camps=[Camp(name='TestCamp')])
+        with self.assertRaises(KeyError):
+            with IndexedDocument.transaction():
+                plan.close()
+                raise KeyError
+        self.assertFalse(plan.is_closed)
+        self.assertEqual(Plan.archived_keys(), [])
+        self.assertEqual(Plan.all(), [plan])
+        Plan.reload()
+        self.assertFalse(Plan.find('Plan 1').is_closed)
+        self.assertEqual(Plan.archived_keys(), [])
+        with IndexedDocument.transaction():
+            Plan.find('Plan 1').close()
+        Plan.reload()
+        self.assertTrue(Plan.find('Plan 1').is_closed)
+        self.assertEqual(Plan.archived_keys(), ['Plan 1'] if Plan.has_archive_tier() else [])
+
+    def test_closed_plan_archived(self):
+        """
+        Test that closed plans are only loaded when requested.
+        """
+        if not Plan.has_archive_tier():
+            self.skipTest('The storage mode of plans has no archive tier')
+        camp = Camp(name='TestCamp')
+        plan = Plan(name='Plan 1',
+                    emergency_type=Plan.EmergencyType.EARTHQUAKE,
+                    description='Test emergency plan',
+                    geographical_area='',
+                    camps=[camp])
+        camp.refugees.add(Refugee(firstname="Tom", lastname="Bond", num_of_family_member=6,
+                                  starting_date=date(2020, 1, 2)))
+        Plan(name='Plan 2',
+             emergency_type=Plan.EmergencyType.FLOOD,
+             description='Test emergency plan',
+             geographical_area='',
+             camps=[Camp(name='TestCamp')])
+        statistics = plan.statistics()
+        plan.close()
+        self.assertEqual([plan.name for plan in Plan.all()], ['Plan 2'])
+        Plan.reload()
+        self.assertEqual(Plan.archived_keys(), ['Plan 1'])
+        self.assertEqual([plan.name for plan in Plan.all()], ['Plan 2'])
+        plan = Plan.find('Plan 1')
+        self.assertTrue(plan.is_closed)
+        self.assertDictEqual(plan.statistics(), statistics)
+        self.assertEqual(len(Plan.all(include_archived=True)), 2)
+        Plan.reload()
+        self.assertEqual([plan.name for plan in Plan.closed_between(start=date.today())], ['Plan 1'])
+
     def test_plan_statistics_for_one_camp(self):
         """
         Test to check number of volunteers and refugees returned by statistics function
@@ -0,0 +1,71 @@
+import unittest
+from datetime import date
+
+from models.camp import Camp
+from models.plan import Plan
+from models.plan_statistics import PlanStatistics
+from models.refugee import Refugee
+from models.volunteer import Volunteer
+
+
+class PlanStatisticsTest(unittest.TestCase):
+    """
+    Test statistics across plans
+    """
+
+    def setUp(self) -> None:
+        Plan.delete_all()
+        Volunteer.delete_all()
+        self.plans = []
+        for i, (emergency_type, area) in enumerate([(Plan.EmergencyType.FLOOD, 'London'),
+                                                    (Plan.EmergencyType.FLOOD, 'Leeds'),
+                                                    (Plan.EmergencyType.FIRE, 'London')]):
+            camps = [Camp(name=f'camp{j}') for j in range(3)]
+            self.plans.append(Plan(name=f'plan{i}',
+                                   emergency_type=emergency_type,
+                                   description='Test emergency plan',
+                                   geographical_area=area,
+                                   camps=camps))
+            for j, camp in enumerate(camps):
+                camp.refugees.add(*[Refugee(firstname='Tom', lastname='Bond', num_of_family_member=7 * (i + j) + 1,
+                                            starting_date=date(2020, 1, 2)) for _ in range(j + 1)])
+                camp.volunteers.add(*[Volunteer(username=f'user{i}{j}{k}', password='root', firstname='William',
+                                                lastname='Yin', phone='+447519953189') for k in range(i)])
+
+    def tearDown(self) -> None:
+        Plan.delete_all()
+        Volunteer.delete_all()
+
+    def test_matches_plan_statistics(self):
+        statistics = PlanStatistics()
+        self.assertEqual(len(statistics), 9)
+        for plan in self.plans:
+            self.assertDictEqual(statistics.plan_statistics(plan.name), plan.statistics())
+        self.assertEqual(statistics.plan_statistics('missing'), {})
+
+    def test_totals_by(self):
+        statistics = PlanStatistics(self.plans[:2])
+        self.assertEqual(set(statistics.totals_by('plan_name')), {'plan0', 'plan1'})
+        totals = statistics.totals_by('emergency')[Plan.EmergencyType.FLOOD]
+        camps = [camp for plan in self.plans[:2] for camp in plan.statistics().values()]
+        self.assertEqual(totals['num_of_camps'], 6)
+        self.assertEqual(totals['num_of_refugees'], sum(camp['num_of_refugees'] for camp in camps))
+        self.assertEqual(totals['num_of_volunteers_needed'],
+                         sum(-camp['num_volunteers_vs_standard'] for camp in camps
+                             if camp['num_volunteers_vs_standard'] < 0))
+        self.assertEqual(PlanStatistics().totals_by('geographical_area')['London']['num_of_camps'], 6)
+        with self.assertRaises(PlanStatistics.InvalidColumnError):
+            statistics.totals_by('camp_name')
+
+    def test_neediest_camps(self):
+        neediest = PlanStatistics().neediest_camps()
+        shortfalls = [num_volunteers_vs_standard for _, _, num_volunteers_vs_standard in neediest]
+        self.assertEqual(shortfalls, sorted(shortfalls))
+        self.assertTrue(all(shortfall < 0 for shortfall in shortfalls))
+        self.assertEqual(neediest[0],
+                         ('plan0', 'camp2', self.plans[0].statistics()['camp2']['num_volunteers_vs_standard']))
+        self.assertEqual(len(PlanStatistics().neediest_camps(2)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 import unittest
-from datetime import date
+from datetime import date, timedelta
 
+from models.camp import Camp
+from models.plan import Plan
 from models.refugee import Refugee
 
 
@@ -89,3 +91,85 @@ class RefugeeTest(unittest.TestCase):
                     num_of_family_member=1,
                     starting_date=date(2022, 1, 1),
                     medical_condition_type=[Refugee.MedicalCondition.HIV])
+
+
+class RefugeeIndexTest(unittest.TestCase):
+    """
+    Test finding refugees by id across plans and camps
+    """
+
+    def setUp(self):
+        Plan.delete_all()
+        self.camp = Camp(name='camp1')
+        Plan(name='test_plan',
+             emergency_type=Plan.EmergencyType.EARTHQUAKE,
+             description='Test emergency plan',
+             geographical_area='London',
+             camps=[self.camp])
+        self.refugee = Refugee(firstname="Tom", lastname="Bond", num_of_family_member=1,
+                               starting_date=date(2020, 1, 2))
+
+    def tearDown(self):
+        Plan.delete_all()
+
+    def test_indexed_while_in_camp(self):
+        self.assertIsNone(Refugee.find_embedded(self.refugee.user_id))
+        self.camp.refugees.add(self.refugee)
+        self.assertIs(Refugee.find_embedded(self.refugee.user_id), self.refugee)
+        self.camp.refugees.remove(self.refugee)
+        self.assertIsNone(Refugee.find_embedded(self.refugee.user_id))
+
+    def test_rebuilt_on_reload(self):
+        self.camp.refugees.add(self.refugee)
+        Plan.reload()
+        Plan.load_all()
+        refugee = Refugee.find_embedded(self.refugee.user_id)
+        self.assertIsNot(refugee, self.refugee)
+        self.assertIs(refugee, Plan.find('test_plan').camps.get('camp1').refugees.get(self.refugee.user_id))
+
+    def test_not_indexed_after_delete(self):
+        self.camp.refugees.add(self.refugee)
+        self.refugee.delete()
+        self.assertIsNone(Refugee.find_embedded(self.refugee.user_id))
+
+    def test_find_by_starting_date(self):
+        refugee = Refugee(firstname="Tim", lastname="Bond", num_of_family_member=3,
+                          starting_date=date.today() - timedelta(days=3))
+        self.camp.refugees.add(self.refugee, refugee)
+        self.assertEqual(list(Refugee.find_range('starting_date', low=date.today() - timedelta(days=7))), [refugee])
+        self.assertEqual(list(Refugee.find_range('num_of_family_member', 2)), [refugee])
+        self.assertEqual(len(Refugee.find_by(lastname='Bond')), 2)
+
+    def test_query_in_plan(self):
+        refugee = Refugee(firstname="Tim", lastname="Bond", num_of_family_member=3,
+                          starting_date=date.today() - timedelta(days=3))
+        other_camp = Camp(name='camp2')
+        other_plan = Plan(name='other_plan',
+                          emergency_type=Plan.EmergencyType.FLOOD,
+                          description='Test emergency plan',
+                          geographical_area='London',
+                          camps=[other_camp])
+        self.camp.refugees.add(self.refugee, refugee)
+        other_camp.refugees.add(Refugee(firstname="Tam", lastname="Bond", num_of_family_member=2,
+                                        starting_date=date.today()))
+        plan = Plan.find('test_plan')
+        query = Refugee.query().where(lastname='Bond', starting_date__gte=date.today() - timedelta(days=7))
+        self.assertEqual(query.within(plan).all(), [refugee])
+        self.assertEqual(query.count(), 2)
+        self.assertEqual(query.within(other_plan).explain()['returned'], 1)
+
+    def test_search_after_reload(self):
+        refugee = Refugee(firstname="Tim", lastname="Bond", num_of_family_member=3,
+                          starting_date=date.today() - timedelta(days=3))
+        self.camp.refugees.add(self.refugee, refugee)
+        Plan.reload()
+        self.assertEqual(len(Refugee.find_by(lastname='Bond')), 2)
+        Plan.reload()
+        self.assertEqual(Refugee.query().where(lastname='Bond').count(), 2)
+        Plan.reload()
+        self.assertEqual([found.user_id for found in Refugee.find_range('num_of_family_member', 2)],
+                         [refugee.user_id])
+
+    def test_global_index_not_defined(self):
+        with self.assertRaises(Camp.GlobalIndexNotDefinedError):
+            Camp.find_embedded('camp1')
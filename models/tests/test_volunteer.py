@@ -1,5 +1,13 @@
+import os
+import shutil
 import unittest
+from unittest.mock import patch
 
+from models.admin import Admin
+from models.base.document import IndexedDocument
+from models.base.storage import PagedStorage, PartitionedStorage, SqliteStorage, MemoryStorage
+from models.camp import Camp
+from models.plan import Plan
 from models.user import User
 from models.volunteer import Volunteer
 
@@ -66,9 +74,115 @@ class TestVolunteer(unittest.TestCase):
             Volunteer(username='yunsy', password='root', firstname='Yunsy', lastname='Yin',
                       phone='+12345')
 
+    def test_find_by_phone(self):
+        volunteer = Volunteer(username='yunsy', password='root', firstname='Yunsy', lastname='Yin',
+                              phone='+447519953189')
+        self.assertEqual(Volunteer.find_by(phone='+447519953189'), [volunteer])
+        volunteer.phone = '+447511111111'
+        self.assertEqual(Volunteer.find_by(phone='+447519953189'), [])
+        self.assertEqual(Volunteer.find_by(phone='+447511111111'), [volunteer])
+
+    def test_login_loads_own_plan(self):
+        if IndexedDocument._storage_mode_override in ('snapshot', 'log'):
+            self.skipTest('Documents are only loaded one by one with lazy storage')
+        Plan.delete_all()
+        volunteer = Volunteer(username='yunsy', password='root', firstname='Yunsy', lastname='Yin',
+                              phone='+447519953189')
+        for name in ('plan1', 'plan2'):
+            Plan(name=name,
+                 emergency_type=Plan.EmergencyType.EARTHQUAKE,
+                 description='Test emergency plan',
+                 geographical_area='London',
+                 camps=[Camp(name='camp1')])
+        Plan.find('plan1').camps.get('camp1').volunteers.add(volunteer)
+        for index in (Plan, User, Volunteer):
+            index.reload()
+        with patch.object(PagedStorage, 'load_document', autospec=True,
+                          side_effect=PagedStorage.load_document) as load_user, \
+                patch.object(PartitionedStorage, 'load_document', autospec=True,
+                             side_effect=PartitionedStorage.load_document) as load_plan, \
+                patch.object(SqliteStorage, 'load_document', autospec=True,
+                             side_effect=SqliteStorage.load_document) as load_sqlite, \
+                patch.object(MemoryStorage, 'load_document', autospec=True,
+                             side_effect=MemoryStorage.load_document) as load_memory:
+            volunteer = User.find('yunsy')
+            loaded = {(storage.document_type, key) for (storage, key), _ in
+                      load_user.call_args_list + load_plan.call_args_list + load_sqlite.call_args_list
+                      + load_memory.call_args_list}
+        self.assertEqual(loaded, {(User, 'yunsy'), (Plan, 'plan1')})
+        self.assertEqual(volunteer.camp.plan.name, 'plan1')
+        Plan.delete_all()
+
+    def test_startup_does_not_load_plans(self):
+        if IndexedDocument._storage_mode_override in ('snapshot', 'log'):
+            self.skipTest('Documents are only loaded one by one with lazy storage')
+        Plan.delete_all()
+        Admin.delete_all()
+        Admin('admin', 'admin')
+        for name in ('plan1', 'plan2'):
+            camp = Camp(name='camp1')
+            Plan(name=name,
+                 emergency_type=Plan.EmergencyType.EARTHQUAKE,
+                 description='Test emergency plan',
+                 geographical_area='London',
+                 camps=[camp])
+            camp.volunteers.add(Volunteer(username=f'{name}_volunteer', password='root', firstname='Yunsy',
+                                          lastname='Yin', phone='+447519953189'))
+        Plan.find('plan2').close()
+        for index in (Plan, User, Volunteer, Admin):
+            index.reload()
+        with patch.object(PagedStorage, 'load_document', autospec=True,
+                          side_effect=PagedStorage.load_document) as load_user, \
+                patch.object(PartitionedStorage, 'load_document', autospec=True,
+                             side_effect=PartitionedStorage.load_document) as load_plan, \
+                patch.object(SqliteStorage, 'load_document', autospec=True,
+                             side_effect=SqliteStorage.load_document) as load_sqlite, \
+                patch.object(MemoryStorage, 'load_document', autospec=True,
+                             side_effect=MemoryStorage.load_document) as load_memory:
+            Admin.configure_initial_user()
+            loaded = {(storage.document_type, key) for (storage, key), _ in
+                      load_user.call_args_list + load_plan.call_args_list + load_sqlite.call_args_list
+                      + load_memory.call_args_list}
+        self.assertEqual(loaded, {(User, 'admin')})
+        self.assertIsNone(Admin.find('root'))
+        Plan.delete_all()
+        Admin.delete_all()
+
     def tearDown(self) -> None:
         Volunteer.delete_all()
 
 
+class BaselineDataTest(unittest.TestCase):
+    """
+    Test loading the data files written by the first version, in baseline_data: a plan with a camp,
+    and a volunteer and a refugee in the camp.
+    """
+    BASELINE_DATA = os.path.join(os.path.dirname(__file__), 'baseline_data')
+
+    def setUp(self):
+        self.addCleanup(IndexedDocument.override_storage_mode, IndexedDocument.override_storage_mode(None))
+        Plan.delete_all()
+        User.delete_all()
+        for name, path in (('Plan', Plan._persistence_path), ('User', User._persistence_path),
+                           ('Volunteer', Volunteer._separate_persistence_path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copy(os.path.join(self.BASELINE_DATA, name), path)
+        for index in (Plan, User, Volunteer):
+            index.reload()
+
+    def test_camp_of_volunteer(self):
+        self.assertEqual(User.find('baseline_volunteer').camp.name, 'baseline_camp')
+        # Migrated to the current storage modes when first loaded
+        for index in (Plan, User, Volunteer):
+            index.reload()
+        volunteer = Volunteer.find('baseline_volunteer')
+        self.assertEqual(volunteer.camp.plan.name, 'baseline_plan')
+        self.assertEqual([refugee.firstname for refugee in volunteer.camp.refugees], ['Tim'])
+
+    def tearDown(self) -> None:
+        Plan.delete_all()
+        User.delete_all()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -12,6 +12,7 @@ class User(IndexedDocument):
     """
     Base class for user with authentication mechanism
     """
+    _storage_mode = 'paged'  # Users are loaded when they log in
     username = Field(primary_key=True)
     __salt = Field()
     __password_hash = Field()
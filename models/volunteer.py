@@ -10,7 +10,7 @@ class Volunteer(User):
     account_activated = Field()
     firstname = Field()
     lastname = Field()
-    phone = Field()
+    phone = Field(index=True)
     availability = Field()
     __creation_date = Field()
 
@@ -79,13 +79,14 @@ class Volunteer(User):
     @property
     def camp(self):
         from models.camp import Camp
-        return self.find_referred_by(referrer_type=Camp)
+        return self.find_owner(Camp.volunteers)
 
     def __str__(self):
         self.status = 'available' if self.availability else 'unavailable'
         try:
-            camp_str = f"Camp '{self.camp.name}' in Plan '{self.camp.plan.name}' " \
-                       f"{'(Closed)' if self.camp.plan.is_closed else ''}"
+            camp = self.camp
+            camp_str = f"Camp '{camp.name}' in Plan '{camp.plan.name}' " \
+                       f"{'(Closed)' if camp.plan.is_closed else ''}"
         except Document.ReferrerNotFound:
             camp_str = 'not assigned'
         return f"{super().__str__()}\n" \